@@ -1,15 +1,56 @@
+import argparse
 import logging
 import os
+from datetime import datetime
 
-from hedwig.commands import requeue_dead_letter
+from hedwig.commands import ReplayFilter, ReplayStats, replay_dead_letter
+
+
+def _header(value: str):
+    name, _, header_value = value.partition("=")
+    return name, header_value
+
+
+def _print_progress(stats: ReplayStats) -> None:
+    logging.info(
+        f"pulled={stats.pulled} matched={stats.matched} replayed={stats.replayed} invalid={stats.invalid}",
+    )
 
 
 def main():
     os.environ.setdefault("SETTINGS_MODULE", "example_settings")
 
-    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(description="Re-queue messages from the Hedwig DLQ")
+    parser.add_argument("--type", dest="message_types", action="append", help="message type, may be repeated")
+    parser.add_argument("--version", dest="versions", action="append", help="version pattern, e.g. 1.*")
+    parser.add_argument("--publisher", dest="publishers", action="append", help="publisher, may be repeated")
+    parser.add_argument("--header", dest="headers", action="append", type=_header, help="header as name=value")
+    parser.add_argument("--after", type=datetime.fromisoformat, help="published at or after, ISO 8601")
+    parser.add_argument("--before", type=datetime.fromisoformat, help="published before, ISO 8601")
+    parser.add_argument("--rate", type=float, help="maximum messages per second")
+    parser.add_argument("--dry-run", action="store_true", help="only count messages")
+    parser.add_argument("--num-messages", type=int, default=10, help="messages fetched per call")
+    parser.add_argument("--visibility-timeout", type=int, help="visibility timeout in seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
     logging.info("Re-queuing Hedwig DLQ")
-    requeue_dead_letter()
+    stats = replay_dead_letter(
+        ReplayFilter(
+            message_types=args.message_types,
+            versions=args.versions,
+            publishers=args.publishers,
+            headers=dict(args.headers) if args.headers else None,
+            published_after=args.after,
+            published_before=args.before,
+        ),
+        rate_limit=args.rate,
+        dry_run=args.dry_run,
+        progress_callback=_print_progress,
+        num_messages=args.num_messages,
+        visibility_timeout=args.visibility_timeout,
+    )
+    _print_progress(stats)
 
 
 if __name__ == "__main__":
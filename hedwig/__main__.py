@@ -0,0 +1,48 @@
+import argparse
+import logging
+import os
+import signal
+import threading
+from typing import List, Optional
+
+from hedwig.outbox import OutboxRelay
+from hedwig.supervisor import supervise
+
+
+def _relay() -> None:
+    shutdown_event = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: shutdown_event.set())
+    OutboxRelay().run(shutdown_event)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m hedwig', description='Hedwig command line interface')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    consume = subparsers.add_parser('consume', help='run consumer worker processes')
+    consume.add_argument(
+        '--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes, defaults to CPU count'
+    )
+    consume.add_argument('--num-messages', type=int, default=10, help='messages fetched per call')
+    consume.add_argument('--visibility-timeout', type=int, help='visibility timeout in seconds')
+    consume.add_argument(
+        '--shutdown-timeout', type=float, default=60, help='seconds to wait for workers to finish on shut down'
+    )
+    subparsers.add_parser('relay', help='publish messages from the outbox')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'relay':
+        _relay()
+        return
+    supervise(
+        args.workers,
+        num_messages=args.num_messages,
+        visibility_timeout_s=args.visibility_timeout,
+        shutdown_timeout_s=args.shutdown_timeout,
+    )
+
+
+if __name__ == '__main__':
+    main()
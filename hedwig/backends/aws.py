@@ -1,23 +1,79 @@
 import base64
 import dataclasses
 import logging
+import math
 import threading
 from datetime import datetime, timezone
-from time import time
-from typing import cast, Optional, Generator, List, Union, Dict
-from unittest import mock
+from typing import cast, Optional, Generator, List, Union, Dict, Tuple
 
 import boto3
 import funcy
 from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from retrying import retry
 
-from hedwig.backends.base import HedwigConsumerBaseBackend, HedwigPublisherBaseBackend
+from hedwig.backends.base import HedwigConsumerBaseBackend, HedwigPublisherBaseBackend, SyncMetadata
 from hedwig.backends.exceptions import PartialFailure
 from hedwig.conf import settings
 from hedwig.models import Message
 from hedwig.utils import log
 
+# the maximum visibility timeout allowed by SQS
+MAX_VISIBILITY_TIMEOUT_S = 43200
+
+# the default visibility timeout of SQS queues
+DEFAULT_VISIBILITY_TIMEOUT_S = 30
+
+# the maximum number of message attributes allowed by SQS
+MAX_MESSAGE_ATTRIBUTES = 10
+
+# boto3 default session isn't thread-safe, so clients are created one at a time
+_client_creation_lock = threading.Lock()
+
+
+def _client_config(**kwargs) -> Config:
+    retries: Dict[str, Union[str, int]] = {}
+    if settings.AWS_RETRY_MODE is not None:
+        retries['mode'] = settings.AWS_RETRY_MODE
+    if settings.AWS_RETRY_MAX_ATTEMPTS is not None:
+        retries['total_max_attempts'] = settings.AWS_RETRY_MAX_ATTEMPTS
+    return Config(
+        max_pool_connections=settings.AWS_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=settings.AWS_TCP_KEEPALIVE,
+        retries=retries or None,
+        **kwargs,
+    )
+
+
+class _ClientCache:
+    """
+    Caches boto3 clients and resources either per backend, or per thread if ``AWS_THREAD_LOCAL_CLIENTS`` is set, since
+    boto3 resources aren't thread-safe.
+    """
+
+    def __init__(self) -> None:
+        self._shared: dict = {}
+        self._local = threading.local()
+
+    def get(self, name: str, factory):
+        if settings.AWS_THREAD_LOCAL_CLIENTS:
+            clients = self._local.__dict__
+        else:
+            clients = self._shared
+        if name not in clients:
+            with _client_creation_lock:
+                if name not in clients:
+                    clients[name] = factory()
+        return clients[name]
+
+
+def _warmup_request(fn, **kwargs) -> None:
+    try:
+        fn(**kwargs)
+    except (BotoCoreError, ClientError):
+        # connection is established even if request fails, e.g. due to missing permissions
+        log(__name__, logging.WARNING, 'Failed to warm up AWS client', exc_info=True)
+
 
 @dataclasses.dataclass(frozen=True)
 class AWSMetadata:
@@ -51,22 +107,36 @@ class AWSMetadata:
 
 class AWSSNSPublisherBackend(HedwigPublisherBaseBackend):
     def __init__(self):
-        self._sns_client = None
+        self._clients = _ClientCache()
+        if settings.AWS_WARMUP_CLIENTS:
+            self.warmup()
 
     @property
     def sns_client(self):
-        if self._sns_client is None:
-            config = Config(connect_timeout=settings.AWS_CONNECT_TIMEOUT_S, read_timeout=settings.AWS_READ_TIMEOUT_S)
-            self._sns_client = boto3.client(
-                'sns',
-                region_name=settings.AWS_REGION,
-                aws_access_key_id=settings.AWS_ACCESS_KEY,
-                aws_secret_access_key=settings.AWS_SECRET_KEY,
-                aws_session_token=settings.AWS_SESSION_TOKEN,
-                endpoint_url=settings.AWS_ENDPOINT_SNS,
-                config=config,
-            )
-        return self._sns_client
+        return self._clients.get('sns', self._create_sns_client)
+
+    @staticmethod
+    def _create_sns_client():
+        config = _client_config(
+            connect_timeout=settings.AWS_CONNECT_TIMEOUT_S, read_timeout=settings.AWS_READ_TIMEOUT_S
+        )
+        return boto3.client(
+            'sns',
+            region_name=settings.AWS_REGION,
+            aws_access_key_id=settings.AWS_ACCESS_KEY,
+            aws_secret_access_key=settings.AWS_SECRET_KEY,
+            aws_session_token=settings.AWS_SESSION_TOKEN,
+            endpoint_url=settings.AWS_ENDPOINT_SNS,
+            config=config,
+        )
+
+    def warmup(self) -> None:
+        """
+        Creates the SNS client and opens a connection, so that the first publish doesn't pay for it. Called when the
+        backend is created if ``AWS_WARMUP_CLIENTS`` is set. Call this in each publishing thread if
+        ``AWS_THREAD_LOCAL_CLIENTS`` is set.
+        """
+        _warmup_request(self.sns_client.list_topics)
 
     @classmethod
     def _get_sns_topic(cls, message: Message) -> str:
@@ -86,25 +156,6 @@ class AWSSNSPublisherBackend(HedwigPublisherBaseBackend):
         )
         return response['MessageId']
 
-    def _mock_queue_message(self, message: Message) -> mock.Mock:
-        sqs_message = mock.Mock()
-        payload, attributes = message.serialize()
-        # SQS requires UTF-8 encoded string
-        if isinstance(payload, bytes):
-            payload = base64.encodebytes(payload).decode()
-            attributes['hedwig_encoding'] = 'base64'
-        sqs_message.body = payload
-        sqs_message.message_attributes = {
-            k: {'DataType': 'String', 'StringValue': str(v)} for k, v in attributes.items()
-        }
-        sqs_message.attributes = {
-            'ApproximateReceiveCount': 1,
-            'SentTimestamp': int(time() * 1000),
-            'ApproximateFirstReceiveTimestamp': int(time() * 1000),
-        }
-        sqs_message.receipt_handle = 'test-receipt'
-        return sqs_message
-
     def _publish(self, message: Message, payload: Union[str, bytes], attributes: Dict[str, str]) -> str:
         topic = self._get_sns_topic(message)
         # SNS requires UTF-8 encoded string
@@ -119,39 +170,60 @@ class AWSSQSConsumerBackend(HedwigConsumerBaseBackend):
 
     def __init__(self, dlq=False):
         super().__init__()
-        self._sqs_resource = None
-        self._sqs_client = None
+        self._clients = _ClientCache()
         self.queue_name = f'HEDWIG-{settings.HEDWIG_QUEUE}{"-DLQ" if dlq else ""}'
+        if settings.AWS_WARMUP_CLIENTS:
+            self.warmup()
 
     @property
     def sqs_resource(self):
-        if self._sqs_resource is None:
-            self._sqs_resource = boto3.resource(
-                'sqs',
-                region_name=settings.AWS_REGION,
-                aws_access_key_id=settings.AWS_ACCESS_KEY,
-                aws_secret_access_key=settings.AWS_SECRET_KEY,
-                aws_session_token=settings.AWS_SESSION_TOKEN,
-                endpoint_url=settings.AWS_ENDPOINT_SQS,
-            )
-        return self._sqs_resource
+        return self._clients.get('sqs_resource', self._create_sqs_resource)
 
     @property
     def sqs_client(self):
-        if self._sqs_client is None:
-            self._sqs_client = boto3.client(
-                'sqs',
-                region_name=settings.AWS_REGION,
-                aws_access_key_id=settings.AWS_ACCESS_KEY,
-                aws_secret_access_key=settings.AWS_SECRET_KEY,
-                aws_session_token=settings.AWS_SESSION_TOKEN,
-                endpoint_url=settings.AWS_ENDPOINT_SQS,
-            )
-        return self._sqs_client
+        return self._clients.get('sqs_client', self._create_sqs_client)
+
+    @staticmethod
+    def _create_sqs_resource():
+        return boto3.resource(
+            'sqs',
+            region_name=settings.AWS_REGION,
+            aws_access_key_id=settings.AWS_ACCESS_KEY,
+            aws_secret_access_key=settings.AWS_SECRET_KEY,
+            aws_session_token=settings.AWS_SESSION_TOKEN,
+            endpoint_url=settings.AWS_ENDPOINT_SQS,
+            config=_client_config(),
+        )
+
+    @staticmethod
+    def _create_sqs_client():
+        return boto3.client(
+            'sqs',
+            region_name=settings.AWS_REGION,
+            aws_access_key_id=settings.AWS_ACCESS_KEY,
+            aws_secret_access_key=settings.AWS_SECRET_KEY,
+            aws_session_token=settings.AWS_SESSION_TOKEN,
+            endpoint_url=settings.AWS_ENDPOINT_SQS,
+            config=_client_config(),
+        )
+
+    def warmup(self) -> None:
+        """
+        Creates the SQS client and resource and opens a connection, so that the first API call doesn't pay for it.
+        Called when the backend is created if ``AWS_WARMUP_CLIENTS`` is set.
+        """
+        self.sqs_resource
+        _warmup_request(self.sqs_client.get_queue_url, QueueName=self.queue_name)
 
     def _get_queue(self):
         return self.sqs_resource.get_queue_by_name(QueueName=self.queue_name)
 
+    def _get_dead_letter_queue(self):
+        return self._clients.get(
+            'dead_letter_queue',
+            lambda: self.sqs_resource.get_queue_by_name(QueueName=f'HEDWIG-{settings.HEDWIG_QUEUE}-DLQ'),
+        )
+
     def pull_messages(
         self,
         num_messages: int = 10,
@@ -179,12 +251,17 @@ class AWSSQSConsumerBackend(HedwigConsumerBaseBackend):
             self._perform_error_counter_inactivity_reset()
             self._call_heartbeat_hook()
 
-    def process_message(self, queue_message) -> None:
+    @staticmethod
+    def _payload_and_attributes(queue_message) -> Tuple[Union[str, bytes], dict]:
         attributes = {k: o['StringValue'] for k, o in (queue_message.message_attributes or {}).items()}
         # body is always UTF-8 string
         message_payload = queue_message.body
         if attributes.get("hedwig_encoding") == "base64":
             message_payload = base64.decodebytes(message_payload.encode())
+        return message_payload, attributes
+
+    def process_message(self, queue_message) -> None:
+        message_payload, attributes = self._payload_and_attributes(queue_message)
         receipt = queue_message.receipt_handle
         self.message_handler(
             message_payload,
@@ -203,8 +280,41 @@ class AWSSQSConsumerBackend(HedwigConsumerBaseBackend):
         queue_message.delete()
 
     def nack_message(self, queue_message) -> None:
-        # let visibility timeout take care of it
-        pass
+        delay_s = self._retry_delay_s(int(queue_message.attributes['ApproximateReceiveCount']))
+        if delay_s is not None:
+            # redeliver once the new visibility timeout expires
+            queue_message.change_visibility(VisibilityTimeout=min(int(delay_s), MAX_VISIBILITY_TIMEOUT_S))
+        # otherwise, let visibility timeout take care of it
+
+    def _lease_s(self) -> int:
+        # visibility timeout that messages were pulled with
+        return self._visibility_timeout or settings.HEDWIG_VISIBILITY_TIMEOUT_S or DEFAULT_VISIBILITY_TIMEOUT_S
+
+    def _extend_queued_message_lease(self, queue_message) -> Optional[float]:
+        visibility_timeout_s = self._lease_s()
+        queue_message.change_visibility(VisibilityTimeout=visibility_timeout_s)
+        return visibility_timeout_s
+
+    def _extend_lease_for_wait(self, provider_metadata: AWSMetadata, wait_s: float) -> bool:
+        visibility_timeout_s = math.ceil(wait_s) + self._lease_s()
+        if visibility_timeout_s > MAX_VISIBILITY_TIMEOUT_S:
+            return False
+        self.extend_visibility_timeout(visibility_timeout_s, provider_metadata)
+        return True
+
+    def _quarantine_message(self, queue_message, error: str) -> None:
+        message_attributes = dict(queue_message.message_attributes or {})
+        if len(message_attributes) < MAX_MESSAGE_ATTRIBUTES:
+            message_attributes['hedwig_error'] = {'DataType': 'String', 'StringValue': error}
+        else:
+            # no room for another attribute, all of the existing ones are needed to process the message later
+            log(
+                __name__,
+                logging.WARNING,
+                'Too many message attributes to add error, moving message to DLQ without it',
+                extra={'queue_message': queue_message, 'error': error},
+            )
+        self._get_dead_letter_queue().send_message(MessageBody=queue_message.body, MessageAttributes=message_attributes)
 
     def extend_visibility_timeout(self, visibility_timeout_s: int, metadata: AWSMetadata) -> None:
         """
@@ -230,38 +340,51 @@ class AWSSQSConsumerBackend(HedwigConsumerBaseBackend):
 
         log(__name__, logging.INFO, "Re-queueing messages from {} to {}".format(dead_letter_queue.url, sqs_queue.url))
         while True:
-            queue_messages = self.pull_messages(num_messages=num_messages, visibility_timeout=visibility_timeout)
-            queue_messages = cast(list, queue_messages)
+            queue_messages = self._pull_dead_letter(num_messages, visibility_timeout)
 
             if not queue_messages:
                 break
 
             log(__name__, logging.INFO, "got {} messages from dlq".format(len(queue_messages)))
 
-            result = sqs_queue.send_messages(
-                Entries=[
-                    funcy.merge(
-                        {'Id': queue_message.message_id, 'MessageBody': queue_message.body},
-                        (
-                            {'MessageAttributes': queue_message.message_attributes}
-                            if queue_message.message_attributes
-                            else {}
-                        ),
-                    )
-                    for queue_message in queue_messages
-                ]
-            )
-            if result.get('Failed'):
-                raise PartialFailure(result)
-
-            dead_letter_queue.delete_messages(
-                Entries=[
-                    {'Id': message.message_id, 'ReceiptHandle': message.receipt_handle} for message in queue_messages
-                ]
-            )
+            self._requeue_dead_letter(queue_messages, sqs_queue=sqs_queue, dead_letter_queue=dead_letter_queue)
 
             log(__name__, logging.INFO, "Re-queued {} messages".format(len(queue_messages)))
 
+    def _pull_dead_letter(self, num_messages: int, visibility_timeout: Optional[int]) -> list:
+        return cast(list, self.pull_messages(num_messages=num_messages, visibility_timeout=visibility_timeout))
+
+    def _decode_dead_letter(self, queue_message) -> Tuple[str, Union[str, bytes], dict]:
+        message_payload, attributes = self._payload_and_attributes(queue_message)
+        return queue_message.message_id, message_payload, attributes
+
+    def _requeue_dead_letter(self, queue_messages: list, sqs_queue=None, dead_letter_queue=None) -> int:
+        if sqs_queue is None:
+            sqs_queue = self.sqs_resource.get_queue_by_name(QueueName=f'HEDWIG-{settings.HEDWIG_QUEUE}')
+        if dead_letter_queue is None:
+            dead_letter_queue = self._get_queue()
+
+        result = sqs_queue.send_messages(
+            Entries=[
+                funcy.merge(
+                    {'Id': queue_message.message_id, 'MessageBody': queue_message.body},
+                    (
+                        {'MessageAttributes': queue_message.message_attributes}
+                        if queue_message.message_attributes
+                        else {}
+                    ),
+                )
+                for queue_message in queue_messages
+            ]
+        )
+        if result.get('Failed'):
+            raise PartialFailure(result)
+
+        dead_letter_queue.delete_messages(
+            Entries=[{'Id': message.message_id, 'ReceiptHandle': message.receipt_handle} for message in queue_messages]
+        )
+        return len(queue_messages)
+
     @staticmethod
     def pre_process_hook_kwargs(queue_message) -> dict:
         return {'sqs_queue_message': queue_message}
@@ -270,9 +393,20 @@ class AWSSQSConsumerBackend(HedwigConsumerBaseBackend):
     def post_process_hook_kwargs(queue_message) -> dict:
         return {"sqs_queue_message": queue_message}
 
+    @staticmethod
+    def sync_process_hook_kwargs(sync_metadata: SyncMetadata) -> dict:
+        return {'sqs_queue_message': sync_metadata}
+
     def message_attributes(self, queue_message) -> dict:
         return {k: v["StringValue"] for k, v in queue_message.message_attributes.items()}
 
+    def _message_timestamp(self, queue_message, attributes: Dict[str, str]) -> Optional[float]:
+        timestamp = super()._message_timestamp(queue_message, attributes)
+        if timestamp is None:
+            # time the message was sent to the queue, requested with AttributeNames
+            timestamp = int(queue_message.attributes['SentTimestamp']) / 1000
+        return timestamp
+
 
 class AWSSNSConsumerBackend(HedwigConsumerBaseBackend):
     def requeue_dead_letter(self, num_messages: int = 10, visibility_timeout: Optional[int] = None) -> None:
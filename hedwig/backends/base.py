@@ -1,18 +1,49 @@
 import abc
+import enum
 import logging
 import threading
+import time
 import uuid
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional, Union, Generator, List, Any, Dict, Tuple, Iterator
+from distutils.version import StrictVersion
+from typing import Optional, Union, Generator, List, Any, Dict, NamedTuple, Tuple, Iterator, Collection
 
+from hedwig.callback import Callback
 from hedwig.conf import settings
-from hedwig.exceptions import ValidationError, IgnoreException, LoggingException, RetryException
+from hedwig.dedup import DedupStore
+from hedwig.exceptions import ValidationError, IgnoreException, LoggingException, RetryException, CallbackNotFound
 from hedwig.models import Message
 from hedwig.utils import log
 
 
+class SyncMetadata:
+    """
+    Provider metadata for messages dispatched in-process, when ``HEDWIG_SYNC`` is set
+    """
+
+    __slots__ = ('topic', 'delivery_attempt')
+
+    def __init__(self, topic: Union[str, Tuple[str, str]], delivery_attempt: int = 1) -> None:
+        self.topic = topic
+        """
+        The topic the message would've been published to
+        """
+        self.delivery_attempt = delivery_attempt
+        """
+        Always 1, since sync messages aren't redelivered
+        """
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, SyncMetadata):
+            return NotImplemented
+        return self.topic == other.topic and self.delivery_attempt == other.delivery_attempt
+
+    def __repr__(self) -> str:
+        return f'SyncMetadata(topic={self.topic!r}, delivery_attempt={self.delivery_attempt})'
+
+
 class HedwigPublisherBaseBackend(abc.ABC):
     @classmethod
     def topic(cls, message: Message) -> Union[str, Tuple[str, str]]:
@@ -27,17 +58,11 @@ class HedwigPublisherBaseBackend(abc.ABC):
         from hedwig.backends.utils import get_consumer_backend
 
         consumer_backend = get_consumer_backend()
-        queue_message = self._mock_queue_message(message)
-        settings.HEDWIG_PRE_PROCESS_HOOK(**consumer_backend.pre_process_hook_kwargs(queue_message))
-        consumer_backend.process_message(queue_message)
-        settings.HEDWIG_POST_PROCESS_HOOK(**consumer_backend.post_process_hook_kwargs(queue_message))
-
-    @abc.abstractmethod
-    def _mock_queue_message(self, message: Message):
-        """
-        Generate a mock queue message in proper format as expected by the transport backend. This is primarily used for
-        testing.
-        """
+        payload, attributes = message.serialize()
+        metadata = SyncMetadata(self.topic(message))
+        settings.HEDWIG_PRE_PROCESS_HOOK(**consumer_backend.sync_process_hook_kwargs(metadata))
+        consumer_backend.sync_message_handler(payload, attributes, metadata)
+        settings.HEDWIG_POST_PROCESS_HOOK(**consumer_backend.sync_process_hook_kwargs(metadata))
 
     @abc.abstractmethod
     def _publish(self, message: Message, payload: Union[str, bytes], attributes: Dict[str, str]) -> Union[str, Future]:
@@ -80,16 +105,203 @@ class HedwigPublisherBaseBackend(abc.ABC):
 
             payload, attributes = message.serialize()
 
-            result = self._publish(message, payload, attributes)
+            result = self.publish_serialized(message, payload, attributes)
+
+        return result
+
+    def publish_serialized(
+        self, message: Message, payload: Union[str, bytes], attributes: Dict[str, str]
+    ) -> Union[str, Future]:
+        """
+        Publish a message that was already serialized, with default headers and instrumentation, by :meth:`publish`.
+        This is used to publish messages that were stored, for example by :class:`hedwig.outbox.OutboxRelay`.
+        ``HEDWIG_SYNC`` isn't applied. The implementing class may modify ``attributes``.
 
-            log_published_message(message, result)
+        :return: Either a future if publisher is async, message id otherwise
+        """
+        result = self._publish(message, payload, attributes)
+
+        log_published_message(message, result)
 
         return result
 
 
+class RetryBackoff(NamedTuple):
+    """
+    Exponential backoff for redelivery of messages that failed processing.
+    """
+
+    initial_s: float
+    """Delay in seconds before the first redelivery"""
+
+    max_s: float
+    """Maximum delay in seconds"""
+
+    multiplier: float = 2.0
+    """Factor the delay is multiplied by for every subsequent delivery attempt"""
+
+    def delay_s(self, delivery_attempt: int) -> float:
+        return min(self.max_s, self.initial_s * self.multiplier ** max(delivery_attempt - 1, 0))
+
+
+class LoadShedding(NamedTuple):
+    """
+    Drops stale messages while the consumer is catching up on a backlog, so that it gets to fresh messages sooner.
+    """
+
+    backlog_age_s: float
+    """Shedding starts when a message at least this old is received"""
+
+    max_age_s: float
+    """While shedding, messages older than this are dropped. Shedding stops when a newer message is received"""
+
+    message_types: Optional[Collection[Tuple[str, str]]] = None
+    """Tuples of message type and major version pattern that may be dropped, defaults to all message types"""
+
+
+class Bulkhead(NamedTuple):
+    """
+    Processes a group of message types in its own thread pool, so that slow callbacks don't hold up other message
+    types.
+    """
+
+    name: str
+    """Message types configured with bulkheads of the same name share the thread pool"""
+
+    max_concurrency: int
+    """Number of messages processed concurrently"""
+
+    max_pending: int = 0
+    """Number of messages that may wait for a free thread, before further messages are nacked"""
+
+
+class _BulkheadPool:
+    """
+    Thread pool of a bulkhead, and the number of its messages that are queued or running.
+    """
+
+    def __init__(self, bulkhead: Bulkhead) -> None:
+        self.bulkhead = bulkhead
+        self.executor = ThreadPoolExecutor(
+            max_workers=bulkhead.max_concurrency, thread_name_prefix=f'hedwig-{bulkhead.name}'
+        )
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    def acquire(self) -> Optional[bool]:
+        """
+        Reserves a slot for a message.
+
+        :return: None if the bulkhead is full, otherwise whether the message has to wait for a free thread
+        """
+        with self._lock:
+            if self._in_flight >= self.bulkhead.max_concurrency + self.bulkhead.max_pending:
+                return None
+            self._in_flight += 1
+            return self._in_flight > self.bulkhead.max_concurrency
+
+    def release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+
+class RateLimit(NamedTuple):
+    """
+    Token bucket rate limit for processing messages.
+    """
+
+    rate: float
+    """Number of messages per second"""
+
+    burst: int = 1
+    """Number of messages that may be processed at once after the consumer was idle"""
+
+    max_wait_s: float = 0
+    """Maximum time to wait for the rate limit before the message is deferred"""
+
+
+class TokenBucket:
+    """
+    Token bucket for a rate limit, local to the consumer process.
+    """
+
+    def __init__(self, name: str, rate_limit: RateLimit) -> None:
+        self._rate_limit = rate_limit
+        self._tokens = float(rate_limit.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait_s: float) -> Tuple[bool, float]:
+        """
+        Reserves a token if one is available within ``max_wait_s``.
+
+        :return: Whether the token was reserved, and the time in seconds until it's available
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed_s = now - self._updated_at
+            self._tokens = min(self._rate_limit.burst, self._tokens + elapsed_s * self._rate_limit.rate)
+            self._updated_at = now
+            wait_s = max(0.0, (1 - self._tokens) / self._rate_limit.rate)
+            if wait_s > max_wait_s:
+                return False, wait_s
+            self._tokens -= 1
+            return True, wait_s
+
+    def refund(self) -> None:
+        """
+        Returns a reserved token that wasn't used.
+        """
+        with self._lock:
+            self._tokens += 1
+
+
+class PreFilterAction(enum.Enum):
+    """
+    What to do with a message, decided from its transport attributes before the payload is deserialized.
+    """
+
+    PROCESS = 'process'
+    """Deserialize the message and run its callback"""
+
+    SKIP = 'skip'
+    """Ack the message without deserializing it"""
+
+    DEAD_LETTER = 'dead_letter'
+    """Move the message to the DLQ without deserializing it"""
+
+
+def callbacks_pre_filter(
+    message_type: str, version: StrictVersion, headers: Dict[str, str], **kwargs
+) -> PreFilterAction:
+    """
+    Pre-filter that skips messages that no callback is registered for.
+    """
+    try:
+        Callback.find_by_message(message_type, version.version[0])
+    except CallbackNotFound:
+        return PreFilterAction.SKIP
+    return PreFilterAction.PROCESS
+
+
 class HedwigConsumerBaseBackend(abc.ABC):
     def __init__(self) -> None:
+        self._local = threading.local()
+        self._message = None
+        self._dedup_store: Optional[DedupStore] = None
+        self._rate_limit_buckets: Dict[str, TokenBucket] = {}
+        self._rate_limit_buckets_lock = threading.Lock()
+        # bulkhead thread pools by name, created lazily and only touched by the consumer loop thread
+        self._bulkheads: Dict[str, _BulkheadPool] = {}
+        # visibility timeout that messages are pulled with
+        self._visibility_timeout: Optional[int] = None
+        # decoded message type and version by schema, None if the schema is invalid
+        self._schema_cache: Dict[str, Optional[Tuple[str, StrictVersion]]] = {}
+        self._expired_count = 0
+        self._shedding_load = False
         self._error_count = 0
+        # messages in bulkheads are processed concurrently
+        self._error_count_lock = threading.Lock()
         self._heartbeat_called_at = datetime(1970, 1, 1)
         self._last_message_received_at = datetime(1970, 1, 1)
         self._heartbeat_interval_timedelta = timedelta(seconds=settings.HEDWIG_HEARTBEAT_INTERVAL_S)
@@ -98,6 +310,17 @@ class HedwigConsumerBaseBackend(abc.ABC):
         if inactivity_reset_s:
             self._heartbeat_inactivity_reset_timedelta = timedelta(seconds=inactivity_reset_s)
 
+    @property
+    def _message(self) -> Optional[Message]:
+        """
+        The message being processed by the current thread, if it could be deserialized
+        """
+        return getattr(self._local, 'message', None)
+
+    @_message.setter
+    def _message(self, message: Optional[Message]) -> None:
+        self._local.message = message
+
     def heartbeat_hook_kwargs(self) -> dict:
         return {"error_count": self.error_count}
 
@@ -109,6 +332,14 @@ class HedwigConsumerBaseBackend(abc.ABC):
     def post_process_hook_kwargs(queue_message) -> dict:
         return {}
 
+    @staticmethod
+    def sync_process_hook_kwargs(sync_metadata: SyncMetadata) -> dict:
+        """
+        Pre / post process hook kwargs for messages dispatched with ``HEDWIG_SYNC``. Backends pass ``sync_metadata`` as
+        the value of the same kwarg they use for transport messages.
+        """
+        return {}
+
     @abc.abstractmethod
     def message_attributes(self, queue_message) -> dict:
         """
@@ -133,14 +364,165 @@ class HedwigConsumerBaseBackend(abc.ABC):
         except ImportError:
             pass
 
-    def message_handler(self, message_payload: Union[str, bytes], attributes: dict, provider_metadata) -> None:
+    def _decode_schema(self, schema: str) -> Optional[Tuple[str, StrictVersion]]:
+        if schema not in self._schema_cache:
+            try:
+                self._schema_cache[schema] = settings.HEDWIG_DATA_VALIDATOR_CLASS()._decode_message_type(schema)
+            except ValidationError:
+                self._schema_cache[schema] = None
+        return self._schema_cache[schema]
+
+    def _message_timestamp(self, queue_message, attributes: Dict[str, str]) -> Optional[float]:
+        """
+        Returns the time the message was published at, as seconds since epoch, if it's known before the message is
+        deserialized.
+        """
+        try:
+            return int(attributes['hedwig_message_timestamp']) / 1000
+        except (KeyError, ValueError):
+            return None
+
+    def _is_expired(self, queue_message, attributes: Dict[str, str]) -> bool:
+        """
+        Checks message age against ``HEDWIG_MESSAGE_TTL_S`` and ``HEDWIG_LOAD_SHEDDING``, using transport attributes
+        alone.
+        """
+        load_shedding = settings.HEDWIG_LOAD_SHEDDING
+        default_ttl_s = settings.HEDWIG_DEFAULT_MESSAGE_TTL_S
+        if not settings.HEDWIG_MESSAGE_TTL_S and default_ttl_s is None and load_shedding is None:
+            return False
+        published_at = self._message_timestamp(queue_message, attributes)
+        if published_at is None:
+            return False
+        age_s = time.time() - published_at
+
+        key = None
+        if settings.HEDWIG_USE_TRANSPORT_MESSAGE_ATTRIBUTES:
+            decoded = self._decode_schema(attributes.get('hedwig_schema', ''))
+            if decoded is not None:
+                key = (decoded[0], f'{decoded[1].version[0]}.*')
+        ttl_s = settings.HEDWIG_MESSAGE_TTL_S.get(key, default_ttl_s)
+        if ttl_s is not None and age_s > ttl_s:
+            return True
+
+        if load_shedding is None:
+            return False
+        if not self._shedding_load and age_s >= load_shedding.backlog_age_s:
+            log(__name__, logging.WARNING, 'Backlog detected, dropping stale messages', extra={'age_s': age_s})
+            self._shedding_load = True
+        elif self._shedding_load and age_s <= load_shedding.max_age_s:
+            log(__name__, logging.INFO, 'Backlog cleared, no longer dropping stale messages')
+            self._shedding_load = False
+        return (
+            self._shedding_load
+            and age_s > load_shedding.max_age_s
+            and (load_shedding.message_types is None or key in load_shedding.message_types)
+        )
+
+    def _pre_filter(self, attributes: Dict[str, str]) -> PreFilterAction:
+        """
+        Decides what to do with a message from its transport attributes alone. Messages without valid transport
+        attributes are always processed, so they fail deserialization as usual.
+        """
+        if settings.HEDWIG_PRE_FILTER is None or not settings.HEDWIG_USE_TRANSPORT_MESSAGE_ATTRIBUTES:
+            return PreFilterAction.PROCESS
+        decoded = self._decode_schema(attributes.get('hedwig_schema', ''))
+        if decoded is None:
+            return PreFilterAction.PROCESS
+        message_type, version = decoded
+        headers = {k: v for k, v in attributes.items() if not k.startswith('hedwig_')}
+        return settings.HEDWIG_PRE_FILTER(message_type=message_type, version=version, headers=headers)
+
+    def _receive_message(self, message_payload: Union[str, bytes], attributes: dict, provider_metadata) -> Message:
         message = self._build_message(message_payload, attributes, provider_metadata)
+        self._message = message
         _log_received_message(message)
 
         self._maybe_update_instrumentation(message)
+        return message
 
+    def sync_message_handler(self, message_payload: Union[str, bytes], attributes: dict, provider_metadata) -> None:
+        """
+        Handles a message dispatched in-process with ``HEDWIG_SYNC``. Consumer only stages - dedup, rate limits and
+        visibility timeout extension - are skipped, since there's no queue message behind it.
+        """
+        message = self._receive_message(message_payload, attributes, provider_metadata)
         message.exec_callback()
 
+    def message_handler(self, message_payload: Union[str, bytes], attributes: dict, provider_metadata) -> None:
+        message = self._receive_message(message_payload, attributes, provider_metadata)
+
+        dedup_store = self._get_dedup_store()
+        if dedup_store is not None and dedup_store.seen(message.id):
+            raise IgnoreException(f'Message {message.id} was already processed')
+
+        self._wait_for_rate_limits(message)
+
+        message.exec_callback()
+
+    def _get_dedup_store(self) -> Optional[DedupStore]:
+        if self._dedup_store is None and settings.HEDWIG_DEDUP_STORE_CLASS is not None:
+            self._dedup_store = settings.HEDWIG_DEDUP_STORE_CLASS()
+        return self._dedup_store
+
+    def _record_processed_message(self) -> None:
+        dedup_store = self._get_dedup_store()
+        if dedup_store is None or self._message is None:
+            return
+        try:
+            dedup_store.record(self._message.id, settings.HEDWIG_DEDUP_TTL_S)
+        except Exception:
+            log(__name__, logging.ERROR, 'Exception while recording processed message', exc_info=True)
+
+    def _rate_limit_bucket(self, name: str, rate_limit: RateLimit) -> TokenBucket:
+        with self._rate_limit_buckets_lock:
+            if name not in self._rate_limit_buckets:
+                self._rate_limit_buckets[name] = settings.HEDWIG_RATE_LIMIT_BUCKET_CLASS(name, rate_limit)
+            return self._rate_limit_buckets[name]
+
+    def _wait_for_rate_limits(self, message: Message) -> None:
+        """
+        Waits for ``HEDWIG_GLOBAL_RATE_LIMIT`` and the rate limit of the message type in ``HEDWIG_RATE_LIMITS``. If a
+        limit can't be met within its ``max_wait_s``, the message is deferred until it can.
+        """
+        rate_limits = []
+        if settings.HEDWIG_GLOBAL_RATE_LIMIT is not None:
+            rate_limits.append(('global', settings.HEDWIG_GLOBAL_RATE_LIMIT))
+        rate_limit = settings.HEDWIG_RATE_LIMITS.get((message.type, f'{message.major_version}.*'))
+        if rate_limit is not None:
+            rate_limits.append((f'{message.type}:{message.major_version}', rate_limit))
+
+        reserved: List[TokenBucket] = []
+        wait_s = 0.0
+        for name, rate_limit in rate_limits:
+            bucket = self._rate_limit_bucket(name, rate_limit)
+            acquired, bucket_wait_s = bucket.reserve(rate_limit.max_wait_s)
+            if not acquired:
+                for reserved_bucket in reserved:
+                    reserved_bucket.refund()
+                self._local.deferral_s = bucket_wait_s
+                raise RetryException(f'Rate limit {name} exceeded, deferring message by {bucket_wait_s:.3f}s')
+            reserved.append(bucket)
+            wait_s = max(wait_s, bucket_wait_s)
+
+        if wait_s > 0:
+            if not self._extend_lease_for_wait(message.provider_metadata, wait_s):
+                for reserved_bucket in reserved:
+                    reserved_bucket.refund()
+                self._local.deferral_s = wait_s
+                raise RetryException(f'Rate limit wait of {wait_s:.3f}s exceeds the lease, deferring message')
+            time.sleep(wait_s)
+
+    def _extend_lease_for_wait(self, provider_metadata, wait_s: float) -> bool:
+        """
+        Extends the lease of the message being processed, so that it isn't redelivered while the consumer waits for a
+        rate limit, and its callback still has time to run afterwards.
+
+        :return: False if the lease can't be extended long enough, and the message should be deferred instead
+        """
+        # kept alive by the client library unless a backend overrides this
+        return True
+
     def fetch_and_process_messages(
         self,
         num_messages: int = 10,
@@ -149,72 +531,254 @@ class HedwigConsumerBaseBackend(abc.ABC):
     ) -> None:
         if not shutdown_event:
             shutdown_event = threading.Event()  # pragma: no cover
-        while not shutdown_event.is_set():
-            queue_messages = self.pull_messages(
-                num_messages=num_messages, visibility_timeout=visibility_timeout, shutdown_event=shutdown_event
-            )
-            for queue_message in queue_messages:
-                self._last_message_received_at = datetime.utcnow()
-                with self._maybe_instrument(self.message_attributes(queue_message)):
-                    try:
-                        settings.HEDWIG_PRE_PROCESS_HOOK(**self.pre_process_hook_kwargs(queue_message))
-                    except Exception:
-                        log(
-                            __name__,
-                            logging.ERROR,
-                            'Exception in pre process hook for message',
-                            exc_info=True,
-                            extra={'queue_message': queue_message},
-                        )
-                        self.nack_message(queue_message)
+        self._visibility_timeout = visibility_timeout
+        try:
+            while not shutdown_event.is_set():
+                queue_messages = self.pull_messages(
+                    num_messages=num_messages, visibility_timeout=visibility_timeout, shutdown_event=shutdown_event
+                )
+                for queue_message in queue_messages:
+                    self._last_message_received_at = datetime.utcnow()
+                    self._message = None
+                    self._local.deferral_s = None
+                    attributes = self.message_attributes(queue_message)
+                    if not self._filter_queue_message(queue_message, attributes):
                         continue
+                    bulkhead = self._find_bulkhead(attributes)
+                    if bulkhead is None:
+                        self._process_queue_message(queue_message, attributes)
+                    else:
+                        self._submit_to_bulkhead(bulkhead, queue_message, attributes)
+        finally:
+            self._shutdown_bulkheads()
+
+    def _filter_queue_message(self, queue_message, attributes: Dict[str, str]) -> bool:
+        """
+        Drops expired messages and applies the pre filter, before the message is deserialized.
 
-                    try:
-                        self.process_message(queue_message)
-                        self._error_count = 0
-                    except IgnoreException:
-                        log(__name__, logging.INFO, 'Ignoring task', extra={'queue_message': queue_message})
-                    except LoggingException as e:
-                        # log with message and extra
-                        log(__name__, logging.ERROR, str(e), extra=e.extra, exc_info=True)
-                        self.nack_message(queue_message)
-                        continue
-                    except RetryException:
-                        # Retry without logging exception
-                        log(__name__, logging.INFO, 'Retrying due to exception')
-                        self.nack_message(queue_message)
-                        continue
-                    except Exception:
-                        log(__name__, logging.ERROR, 'Exception while processing message', exc_info=True)
-                        self.nack_message(queue_message)
-                        self._error_count += 1
-                        continue
-                    finally:
-                        self._call_heartbeat_hook()
-
-                    try:
-                        settings.HEDWIG_POST_PROCESS_HOOK(**self.post_process_hook_kwargs(queue_message))
-                    except Exception:
-                        log(
-                            __name__,
-                            logging.ERROR,
-                            'Exception in post process hook for message',
-                            extra={'queue_message': queue_message},
-                            exc_info=True,
-                        )
-                        self.nack_message(queue_message)
-                        continue
+        :return: True if the message should be processed
+        """
+        try:
+            expired = self._is_expired(queue_message, attributes)
+            action = PreFilterAction.SKIP if expired else self._pre_filter(attributes)
+        except Exception:
+            log(
+                __name__,
+                logging.ERROR,
+                'Exception in pre filter for message',
+                exc_info=True,
+                extra={'queue_message': queue_message},
+            )
+            self.nack_message(queue_message)
+            return False
+
+        if expired:
+            self._expired_count += 1
+            log(__name__, logging.DEBUG, 'Dropping expired message', extra={'queue_message': queue_message})
+        if action is PreFilterAction.SKIP:
+            try:
+                self.ack_message(queue_message)
+            except Exception:
+                log(
+                    __name__,
+                    logging.ERROR,
+                    'Exception while deleting message',
+                    extra={'queue_message': queue_message},
+                    exc_info=True,
+                )
+            return False
+        if action is PreFilterAction.DEAD_LETTER:
+            self._move_to_dead_letter(queue_message, f'Rejected by pre filter: {attributes["hedwig_schema"]}')
+            return False
+        return True
+
+    def _find_bulkhead(self, attributes: Dict[str, str]) -> Optional[Bulkhead]:
+        if not settings.HEDWIG_BULKHEADS or not settings.HEDWIG_USE_TRANSPORT_MESSAGE_ATTRIBUTES:
+            return None
+        decoded = self._decode_schema(attributes.get('hedwig_schema', ''))
+        if decoded is None:
+            return None
+        message_type, version = decoded
+        return settings.HEDWIG_BULKHEADS.get((message_type, f'{version.version[0]}.*'))
+
+    def _submit_to_bulkhead(self, bulkhead: Bulkhead, queue_message, attributes: Dict[str, str]) -> None:
+        pool = self._bulkheads.get(bulkhead.name)
+        if pool is None:
+            pool = self._bulkheads[bulkhead.name] = _BulkheadPool(bulkhead)
+        queued = pool.acquire()
+        if queued is None:
+            log(
+                __name__,
+                logging.INFO,
+                'Bulkhead is full, retrying message later',
+                extra={'bulkhead': bulkhead.name, 'queue_message': queue_message},
+            )
+            self.nack_message(queue_message)
+            return
+        lease_expires_at = None
+        if queued:
+            # the message may wait longer than the visibility timeout it was pulled with
+            started_at = time.monotonic()
+            try:
+                lease_s = self._extend_queued_message_lease(queue_message)
+            except Exception:
+                log(
+                    __name__,
+                    logging.ERROR,
+                    'Exception while extending lease of queued message',
+                    extra={'bulkhead': bulkhead.name, 'queue_message': queue_message},
+                    exc_info=True,
+                )
+                pool.release()
+                self.nack_message(queue_message)
+                return
+            if lease_s is not None:
+                lease_expires_at = started_at + lease_s
+        future = pool.executor.submit(self._process_bulkhead_message, queue_message, attributes, lease_expires_at)
+        future.add_done_callback(lambda _: pool.release())
+
+    def _process_bulkhead_message(
+        self, queue_message, attributes: Dict[str, str], lease_expires_at: Optional[float]
+    ) -> None:
+        if lease_expires_at is not None:
+            if time.monotonic() >= lease_expires_at:
+                # the message may have been redelivered already, so don't process it twice
+                log(
+                    __name__,
+                    logging.WARNING,
+                    'Lease of queued message expired, leaving it to be redelivered',
+                    extra={'queue_message': queue_message},
+                )
+                return
+            try:
+                # renew the lease, so the callback gets the full visibility timeout
+                self._extend_queued_message_lease(queue_message)
+            except Exception:
+                log(
+                    __name__,
+                    logging.ERROR,
+                    'Exception while extending lease of queued message',
+                    extra={'queue_message': queue_message},
+                    exc_info=True,
+                )
+                return
+        self._process_queue_message(queue_message, attributes)
+
+    def _extend_queued_message_lease(self, queue_message) -> Optional[float]:
+        """
+        Extends the lease of a message that's waiting for a bulkhead thread, so that it isn't redelivered meanwhile.
+
+        :return: Number of seconds the message stays leased, or None if the lease is kept alive by the client library
+        """
+        return None
+
+    def _shutdown_bulkheads(self) -> None:
+        # wait for messages in flight, so they're acked before the consumer exits
+        while self._bulkheads:
+            _, pool = self._bulkheads.popitem()
+            pool.executor.shutdown(wait=True)
+
+    def _process_queue_message(self, queue_message, attributes: Dict[str, str]) -> None:
+        self._message = None
+        self._local.deferral_s = None
+        with self._maybe_instrument(attributes):
+            try:
+                settings.HEDWIG_PRE_PROCESS_HOOK(**self.pre_process_hook_kwargs(queue_message))
+            except Exception:
+                log(
+                    __name__,
+                    logging.ERROR,
+                    'Exception in pre process hook for message',
+                    exc_info=True,
+                    extra={'queue_message': queue_message},
+                )
+                self.nack_message(queue_message)
+                return
 
-                    try:
-                        self.ack_message(queue_message)
-                    except Exception:
-                        log(
-                            __name__,
-                            logging.ERROR,
-                            'Exception while deleting message',
-                            extra={'queue_message': queue_message},
-                            exc_info=True,
-                        )
+            try:
+                self.process_message(queue_message)
+                with self._error_count_lock:
+                    self._error_count = 0
+            except IgnoreException:
+                log(__name__, logging.INFO, 'Ignoring task', extra={'queue_message': queue_message})
+            except LoggingException as e:
+                # log with message and extra
+                log(__name__, logging.ERROR, str(e), extra=e.extra, exc_info=True)
+                self.nack_message(queue_message)
+                return
+            except RetryException:
+                # Retry without logging exception
+                log(__name__, logging.INFO, 'Retrying due to exception')
+                self.nack_message(queue_message)
+                return
+            except Exception as e:
+                # message couldn't be deserialized, so retrying won't help
+                if (
+                    isinstance(e, ValidationError)
+                    and self._message is None
+                    and settings.HEDWIG_QUARANTINE_INVALID_MESSAGES
+                ):
+                    self._quarantine_invalid_message(queue_message, e)
+                    return
+                log(__name__, logging.ERROR, 'Exception while processing message', exc_info=True)
+                self.nack_message(queue_message)
+                with self._error_count_lock:
+                    self._error_count += 1
+                return
+            finally:
+                self._call_heartbeat_hook()
+
+            try:
+                settings.HEDWIG_POST_PROCESS_HOOK(**self.post_process_hook_kwargs(queue_message))
+            except Exception:
+                log(
+                    __name__,
+                    logging.ERROR,
+                    'Exception in post process hook for message',
+                    extra={'queue_message': queue_message},
+                    exc_info=True,
+                )
+                self.nack_message(queue_message)
+                return
+
+            try:
+                self.ack_message(queue_message)
+            except Exception:
+                log(
+                    __name__,
+                    logging.ERROR,
+                    'Exception while deleting message',
+                    extra={'queue_message': queue_message},
+                    exc_info=True,
+                )
+            else:
+                self._record_processed_message()
+
+    def _quarantine_invalid_message(self, queue_message, error: ValidationError) -> None:
+        self._move_to_dead_letter(queue_message, str(error) or repr(error.__context__ or error))
+
+    def _move_to_dead_letter(self, queue_message, description: str) -> None:
+        try:
+            # attribute values are limited to 1024 bytes on Google
+            self._quarantine_message(queue_message, description.encode()[:1024].decode(errors='ignore'))
+            self.ack_message(queue_message)
+            log(__name__, logging.INFO, 'Moved message to DLQ', extra={'queue_message': queue_message})
+        except Exception:
+            log(
+                __name__,
+                logging.ERROR,
+                'Exception while moving message to DLQ',
+                extra={'queue_message': queue_message},
+                exc_info=True,
+            )
+            self.nack_message(queue_message)
+
+    def _quarantine_message(self, queue_message, error: str) -> None:
+        """
+        Copies the message to the Hedwig DLQ, with the error that caused it added as ``hedwig_error`` attribute. The
+        message is acked by the caller afterwards.
+        """
+        raise NotImplementedError
 
     @abc.abstractmethod
     def extend_visibility_timeout(self, visibility_timeout_s: int, metadata) -> None:
@@ -232,6 +796,42 @@ class HedwigConsumerBaseBackend(abc.ABC):
         Defaults to None, which is queue default
         """
 
+    _dead_letter_pull_repeats = True
+    """
+    Whether ``_pull_dead_letter`` may return a message that wasn't re-queued again, once its visibility timeout
+    expires. If so, :func:`hedwig.commands.replay_dead_letter` remembers the messages it has seen.
+    """
+
+    def _reset_dead_letter_pull(self) -> None:
+        """
+        Starts pulling from the Hedwig DLQ afresh. Called by :func:`hedwig.commands.replay_dead_letter` before the
+        first call to ``_pull_dead_letter``, since the backend may be reused by subsequent replays.
+        """
+
+    def _pull_dead_letter(self, num_messages: int, visibility_timeout: Optional[int]) -> list:
+        """
+        Pulls a batch of messages from the Hedwig DLQ. Used by :func:`hedwig.commands.replay_dead_letter`. Messages
+        that aren't re-queued must not be returned again by subsequent calls on the same backend until the next
+        ``_reset_dead_letter_pull``, at least until their visibility timeout expires.
+        """
+        raise NotImplementedError
+
+    def _decode_dead_letter(self, queue_message) -> Tuple[str, Union[str, bytes], dict]:
+        """
+        Decodes a message pulled by ``_pull_dead_letter``.
+
+        :return: a tuple of the transport message id, message payload and attributes
+        """
+        raise NotImplementedError
+
+    def _requeue_dead_letter(self, queue_messages: list) -> int:
+        """
+        Moves messages pulled by ``_pull_dead_letter`` from the Hedwig DLQ back into the Hedwig queue.
+
+        :return: Number of messages re-queued
+        """
+        raise NotImplementedError
+
     @abc.abstractmethod
     def pull_messages(
         self,
@@ -270,6 +870,22 @@ class HedwigConsumerBaseBackend(abc.ABC):
         when exception is raised during message processing.
         """
 
+    def _retry_delay_s(self, delivery_attempt: int) -> Optional[float]:
+        """
+        Returns the delay before redelivery of the message currently being processed, as configured by
+        ``HEDWIG_RETRY_BACKOFF``, or None if no backoff is configured. Messages deferred by a rate limit are delayed
+        until the rate limit allows them instead.
+        """
+        deferral_s = getattr(self._local, 'deferral_s', None)
+        if deferral_s is not None:
+            self._local.deferral_s = None
+            return deferral_s
+        backoff = settings.HEDWIG_DEFAULT_RETRY_BACKOFF
+        if self._message is not None:
+            key = (self._message.type, f'{self._message.major_version}.*')
+            backoff = settings.HEDWIG_RETRY_BACKOFF.get(key, backoff)
+        return backoff.delay_s(delivery_attempt) if backoff else None
+
     @staticmethod
     def _build_message(message_payload: Union[str, bytes], attributes: dict, provider_metadata: Any) -> Message:
         try:
@@ -285,7 +901,8 @@ class HedwigConsumerBaseBackend(abc.ABC):
         if self._heartbeat_inactivity_reset_timedelta and self.error_count:
             now = datetime.utcnow()
             if self._last_message_received_at + self._heartbeat_inactivity_reset_timedelta < now:
-                self._error_count = 0
+                with self._error_count_lock:
+                    self._error_count = 0
                 log(__name__, logging.INFO, 'Error counter was reset due to heartbeat inactivity settings')
 
     def _call_heartbeat_hook(self, force: bool = False):
@@ -309,6 +926,16 @@ class HedwigConsumerBaseBackend(abc.ABC):
         """
         return self._error_count
 
+    @property
+    def expired_count(self) -> int:
+        """
+        Returns the number of messages dropped because they were expired, as configured by ``HEDWIG_MESSAGE_TTL_S`` or
+        ``HEDWIG_LOAD_SHEDDING``.
+
+        :return: Number of expired messages
+        """
+        return self._expired_count
+
 
 def log_published_message(message: Message, result: Union[str, Future]) -> None:
     def _log(message_id: str):
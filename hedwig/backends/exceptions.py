@@ -8,3 +8,9 @@ class PartialFailure(Exception):
         self.failure_count = len(result['Failed'])
         self.result = result
         super().__init__(*args)
+
+
+class PublisherOverloaded(Exception):
+    """
+    Error indicating that a message couldn't be published because the publisher has too many messages in flight
+    """
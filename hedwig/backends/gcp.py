@@ -1,25 +1,29 @@
 import dataclasses
+import enum
+import functools
 import logging
+import os
 import threading
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import ExitStack, contextmanager
 from datetime import datetime
 from queue import Empty, Queue
-from time import time
-from typing import Dict, Generator, List, Optional, Union, cast
-from unittest import mock
+from typing import Any, Dict, Generator, List, NamedTuple, Optional, Tuple, Union, cast
 
+import grpc
 from google.api_core.exceptions import DeadlineExceeded
 from google.auth import default as google_auth_default
 from google.auth import environment_vars as google_env_vars
 from google.cloud import pubsub_v1
 from google.cloud.pubsub_v1.subscriber.message import Message as SubscriberMessage
 from google.cloud.pubsub_v1.subscriber.scheduler import Scheduler
-from google.cloud.pubsub_v1.types import FlowControl, PubsubMessage, ReceivedMessage
-from google.protobuf.timestamp_pb2 import Timestamp
+from google.cloud.pubsub_v1.types import FlowControl, ReceivedMessage
+from google.pubsub_v1.services.publisher.transports import PublisherGrpcTransport
+from google.pubsub_v1.services.subscriber.transports import SubscriberGrpcTransport
 
-from hedwig.backends.base import HedwigConsumerBaseBackend, HedwigPublisherBaseBackend
-from hedwig.backends.utils import override_env
+from hedwig.backends.base import HedwigConsumerBaseBackend, HedwigPublisherBaseBackend, SyncMetadata
+from hedwig.backends.exceptions import PublisherOverloaded
+from hedwig.backends.utils import flush_on_exit_and_fork, override_env
 from hedwig.conf import settings
 from hedwig.models import Message
 from hedwig.utils import log
@@ -28,6 +32,21 @@ from hedwig.utils import log
 # ideally find by calling PubSub REST API
 DEFAULT_VISIBILITY_TIMEOUT_S = 20
 
+# the maximum ack deadline allowed by PubSub
+MAX_ACK_DEADLINE_S = 600
+
+# channel options set by Pub/Sub clients by default
+_DEFAULT_GRPC_OPTIONS: Dict[str, Any] = {
+    'grpc.max_send_message_length': -1,
+    'grpc.max_receive_message_length': -1,
+    'grpc.max_metadata_size': 4 * 1024 * 1024,
+    'grpc.keepalive_time_ms': 30000,
+}
+
+# channels shared by all Pub/Sub clients in this process, by host
+_shared_channels: Dict[str, grpc.Channel] = {}
+_shared_channels_lock = threading.Lock()
+
 
 @contextmanager
 def _seed_credentials() -> Generator[None, None, None]:
@@ -64,6 +83,46 @@ def get_google_cloud_project() -> str:
     return settings.GOOGLE_CLOUD_PROJECT
 
 
+def _create_channel(transport_class, host: str, **kwargs) -> grpc.Channel:
+    options = {**_DEFAULT_GRPC_OPTIONS, **dict(kwargs.pop('options', ())), **dict(settings.GOOGLE_PUBSUB_GRPC_OPTIONS)}
+    if settings.GOOGLE_PUBSUB_GRPC_COMPRESSION:
+        kwargs['compression'] = grpc.Compression[settings.GOOGLE_PUBSUB_GRPC_COMPRESSION.capitalize()]
+    return transport_class.create_channel(host, options=list(options.items()), **kwargs)
+
+
+def _get_shared_channel(transport_class, host: str, **kwargs) -> grpc.Channel:
+    with _shared_channels_lock:
+        if host not in _shared_channels:
+            _shared_channels[host] = _create_channel(transport_class, host, **kwargs)
+        return _shared_channels[host]
+
+
+def _reset_shared_channels_after_fork() -> None:
+    # gRPC channels must not be shared with the parent process
+    _shared_channels.clear()
+
+
+if hasattr(os, 'register_at_fork'):  # pragma: no branch
+    os.register_at_fork(after_in_child=_reset_shared_channels_after_fork)
+
+
+def _client_kwargs(transport_class) -> dict:
+    """
+    Keyword arguments for Pub/Sub clients, with a transport that uses the configured gRPC channel options, and the
+    shared channel if ``GOOGLE_PUBSUB_SHARED_CHANNEL`` is set. Clients use the default transport if nothing is
+    configured, or if using the Pub/Sub emulator.
+    """
+    if os.environ.get('PUBSUB_EMULATOR_HOST'):
+        return {}
+    if settings.GOOGLE_PUBSUB_SHARED_CHANNEL:
+        channel = functools.partial(_get_shared_channel, transport_class)
+    elif settings.GOOGLE_PUBSUB_GRPC_OPTIONS or settings.GOOGLE_PUBSUB_GRPC_COMPRESSION:
+        channel = functools.partial(_create_channel, transport_class)
+    else:
+        return {}
+    return {'transport': transport_class(channel=channel)}
+
+
 @dataclasses.dataclass(frozen=True)
 class GoogleMetadata:
     """
@@ -93,15 +152,124 @@ class GoogleMetadata:
     """
 
 
+class OverflowBehavior(enum.Enum):
+    """
+    What to do when publishing a message would exceed in-flight limits
+    """
+
+    BLOCK = 'block'
+    """
+    Wait for in-flight messages to be published, raise :class:`hedwig.backends.exceptions.PublisherOverloaded` if
+    ``block_timeout_s`` is exceeded
+    """
+
+    RAISE = 'raise'
+    """
+    Raise :class:`hedwig.backends.exceptions.PublisherOverloaded`
+    """
+
+    DROP = 'drop'
+    """
+    Drop the message, and return a future that fails with :class:`hedwig.backends.exceptions.PublisherOverloaded`
+    """
+
+
+class InFlightLimits(NamedTuple):
+    """
+    Limits for messages published by :class:`GooglePubSubAsyncPublisherBackend` that haven't finished publishing yet
+    """
+
+    max_messages: Optional[int] = None
+    """
+    Maximum number of messages in flight, or None for no limit
+    """
+
+    max_bytes: Optional[int] = None
+    """
+    Maximum size of message payloads and attributes in flight, or None for no limit. A single message larger than this
+    is published once nothing else is in flight.
+    """
+
+    overflow: OverflowBehavior = OverflowBehavior.BLOCK
+    """
+    What to do when a limit would be exceeded
+    """
+
+    block_timeout_s: Optional[float] = None
+    """
+    Maximum number of seconds to block for, or None to block until there's capacity
+    """
+
+
+class _InFlightTracker:
+    def __init__(self, limits: InFlightLimits) -> None:
+        self._limits = limits
+        self._condition = threading.Condition()
+        self.messages = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def _has_capacity(self, size: int) -> bool:
+        # caller must hold condition lock
+        if self._limits.max_messages is not None and self.messages >= self._limits.max_messages:
+            return False
+        if self._limits.max_bytes is not None and self.messages and self.bytes + size > self._limits.max_bytes:
+            return False
+        return True
+
+    def acquire(self, size: int) -> bool:
+        """
+        Reserves capacity for a message, returns False if the message should be dropped.
+        """
+        with self._condition:
+            if not self._has_capacity(size):
+                overflow = self._limits.overflow
+                if overflow == OverflowBehavior.DROP:
+                    self.dropped += 1
+                    return False
+                if overflow == OverflowBehavior.RAISE or not self._condition.wait_for(
+                    lambda: self._has_capacity(size), self._limits.block_timeout_s
+                ):
+                    raise PublisherOverloaded(
+                        f'{self.messages} messages and {self.bytes} bytes in flight, limits: {self._limits}'
+                    )
+            self.messages += 1
+            self.bytes += size
+            return True
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self.messages -= 1
+            self.bytes -= size
+            self._condition.notify_all()
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: self.messages == 0, timeout)
+
+
 class GooglePubSubAsyncPublisherBackend(HedwigPublisherBaseBackend):
+    """
+    Publishes messages in batches in the background. Messages that haven't finished publishing are limited by
+    ``HEDWIG_PUBLISHER_GCP_IN_FLIGHT_LIMITS``, so that a publish rate higher than Pub/Sub throughput doesn't grow memory
+    without bound. Messages in flight are waited for on interpreter exit and before the process forks, for up to
+    ``HEDWIG_PUBLISHER_EXIT_TIMEOUT_S`` and ``HEDWIG_PUBLISHER_FORK_TIMEOUT_S`` seconds respectively.
+    """
+
     def __init__(self) -> None:
         self._publisher = None
+        self._in_flight = _InFlightTracker(InFlightLimits(*settings.HEDWIG_PUBLISHER_GCP_IN_FLIGHT_LIMITS))
+        flush_on_exit_and_fork(self._flush_on_exit_and_fork, stage=1)
 
     @property
     def publisher(self):
         if self._publisher is None:
             with _seed_credentials():
-                self._publisher = pubsub_v1.PublisherClient(batch_settings=settings.HEDWIG_PUBLISHER_GCP_BATCH_SETTINGS)
+                self._publisher = pubsub_v1.PublisherClient(
+                    batch_settings=settings.HEDWIG_PUBLISHER_GCP_BATCH_SETTINGS,
+                    publisher_options=settings.HEDWIG_PUBLISHER_GCP_PUBLISHER_OPTIONS,
+                    **_client_kwargs(PublisherGrpcTransport),
+                )
         return self._publisher
 
     def publish_to_topic(self, topic_path: str, data: bytes, attrs: Dict[str, str]) -> Union[str, Future]:
@@ -113,7 +281,58 @@ class GooglePubSubAsyncPublisherBackend(HedwigPublisherBaseBackend):
         to Future class. There's no generic type to represent future objects though.
         """
         attrs = dict((str(key), str(value)) for key, value in attrs.items())
-        return self.publisher.publish(topic_path, data=data, **attrs)
+        size = len(data) + sum(len(key) + len(value) for key, value in attrs.items())
+        if not self._in_flight.acquire(size):
+            log(__name__, logging.WARNING, 'Dropped message, too many messages in flight', extra={'topic': topic_path})
+            dropped: Future = Future()
+            dropped.set_exception(PublisherOverloaded('too many messages in flight'))
+            return dropped
+        try:
+            future = self.publisher.publish(topic_path, data=data, **attrs)
+        except Exception:
+            self._in_flight.release(size)
+            raise
+        future.add_done_callback(lambda _: self._in_flight.release(size))
+        return future
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for all messages in flight to finish publishing.
+
+        :param timeout: Maximum number of seconds to wait, or None to wait until done
+        :returns: True if all messages finished publishing, False if timed out
+        """
+        return self._in_flight.wait(timeout)
+
+    def _flush_on_exit_and_fork(self, timeout_s: float) -> None:
+        if not self.flush(timeout_s):
+            log(
+                __name__,
+                logging.WARNING,
+                'Messages still in flight after flush timeout',
+                extra={'in_flight_messages': self.in_flight_messages},
+            )
+
+    @property
+    def in_flight_messages(self) -> int:
+        """
+        Number of messages that haven't finished publishing
+        """
+        return self._in_flight.messages
+
+    @property
+    def in_flight_bytes(self) -> int:
+        """
+        Size of payloads and attributes of messages that haven't finished publishing
+        """
+        return self._in_flight.bytes
+
+    @property
+    def dropped_count(self) -> int:
+        """
+        Number of messages dropped because in-flight limits were exceeded
+        """
+        return self._in_flight.dropped
 
     def _get_topic_path(self, message: Message) -> str:
         topic = self.topic(message)
@@ -123,25 +342,6 @@ class GooglePubSubAsyncPublisherBackend(HedwigPublisherBaseBackend):
             project = get_google_cloud_project()
         return self.publisher.topic_path(project, f'hedwig-{topic}')
 
-    def _mock_queue_message(self, message: Message) -> "MessageWrapper":
-        payload, attributes = message.serialize()
-        # Pub/Sub requires bytes
-        if isinstance(payload, str):
-            payload = payload.encode('utf8')
-            attributes['hedwig_encoding'] = 'utf8'
-        publish_time = Timestamp()
-        publish_time.GetCurrentTime()
-        pubsub_message = PubsubMessage(
-            data=payload,
-            attributes=attributes,
-            message_id=str(int(time() * 1000)),
-            publish_time=publish_time,
-        )
-        # SubscriberMessage requires raw proto class, not proto-plus
-        subscriber_message = SubscriberMessage(PubsubMessage.pb(pubsub_message), 'test-receipt', 1, mock.MagicMock())
-        gcp_message = MessageWrapper(subscriber_message, 'test-subscription')
-        return gcp_message
-
     def _publish(self, message: Message, payload: Union[str, bytes], attributes: Dict[str, str]) -> Union[str, Future]:
         topic_path = self._get_topic_path(message)
         # Pub/Sub requires bytes
@@ -234,14 +434,14 @@ class GooglePubSubConsumerBackend(HedwigConsumerBaseBackend):
     def subscriber(self):
         if self._subscriber is None:
             with _seed_credentials():
-                self._subscriber = pubsub_v1.SubscriberClient()
+                self._subscriber = pubsub_v1.SubscriberClient(**_client_kwargs(SubscriberGrpcTransport))
         return self._subscriber
 
     @property
     def publisher(self):
         if self._publisher is None:
             with _seed_credentials():
-                self._publisher = pubsub_v1.PublisherClient()
+                self._publisher = pubsub_v1.PublisherClient(**_client_kwargs(PublisherGrpcTransport))
         return self._publisher
 
     def pull_messages(  # type: ignore[return]
@@ -314,9 +514,23 @@ class GooglePubSubConsumerBackend(HedwigConsumerBaseBackend):
         queue_message.message.ack()
 
     def nack_message(self, queue_message: MessageWrapper) -> None:
+        # delivery attempt is only counted if subscription has a dead-letter policy
+        delay_s = self._retry_delay_s(queue_message.message.delivery_attempt or 1)
+        if delay_s:
+            log(__name__, logging.INFO, "nacking message with backoff", extra={'delay_s': delay_s})
+            # redeliver once the ack deadline expires: the streaming pull leaser would otherwise keep extending the
+            # deadline, and hold on to the flow control slot of the message
+            queue_message.message.modify_ack_deadline(min(int(delay_s), MAX_ACK_DEADLINE_S))
+            queue_message.message.drop()
+            return
         log(__name__, logging.INFO, "nacking message")
         queue_message.message.nack()
 
+    def _quarantine_message(self, queue_message: MessageWrapper, error: str) -> None:
+        attributes = {**queue_message.message.attributes, 'hedwig_error': error}
+        # wait for success
+        self.publisher.publish(self._dlq_topic_path, data=queue_message.message.data, **attributes).result()
+
     @staticmethod
     def pre_process_hook_kwargs(queue_message: MessageWrapper) -> dict:
         return {'google_pubsub_message': queue_message.message}
@@ -325,9 +539,19 @@ class GooglePubSubConsumerBackend(HedwigConsumerBaseBackend):
     def post_process_hook_kwargs(queue_message: MessageWrapper) -> dict:
         return {'google_pubsub_message': queue_message.message}
 
+    @staticmethod
+    def sync_process_hook_kwargs(sync_metadata: SyncMetadata) -> dict:
+        return {'google_pubsub_message': sync_metadata}
+
     def message_attributes(self, queue_message: MessageWrapper) -> dict:
         return queue_message.message.attributes
 
+    def _message_timestamp(self, queue_message: MessageWrapper, attributes: Dict[str, str]) -> Optional[float]:
+        timestamp = super()._message_timestamp(queue_message, attributes)
+        if timestamp is None:
+            timestamp = queue_message.message.publish_time.timestamp()
+        return timestamp
+
     def extend_visibility_timeout(self, visibility_timeout_s: int, metadata: GoogleMetadata) -> None:
         """
         Extends visibility timeout of a message on a given priority queue for long running tasks.
@@ -343,7 +567,8 @@ class GooglePubSubConsumerBackend(HedwigConsumerBaseBackend):
 
     def requeue_dead_letter(self, num_messages: int = 10, visibility_timeout: Optional[int] = None) -> None:
         """
-        Re-queues everything in the Hedwig DLQ back into the Hedwig queue.
+        Re-queues everything in the Hedwig DLQ back into the Hedwig queue. Up to
+        ``GOOGLE_PUBSUB_REQUEUE_CONCURRENCY`` batches are pulled and re-queued concurrently.
 
         :param num_messages: Maximum number of messages to fetch in one call. Defaults to 10.
         :param visibility_timeout: The number of seconds the message should remain invisible to other queue readers.
@@ -354,49 +579,101 @@ class GooglePubSubConsumerBackend(HedwigConsumerBaseBackend):
         subscription_path = self._subscription_paths[0]
 
         log(__name__, logging.INFO, "Re-queueing messages from {} to {}".format(subscription_path, topic_path))
-        while True:
-            try:
-                queue_messages: List[ReceivedMessage] = self.subscriber.pull(
-                    subscription=subscription_path,
-                    max_messages=num_messages,
-                    retry=None,
-                    timeout=settings.GOOGLE_PUBSUB_READ_TIMEOUT_S,
-                ).received_messages
-            except DeadlineExceeded:
-                break
-
-            if not queue_messages:
-                break
-
-            log(__name__, logging.INFO, "got {} messages from dlq".format(len(queue_messages)))
-            for queue_message in queue_messages:
-                try:
-                    if visibility_timeout:
-                        self.subscriber.modify_ack_deadline(
-                            subscription=subscription_path,
-                            ack_ids=[queue_message.ack_id],
-                            ack_deadline_seconds=visibility_timeout,
-                        )
-
-                    future = self.publisher.publish(
-                        topic_path, data=queue_message.message.data, **queue_message.message.attributes
-                    )
-                    # wait for success
-                    future.result()
-                    log(
-                        __name__,
-                        logging.DEBUG,
-                        'Re-queued message from DLQ {} to {}'.format(subscription_path, topic_path),
-                        extra={'message_id': queue_message.message.message_id},
-                    )
+        # create clients before they're shared by worker threads
+        self.subscriber
+        self.publisher
 
-                    self.subscriber.acknowledge(subscription=subscription_path, ack_ids=[queue_message.ack_id])
-                except Exception:
-                    log(
-                        __name__,
-                        logging.ERROR,
-                        'Exception in requeue message from {} to {}'.format(subscription_path, topic_path),
-                        exc_info=True,
-                    )
+        def requeue_until_empty() -> None:
+            while self._requeue_batch(num_messages, visibility_timeout):
+                pass
+
+        concurrency = settings.GOOGLE_PUBSUB_REQUEUE_CONCURRENCY
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(requeue_until_empty) for _ in range(concurrency)]:
+                future.result()
+
+    def _requeue_batch(self, num_messages: int, visibility_timeout: Optional[int]) -> int:
+        """
+        Pulls a batch of messages from the DLQ and re-queues them.
+
+        :return: Number of messages pulled, 0 if the DLQ is empty.
+        """
+        queue_messages = self._pull_dead_letter(num_messages, visibility_timeout)
+        if not queue_messages:
+            return 0
+
+        log(__name__, logging.INFO, "got {} messages from dlq".format(len(queue_messages)))
+        count = self._requeue_dead_letter(queue_messages)
+        log(__name__, logging.INFO, "Re-queued {} messages".format(count))
+        return len(queue_messages)
+
+    def _pull_dead_letter(self, num_messages: int, visibility_timeout: Optional[int]) -> list:
+        assert len(self._subscription_paths) == 1, "multiple subscriptions found"
+        subscription_path = self._subscription_paths[0]
+        try:
+            queue_messages: List[ReceivedMessage] = self.subscriber.pull(
+                subscription=subscription_path,
+                max_messages=num_messages,
+                retry=None,
+                timeout=settings.GOOGLE_PUBSUB_READ_TIMEOUT_S,
+            ).received_messages
+        except DeadlineExceeded:
+            return []
+
+        if queue_messages and visibility_timeout:
+            self.subscriber.modify_ack_deadline(
+                subscription=subscription_path,
+                ack_ids=[queue_message.ack_id for queue_message in queue_messages],
+                ack_deadline_seconds=visibility_timeout,
+            )
+        return list(queue_messages)
+
+    def _decode_dead_letter(self, queue_message: ReceivedMessage) -> Tuple[str, Union[str, bytes], dict]:
+        message_payload: Union[str, bytes] = queue_message.message.data
+        attributes = dict(queue_message.message.attributes)
+        if attributes.get("hedwig_encoding") == "utf8":
+            message_payload = cast(bytes, message_payload).decode('utf8')
+        return queue_message.message.message_id, message_payload, attributes
+
+    def _requeue_dead_letter(self, queue_messages: list) -> int:
+        """
+        Publishes messages concurrently, and acknowledges the ones that were published successfully in a single call.
+
+        :return: Number of messages re-queued
+        """
+        topic_path = pubsub_v1.PublisherClient.topic_path(get_google_cloud_project(), f'hedwig-{settings.HEDWIG_QUEUE}')
+        subscription_path = self._subscription_paths[0]
+        futures: List[Tuple[ReceivedMessage, Future]] = []
+        for queue_message in queue_messages:
+            try:
+                future = self.publisher.publish(
+                    topic_path, data=queue_message.message.data, **queue_message.message.attributes
+                )
+            except Exception as e:
+                # don't let one message fail the rest of the batch, it stays in the DLQ
+                future = Future()
+                future.set_exception(e)
+            futures.append((queue_message, future))
+        ack_ids = []
+        for queue_message, future in futures:
+            try:
+                # wait for success
+                future.result()
+                log(
+                    __name__,
+                    logging.DEBUG,
+                    'Re-queued message from DLQ {} to {}'.format(subscription_path, topic_path),
+                    extra={'message_id': queue_message.message.message_id},
+                )
+                ack_ids.append(queue_message.ack_id)
+            except Exception:
+                log(
+                    __name__,
+                    logging.ERROR,
+                    'Exception in requeue message from {} to {}'.format(subscription_path, topic_path),
+                    exc_info=True,
+                )
 
-            log(__name__, logging.INFO, "Re-queued {} messages".format(len(queue_messages)))
+        if ack_ids:
+            self.subscriber.acknowledge(subscription=subscription_path, ack_ids=ack_ids)
+        return len(ack_ids)
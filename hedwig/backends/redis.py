@@ -1,21 +1,163 @@
 import base64
 import dataclasses
+import logging
+import socket
 import threading
 import uuid
-from concurrent.futures import Future
-from typing import Union, Dict, Optional, Generator, List, Tuple
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Callable, Union, Dict, Optional, Generator, List, NamedTuple, Tuple, cast
 
 from redis import Redis
+from redis.cluster import RedisCluster
 
-from hedwig.backends.base import HedwigPublisherBaseBackend, HedwigConsumerBaseBackend
+from hedwig.backends.base import HedwigPublisherBaseBackend, HedwigConsumerBaseBackend, RateLimit, TokenBucket
+from hedwig.backends.utils import flush_on_exit_and_fork
 from hedwig.conf import settings
+from hedwig.dedup import DedupStore
 from hedwig.models import Message
+from hedwig.utils import log
 
 
 def _client():
+    if settings.REDIS_CLUSTER:
+        return RedisCluster.from_url(settings.REDIS_URL, protocol=3)
     return Redis.from_url(settings.REDIS_URL, protocol=3)
 
 
+def _queue_stream(dlq: bool = False) -> str:
+    """
+    Stream name for the app's queue. For Redis Cluster, the queue name is used as a hash tag so that the main stream and
+    the dead-letter stream live in the same slot.
+    """
+    queue = f"{{{settings.HEDWIG_QUEUE}}}" if settings.REDIS_CLUSTER else settings.HEDWIG_QUEUE
+    return f"hedwig:{queue}:dlq" if dlq else f"hedwig:{queue}"
+
+
+def _queue_key(name: str) -> str:
+    """
+    Name of a key for the app's queue that doesn't need to share a slot with the queue's streams. Not hash tagged, so
+    that these keys are spread across the slots of Redis Cluster.
+    """
+    return f"hedwig:{settings.HEDWIG_QUEUE}:{name}"
+
+
+def _topic_streams(topic: str) -> List[str]:
+    """
+    Stream names for a subscribed topic. For partitioned topics, only the partitions assigned to this consumer
+    through ``HEDWIG_REDIS_PARTITION_ASSIGNMENT`` are returned.
+    """
+    num_partitions = settings.HEDWIG_REDIS_STREAM_PARTITIONS.get(topic)
+    if not num_partitions:
+        return [f"hedwig:{topic}"]
+    partitions = range(num_partitions)
+    if settings.HEDWIG_REDIS_PARTITION_ASSIGNMENT:
+        worker_index, num_workers = settings.HEDWIG_REDIS_PARTITION_ASSIGNMENT
+        partitions = range(worker_index, num_partitions, num_workers)
+    return [f"hedwig:{topic}:{partition}" for partition in partitions]
+
+
+# Claims timed out messages from multiple streams, attaches delivery counts, and moves messages that exceeded max
+# delivery attempts to the dead-letter stream, in a single round trip.
+# KEYS: streams to claim from, optionally followed by the dead-letter stream
+# ARGV: group, consumer, min idle time in ms, count, max delivery attempts, followed by a start id for every stream
+# Returns the next start id, a list of (id, fields, delivery attempt) tuples, and a list of (id, fields) tuples for
+# messages that need to be dead-lettered by the caller (only if dead-letter stream wasn't passed) for every stream
+_CLAIM_SCRIPT = """
+local group, consumer, min_idle_time, count = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local max_delivery_attempts = tonumber(ARGV[5])
+local num_streams = #ARGV - 5
+local deadletter_stream = KEYS[num_streams + 1]
+local result = {}
+for i = 1, num_streams do
+    local stream = KEYS[i]
+    local claimed = redis.call('XAUTOCLAIM', stream, group, consumer, min_idle_time, ARGV[i + 5], 'COUNT', count)
+    local entries = {}
+    local deadletter_entries = {}
+    for _, entry in ipairs(claimed[2]) do
+        local id, fields = entry[1], entry[2]
+        if not fields then
+            -- entry was deleted from the stream, only Redis < 7 returns these
+            redis.call('XACK', stream, group, id)
+        else
+            local delivery_attempt = redis.call('XPENDING', stream, group, id, id, 1)[1][4]
+            if delivery_attempt <= max_delivery_attempts then
+                table.insert(entries, {id, fields, delivery_attempt})
+            elseif deadletter_stream then
+                redis.call('XADD', deadletter_stream, '*', unpack(fields))
+                redis.call('XACK', stream, group, id)
+            else
+                table.insert(deadletter_entries, {id, fields})
+            end
+        end
+    end
+    table.insert(result, {claimed[1], entries, deadletter_entries})
+end
+return result
+"""
+
+
+# Removes consumers that have been idle for longer than the given time from a group. Pending entries of removed consumers
+# are first moved to the given consumer, keeping their idle times and delivery counts, so they're picked up by the
+# regular reclaim.
+# KEYS: stream
+# ARGV: group, consumer, max idle time in ms
+# Returns the number of removed consumers
+_REMOVE_IDLE_CONSUMERS_SCRIPT = """
+local stream = KEYS[1]
+local group, consumer, max_idle_time = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local removed = 0
+for _, info in ipairs(redis.call('XINFO', 'CONSUMERS', stream, group)) do
+    local fields = {}
+    for i = 1, #info, 2 do
+        fields[info[i]] = info[i + 1]
+    end
+    if fields['name'] ~= consumer and fields['idle'] > max_idle_time then
+        if fields['pending'] > 0 then
+            local pending = redis.call('XPENDING', stream, group, '-', '+', fields['pending'], fields['name'])
+            for _, entry in ipairs(pending) do
+                redis.call('XCLAIM', stream, group, consumer, 0, entry[1], 'IDLE', entry[3], 'JUSTID')
+            end
+        end
+        redis.call('XGROUP', 'DELCONSUMER', stream, group, fields['name'])
+        removed = removed + 1
+    end
+end
+return removed
+"""
+
+# Token bucket shared by all consumers, using server time so that consumer clocks don't matter.
+# KEYS: bucket
+# ARGV: rate per second, burst, max wait in seconds
+# Returns whether a token was reserved, and the wait in seconds until it's available as a string
+_RATE_LIMIT_SCRIPT = """
+local bucket = KEYS[1]
+local rate, burst, max_wait = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', bucket, 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or burst
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local wait = math.max(0, (1 - tokens) / rate)
+local reserved = 0
+if wait <= max_wait then
+    tokens = tokens - 1
+    reserved = 1
+end
+redis.call('HSET', bucket, 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', bucket, math.ceil((burst + 1) / rate + max_wait))
+return {reserved, tostring(wait)}
+"""
+
+
+def _fields_to_dict(fields: List[bytes]) -> Dict[bytes, bytes]:
+    # Lua scripts return stream entry fields as a flat list
+    return dict(zip(fields[::2], fields[1::2]))
+
+
 @dataclasses.dataclass(frozen=True)
 class RedisMessage:
     stream: bytes
@@ -44,32 +186,127 @@ class RedisMetadata:
     """
 
 
+class BatchSettings(NamedTuple):
+    """
+    Batching configuration for :class:`RedisStreamsAsyncPublisherBackend`
+    """
+
+    max_messages: int = 100
+    """
+    Maximum number of messages in a batch
+    """
+
+    max_latency: float = 0.01
+    """
+    Maximum number of seconds a message is buffered before the batch is published
+    """
+
+
 class RedisStreamsPublisherBackend(HedwigPublisherBaseBackend):
     def __init__(self) -> None:
         self._r = _client()
 
-    def _mock_queue_message(self, message: Message) -> RedisMessage:
-        payload, attributes = message.serialize()
+    @staticmethod
+    def _redis_message(payload: Union[str, bytes], attributes: Dict[str, str]) -> Dict[str, str]:
+        # Redis requires UTF-8 encoded strings
         if isinstance(payload, bytes):
             payload = base64.encodebytes(payload).decode()
             attributes['hedwig_encoding'] = 'base64'
-        redis_message = {"hedwig_payload": payload, **attributes}
-        redis_message = {k.encode(): v.encode() for k, v in redis_message.items()}
-        stream = f"hedwig:{self.topic(message)}".encode()
-        message_id = f"{attributes['hedwig_message_timestamp']}-0".encode()
-        return RedisMessage(stream=stream, key=message_id, payload=redis_message, delivery_attempt=1)
+        return {"hedwig_payload": payload, **attributes}
+
+    @classmethod
+    def _stream(cls, message: Message) -> str:
+        """
+        The stream name for the message. Messages for partitioned topics are spread over partition streams by hashing
+        the partition key, so that all messages with the same key land in the same partition.
+        """
+        topic = cls.topic(message)
+        num_partitions = settings.HEDWIG_REDIS_STREAM_PARTITIONS.get(topic)
+        if not num_partitions:
+            return f"hedwig:{topic}"
+        partition_key = message.id
+        if settings.HEDWIG_REDIS_PARTITION_KEY_HEADER:
+            partition_key = message.headers.get(settings.HEDWIG_REDIS_PARTITION_KEY_HEADER, partition_key)
+        # crc32 is stable across processes, unlike hash()
+        return f"hedwig:{topic}:{zlib.crc32(partition_key.encode()) % num_partitions}"
 
     def _publish(self, message: Message, payload: Union[str, bytes], attributes: Dict[str, str]) -> Union[str, Future]:
-        key = f"hedwig:{self.topic(message)}"
-        # Redis requires UTF-8 encoded strings
-        if isinstance(payload, bytes):
-            payload = base64.encodebytes(payload).decode()
-            attributes['hedwig_encoding'] = 'base64'
-        redis_message = {"hedwig_payload": payload, **attributes}
-        message_id = self._r.xadd(key, redis_message)
+        message_id = self._r.xadd(self._stream(message), self._redis_message(payload, attributes))
         return message_id
 
 
+class RedisStreamsAsyncPublisherBackend(RedisStreamsPublisherBackend):
+    """
+    Buffers messages and publishes them in batches using a pipeline, so that a burst of messages costs a single round
+    trip. A batch is published once it has ``max_messages`` messages, or ``max_latency`` seconds after its first message
+    was buffered, whichever comes first. Any buffered messages are published on interpreter exit, and before the
+    process forks.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._batch_settings = BatchSettings(*settings.HEDWIG_PUBLISHER_REDIS_BATCH_SETTINGS)
+        self._batch: List[Tuple[str, Dict[str, str], Future]] = []
+        self._batch_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        flush_on_exit_and_fork(self._flush_on_exit_and_fork, stage=1)
+
+    def _publish(self, message: Message, payload: Union[str, bytes], attributes: Dict[str, str]) -> Union[str, Future]:
+        """
+        Buffers the message and returns a future that results in the message id once the batch is published.
+        """
+        future: Future = Future()
+        batch = None
+        with self._batch_lock:
+            self._batch.append((self._stream(message), self._redis_message(payload, attributes), future))
+            if len(self._batch) >= self._batch_settings.max_messages:
+                batch = self._take_batch()
+            elif self._timer is None:
+                self._timer = threading.Timer(self._batch_settings.max_latency, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._publish_batch(batch)
+        return future
+
+    def flush(self) -> None:
+        """
+        Publishes all buffered messages right away, and waits for the publish to finish.
+        """
+        with self._batch_lock:
+            batch = self._take_batch()
+        if batch:
+            self._publish_batch(batch)
+
+    def _flush_on_exit_and_fork(self, timeout_s: float) -> None:
+        # publishes the batch synchronously, so the timeout doesn't apply
+        self.flush()
+
+    def _take_batch(self) -> List[Tuple[str, Dict[str, str], Future]]:
+        # caller must hold batch lock
+        batch, self._batch = self._batch, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _publish_batch(self, batch: List[Tuple[str, Dict[str, str], Future]]) -> None:
+        try:
+            with self._r.pipeline(transaction=False) as pipeline:
+                for stream, redis_message, _ in batch:
+                    pipeline.xadd(stream, redis_message)
+                results = pipeline.execute(raise_on_error=False)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
 class RedisStreamsConsumerBackend(HedwigConsumerBaseBackend):
     def __init__(self, dlq=False) -> None:
         assert (
@@ -79,23 +316,64 @@ class RedisStreamsConsumerBackend(HedwigConsumerBaseBackend):
             settings.HEDWIG_VISIBILITY_TIMEOUT_S
         ), "HEDWIG_VISIBILITY_TIMEOUT_S must be set for RedisStreamsConsumerBackend"
         self._r = _client()
+        self._claim_script = self._r.register_script(_CLAIM_SCRIPT)
         self._group = settings.HEDWIG_QUEUE
-        self._consumer_id = str(uuid.uuid4())
-        self._main_stream = f"hedwig:{settings.HEDWIG_QUEUE}"
-        self._deadletter_stream = f"hedwig:{settings.HEDWIG_QUEUE}:dlq"
+        if settings.HEDWIG_REDIS_CONSUMER_NAME:
+            self._consumer_id = settings.HEDWIG_REDIS_CONSUMER_NAME.format(
+                hostname=socket.gethostname(), worker_index=settings.HEDWIG_WORKER_INDEX
+            )
+        else:
+            self._consumer_id = str(uuid.uuid4())
+        self._main_stream = _queue_stream()
+        self._deadletter_stream = _queue_stream(dlq=True)
         if dlq:
             self._streams = [self._deadletter_stream]
         else:
-            self._streams = [f"hedwig:{x}" for x in settings.HEDWIG_SUBSCRIPTIONS]
+            self._streams = [stream for x in settings.HEDWIG_SUBSCRIPTIONS for stream in _topic_streams(x)]
             # main queue for DLQ re-queued messages
             self._streams.append(self._main_stream)
+        # streams read with NOACK: these never have pending entries, so they're never acked or reclaimed
+        self._noack_streams = (
+            set()
+            if dlq
+            else {stream for x in settings.HEDWIG_REDIS_AT_MOST_ONCE_SUBSCRIPTIONS for stream in _topic_streams(x)}
+        )
+        # XAUTOCLAIM cursor per stream, carried over between reclaim runs
+        self._reclaim_cursors: Dict[str, bytes] = {
+            stream: b"0-0" for stream in self._streams if stream not in self._noack_streams
+        }
+        self._reclaim_called_at = datetime(1970, 1, 1)
+        self._reclaim_interval_timedelta = timedelta(seconds=settings.HEDWIG_VISIBILITY_TIMEOUT_S)
+        # XAUTOCLAIM cursor of dead-letter stream used by DLQ replay, None once pending entries have been walked
+        self._dead_letter_cursor: Optional[bytes] = b"0-0"
+        self._remove_idle_consumers_script = self._r.register_script(_REMOVE_IDLE_CONSUMERS_SCRIPT)
+        self._remove_idle_consumers_called_at = datetime(1970, 1, 1)
+        self._consumer_idle_timeout_timedelta = None
+        if settings.HEDWIG_REDIS_CONSUMER_IDLE_TIMEOUT_S:
+            assert (
+                settings.HEDWIG_REDIS_CONSUMER_IDLE_TIMEOUT_S > settings.HEDWIG_VISIBILITY_TIMEOUT_S
+            ), "HEDWIG_REDIS_CONSUMER_IDLE_TIMEOUT_S must be greater than HEDWIG_VISIBILITY_TIMEOUT_S"
+            self._consumer_idle_timeout_timedelta = timedelta(seconds=settings.HEDWIG_REDIS_CONSUMER_IDLE_TIMEOUT_S)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if settings.REDIS_CLUSTER:
+            # used to run commands for streams in different slots concurrently
+            self._executor = ThreadPoolExecutor(max_workers=len(self._streams))
         super().__init__()
 
     def message_attributes(self, queue_message: RedisMessage) -> dict:
         return {k.decode(): v.decode() for k, v in queue_message.payload.items()}
 
+    def _message_timestamp(self, queue_message: RedisMessage, attributes: Dict[str, str]) -> Optional[float]:
+        timestamp = super()._message_timestamp(queue_message, attributes)
+        if timestamp is None:
+            # auto-generated entry ids start with the time the entry was added in milliseconds
+            timestamp = int(queue_message.key.split(b"-")[0]) / 1000
+        return timestamp
+
     def extend_visibility_timeout(self, visibility_timeout_s: int, metadata) -> None:
         assert visibility_timeout_s == settings.HEDWIG_VISIBILITY_TIMEOUT_S, "Visibility timeout is not configurable"
+        if metadata.stream in self._noack_streams:
+            return
         # reset idle time to 0, thereby extending visibility timeout
         self._r.xclaim(
             name=metadata.stream,
@@ -126,7 +404,7 @@ class RedisStreamsConsumerBackend(HedwigConsumerBaseBackend):
 
             count += len(messages)
             total_count += count
-            self._requeue_messages(messages)
+            self._requeue_dead_letter(messages)
             print(f"Requeued {count} messages")
         while True:
             entries: Dict[str, List[List[Tuple[str, Dict]]]] = self._r.xreadgroup(
@@ -150,40 +428,177 @@ class RedisStreamsConsumerBackend(HedwigConsumerBaseBackend):
             total_count += count
             if count == 0:
                 break
-            self._requeue_messages(messages)
+            self._requeue_dead_letter(messages)
             print(f"Requeued {count} messages")
 
         print('-' * 80)
         print(f"Requeued total {total_count} messages")
 
-    def _requeue_messages(self, messages):
+    # entries that aren't re-queued stay pending behind the cursor, so they aren't pulled again
+    _dead_letter_pull_repeats = False
+
+    def _reset_dead_letter_pull(self) -> None:
+        self._dead_letter_cursor = b"0-0"
+
+    def _pull_dead_letter(self, num_messages: int, visibility_timeout: Optional[int]) -> list:
+        # pending entries are walked with a cursor first, so entries that aren't re-queued aren't pulled again
+        while self._dead_letter_cursor is not None:
+            next_id, entries = self._r.xautoclaim(
+                name=self._deadletter_stream,
+                groupname=self._group,
+                consumername=self._consumer_id,
+                min_idle_time=0,
+                start_id=self._dead_letter_cursor,
+                count=num_messages,
+            )[:2]
+            self._dead_letter_cursor = None if next_id == b"0-0" else next_id
+            # deleted entries have no fields on Redis < 7
+            entries = [entry for entry in entries if entry[1] is not None]
+            if entries:
+                return entries
+        stream_entries: dict[bytes, list[list[tuple[bytes, dict[bytes, bytes]]]]] = self._r.xreadgroup(
+            self._group,
+            self._consumer_id,
+            streams={self._deadletter_stream: ">"},
+            count=num_messages,
+            block=500,
+        )
+        return [message for entries in (stream_entries or {}).values() for msgs in entries for message in msgs]
+
+    def _decode_dead_letter(self, queue_message) -> Tuple[str, Union[str, bytes], dict]:
+        message_id, payload = queue_message
+        message_payload, attributes = self._payload_and_attributes(payload)
+        return message_id.decode(), message_payload, attributes
+
+    def _requeue_dead_letter(self, queue_messages: list) -> int:
         with self._r.pipeline() as pipeline:
             message_ids = []
-            for message in messages:
+            for message in queue_messages:
                 message_ids.append(message[0])
                 pipeline.xadd(self._main_stream, message[1])
             pipeline.xack(self._deadletter_stream, self._group, *message_ids)
             pipeline.execute()
+        return len(queue_messages)
 
+    @staticmethod
     def _process_raw_messages(
-        self, stream: bytes, messages: list[tuple[bytes, dict[bytes, bytes]]]
+        stream: bytes, messages: list[tuple[bytes, dict[bytes, bytes]]]
     ) -> Generator[RedisMessage, None, None]:
-        for message in messages:
-            message_id, message_payload = message
-            # manual tracking of delivery attempts
-            metadata = self._r.xpending_range(stream, self._group, message_id, message_id, 1)[0]
-            if metadata["times_delivered"] > settings.HEDWIG_MAX_DELIVERY_ATTEMPTS:
-                with self._r.pipeline() as pipeline:
-                    pipeline.xadd(self._deadletter_stream, message_payload)
-                    pipeline.xack(stream, self._group, message_id)
-                    pipeline.execute()
-                continue
-            yield RedisMessage(
-                stream=stream,
-                key=message_id,
-                payload=message_payload,
-                delivery_attempt=metadata["times_delivered"],
+        for message_id, message_payload in messages:
+            # messages read with ">" have never been delivered before
+            yield RedisMessage(stream=stream, key=message_id, payload=message_payload, delivery_attempt=1)
+
+    def _call_per_slot(self, fn: Callable[[List[str]], list], streams: List[str]) -> list:
+        """
+        Calls ``fn`` with streams grouped by slot, since a multi-key command can't span multiple slots in a Redis
+        Cluster, and returns the concatenated results. Groups are called concurrently. For a standalone Redis, ``fn``
+        is called once with all the streams.
+        """
+        if self._executor is None:
+            return fn(streams)
+        slots: Dict[int, List[str]] = {}
+        for stream in streams:
+            slots.setdefault(self._r.keyslot(stream), []).append(stream)
+        return [result for results in self._executor.map(fn, slots.values()) for result in results]
+
+    def _claim(self, num_messages: int, streams: List[str]) -> list:
+        keys = list(streams)
+        # dead-letter within the script only if the dead-letter stream lives in the same slot
+        if self._executor is None or self._r.keyslot(self._deadletter_stream) == self._r.keyslot(streams[0]):
+            keys.append(self._deadletter_stream)
+        result = self._claim_script(
+            keys=keys,
+            args=[
+                self._group,
+                self._consumer_id,
+                int(settings.HEDWIG_VISIBILITY_TIMEOUT_S * 1000),
+                num_messages,
+                settings.HEDWIG_MAX_DELIVERY_ATTEMPTS,
+                *(self._reclaim_cursors[stream] for stream in streams),
+            ],
+        )
+        return list(zip(streams, result))
+
+    def _dead_letter(self, stream: str, entries: List[Tuple[bytes, List[bytes]]]) -> None:
+        with self._r.pipeline() as pipeline:
+            for _, fields in entries:
+                pipeline.xadd(self._deadletter_stream, _fields_to_dict(fields))
+            pipeline.xack(stream, self._group, *(message_id for message_id, _ in entries))
+            pipeline.execute()
+
+    def _remove_idle_consumers(self) -> None:
+        """
+        Removes consumers that have been idle for longer than ``HEDWIG_REDIS_CONSUMER_IDLE_TIMEOUT_S``, such as
+        consumers of processes that no longer exist, so that consumer group metadata and pending entries lists don't
+        keep growing. Their pending entries are taken over by this consumer.
+        """
+        if not self._consumer_idle_timeout_timedelta:
+            return
+        now = datetime.utcnow()
+        if self._remove_idle_consumers_called_at + self._consumer_idle_timeout_timedelta > now:
+            return
+        self._remove_idle_consumers_called_at = now
+        for stream in self._streams:
+            removed = self._remove_idle_consumers_script(
+                keys=[stream],
+                args=[
+                    self._group,
+                    self._consumer_id,
+                    int(settings.HEDWIG_REDIS_CONSUMER_IDLE_TIMEOUT_S * 1000),
+                ],
+            )
+            if removed:
+                log(__name__, logging.INFO, f"Removed {removed} idle consumers", extra={'stream': stream})
+
+    def _reclaim_timed_out_messages(self, num_messages: int) -> Generator[RedisMessage, None, None]:
+        """
+        Claims messages whose visibility timeout expired. Since a message can't time out sooner than visibility timeout,
+        pending entries lists are fully scanned at most once per visibility timeout interval. Scans resume from the
+        cursor returned by the previous XAUTOCLAIM call, so a long pending entries list is walked across multiple pulls
+        instead of being re-scanned from the start every time.
+        """
+        now = datetime.utcnow()
+        if self._reclaim_called_at + self._reclaim_interval_timedelta < now:
+            self._reclaim_called_at = now
+            streams = list(self._reclaim_cursors)
+        else:
+            # only resume scans that didn't reach the end of pending entries list in the previous run
+            streams = [stream for stream, cursor in self._reclaim_cursors.items() if cursor != b"0-0"]
+        if not streams:
+            return
+        for stream, (next_id, stream_entries, deadletter_entries) in self._call_per_slot(
+            partial(self._claim, num_messages), streams
+        ):
+            self._reclaim_cursors[stream] = next_id
+            if deadletter_entries:
+                self._dead_letter(stream, deadletter_entries)
+            for message_id, fields, delivery_attempt in stream_entries:
+                yield RedisMessage(
+                    stream=stream.encode(),
+                    key=message_id,
+                    payload=_fields_to_dict(fields),
+                    delivery_attempt=delivery_attempt,
+                )
+
+    def _read(self, num_messages: int, streams: List[str]) -> list:
+        # NOACK applies to the whole command, so at-most-once streams are read separately. Only the last read blocks,
+        # and only if nothing was read so far.
+        noack_streams = [x for x in streams if x in self._noack_streams]
+        ack_streams = [x for x in streams if x not in self._noack_streams]
+        reads = [(noack, x) for noack, x in ((True, noack_streams), (False, ack_streams)) if x]
+        result: list = []
+        for i, (noack, read_streams) in enumerate(reads):
+            entries: dict[bytes, list[list[tuple[bytes, dict[bytes, bytes]]]]] = self._r.xreadgroup(
+                groupname=self._group,
+                consumername=self._consumer_id,
+                streams={x: ">" for x in read_streams},
+                count=num_messages,
+                block=500 if i == len(reads) - 1 and not result else None,
+                noack=noack,
             )
+            if entries:
+                result.extend(entries.items())
+        return result
 
     def pull_messages(  # type: ignore[return]
         self,
@@ -193,41 +608,31 @@ class RedisStreamsConsumerBackend(HedwigConsumerBaseBackend):
     ) -> Union[Generator, List]:
         assert not visibility_timeout, "Visibility timeout is not configurable"
         try:
-            # claim timed out messages
-            for stream in self._streams:
-                stream_entries = self._r.xautoclaim(
-                    name=stream,
-                    groupname=self._group,
-                    consumername=self._consumer_id,
-                    min_idle_time=int(settings.HEDWIG_VISIBILITY_TIMEOUT_S * 1000),
-                    start_id="0-0",
-                    count=num_messages,
-                )[1]
-                yield from self._process_raw_messages(stream.encode(), stream_entries)
-            entries: dict[bytes, list[list[tuple[bytes, dict[bytes, bytes]]]]] = self._r.xreadgroup(
-                groupname=self._group,
-                consumername=self._consumer_id,
-                streams={x: ">" for x in self._streams},
-                count=num_messages,
-                block=500,
-            )
+            self._remove_idle_consumers()
+            yield from self._reclaim_timed_out_messages(num_messages)
+            entries = self._call_per_slot(partial(self._read, num_messages), self._streams)
             if not entries:
                 return []
-            for stream_, stream_entries in entries.items():
+            for stream_, stream_entries in entries:
                 for messages in stream_entries:
                     yield from self._process_raw_messages(stream_, messages)
         finally:
             self._perform_error_counter_inactivity_reset()
             self._call_heartbeat_hook()
 
+    @staticmethod
+    def _payload_and_attributes(payload: Dict[bytes, bytes]) -> Tuple[Union[str, bytes], dict]:
+        fields = {k.decode(): v.decode() for k, v in payload.items()}
+        # body is always UTF-8 string
+        message_payload: Union[str, bytes] = fields.pop("hedwig_payload")
+        if fields.pop("hedwig_encoding", None) == "base64":
+            message_payload = base64.decodebytes(cast(str, message_payload).encode())
+        return message_payload, fields
+
     def process_message(self, queue_message: RedisMessage) -> None:
         stream = queue_message.stream.decode()
         message_id = queue_message.key.decode()
-        fields = self.message_attributes(queue_message)
-        # body is always UTF-8 string
-        message_payload = fields.pop("hedwig_payload")
-        if fields.pop("hedwig_encoding", None) == "base64":
-            message_payload = base64.decodebytes(message_payload.encode())
+        message_payload, fields = self._payload_and_attributes(queue_message.payload)
         self.message_handler(
             message_payload,
             fields,
@@ -235,8 +640,93 @@ class RedisStreamsConsumerBackend(HedwigConsumerBaseBackend):
         )
 
     def ack_message(self, queue_message: RedisMessage) -> None:
+        if queue_message.stream.decode() in self._noack_streams:
+            return
         self._r.xack(queue_message.stream, self._group, queue_message.key)
 
+    def _extend_lease_for_wait(self, provider_metadata: RedisMetadata, wait_s: float) -> bool:
+        if provider_metadata.stream in self._noack_streams:
+            return True
+        # the lease can only be renewed to the visibility timeout, so leave at least half of it to the callback
+        if wait_s > settings.HEDWIG_VISIBILITY_TIMEOUT_S / 2:
+            return False
+        self.extend_visibility_timeout(settings.HEDWIG_VISIBILITY_TIMEOUT_S, provider_metadata)
+        return True
+
+    def _extend_queued_message_lease(self, queue_message: RedisMessage) -> Optional[float]:
+        if queue_message.stream.decode() in self._noack_streams:
+            return None
+        # reset idle time to 0, so the message isn't reclaimed while it waits
+        self._r.xclaim(
+            name=queue_message.stream,
+            groupname=self._group,
+            consumername=self._consumer_id,
+            min_idle_time=0,
+            message_ids=[queue_message.key],
+            justid=True,
+        )
+        return settings.HEDWIG_VISIBILITY_TIMEOUT_S
+
+    def _quarantine_message(self, queue_message: RedisMessage, error: str) -> None:
+        self._r.xadd(self._deadletter_stream, {**queue_message.payload, b"hedwig_error": error})
+
     def nack_message(self, queue_message: RedisMessage) -> None:
-        # let visibility timeout take care of it
-        pass
+        stream = queue_message.stream.decode()
+        delay_s = None if stream in self._noack_streams else self._retry_delay_s(queue_message.delivery_attempt)
+        if delay_s is None:
+            # let visibility timeout take care of it
+            return
+        visibility_timeout_ms = int(settings.HEDWIG_VISIBILITY_TIMEOUT_S * 1000)
+        delay_ms = min(int(delay_s * 1000), visibility_timeout_ms)
+        # messages are reclaimed once idle for visibility timeout, so set idle time such that it's reached after delay
+        self._r.xclaim(
+            name=stream,
+            groupname=self._group,
+            consumername=self._consumer_id,
+            min_idle_time=0,
+            message_ids=[queue_message.key],
+            idle=visibility_timeout_ms - delay_ms,
+            justid=True,
+        )
+        # make sure pending entries are scanned once the delay expires
+        self._reclaim_called_at = min(
+            self._reclaim_called_at,
+            datetime.utcnow() + timedelta(milliseconds=delay_ms) - self._reclaim_interval_timedelta,
+        )
+
+
+class RedisTokenBucket(TokenBucket):
+    """
+    Token bucket for a rate limit, shared by all consumers of the app's queue through Redis.
+    """
+
+    def __init__(self, name: str, rate_limit: RateLimit) -> None:
+        super().__init__(name, rate_limit)
+        self._r = _client()
+        self._key = _queue_key(f"ratelimit:{name}")
+        self._script = self._r.register_script(_RATE_LIMIT_SCRIPT)
+
+    def reserve(self, max_wait_s: float) -> Tuple[bool, float]:
+        reserved, wait_s = self._script(
+            keys=[self._key], args=[self._rate_limit.rate, self._rate_limit.burst, max_wait_s]
+        )
+        return bool(reserved), float(wait_s)
+
+    def refund(self) -> None:
+        self._r.hincrbyfloat(self._key, "tokens", 1)
+
+
+class RedisDedupStore(DedupStore):
+    """
+    Store shared by all consumers of the app's queue through Redis.
+    """
+
+    def __init__(self) -> None:
+        self._r = _client()
+        self._prefix = _queue_key("dedup:")
+
+    def seen(self, message_id: str) -> bool:
+        return bool(self._r.exists(self._prefix + message_id))
+
+    def record(self, message_id: str, ttl_s: int) -> None:
+        self._r.set(self._prefix + message_id, 1, nx=True, ex=ttl_s)
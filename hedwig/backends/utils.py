@@ -1,9 +1,15 @@
+import atexit
+import logging
 import os
+import threading
+import time
+import weakref
 from contextlib import contextmanager
 from functools import lru_cache
-from typing import Any, Generator
+from typing import Any, Callable, Generator, List, Tuple
 
 from hedwig.conf import settings
+from hedwig.utils import log
 
 
 @contextmanager
@@ -34,3 +40,65 @@ def get_publisher_backend(*args, **kwargs):
 @lru_cache(maxsize=3)
 def get_consumer_backend(*args, **kwargs):
     return settings.HEDWIG_CONSUMER_BACKEND(*args, **kwargs)
+
+
+def _reset_backends_after_fork() -> None:
+    # backend clients hold sockets and gRPC channels that must not be shared with the parent process
+    get_publisher_backend.cache_clear()
+    get_consumer_backend.cache_clear()
+
+
+if hasattr(os, 'register_at_fork'):  # pragma: no branch
+    os.register_at_fork(after_in_child=_reset_backends_after_fork)
+
+
+# flush methods of objects that buffer messages, with their stage. Held weakly, so that registering doesn't keep the
+# objects alive
+_flush_methods: List[Tuple[int, weakref.WeakMethod]] = []
+_flush_methods_lock = threading.Lock()
+
+
+def flush_on_exit_and_fork(flush: Callable[[float], Any], stage: int = 0) -> None:
+    """
+    Calls a flush method on interpreter exit, and before the process forks so that buffered messages aren't published
+    again by the child process. Flush methods are called in increasing order of stage, so objects that publish through
+    another registered object must use a lower stage than it.
+
+    :param flush: Bound method, called with the number of seconds it may wait for messages to finish publishing. The
+        object is only referenced weakly
+    :param stage: Order of flushing
+    """
+    with _flush_methods_lock:
+        _flush_methods[:] = [(s, ref) for s, ref in _flush_methods if ref() is not None]
+        _flush_methods.append((stage, weakref.WeakMethod(flush)))
+
+
+def _flush_all(timeout_s: float) -> None:
+    # the timeout is shared by all flush methods
+    deadline = time.monotonic() + timeout_s
+    with _flush_methods_lock:
+        flush_methods = sorted(_flush_methods, key=lambda x: x[0])
+    for _, ref in flush_methods:
+        flush = ref()
+        if flush is None:
+            continue
+        try:
+            flush(max(deadline - time.monotonic(), 0))
+        except Exception:
+            log(__name__, logging.ERROR, 'Failed to flush buffered messages', exc_info=True)
+    if flush_methods and time.monotonic() >= deadline:
+        log(__name__, logging.WARNING, 'Timed out flushing buffered messages', extra={'timeout_s': timeout_s})
+
+
+def _flush_on_exit() -> None:
+    _flush_all(settings.HEDWIG_PUBLISHER_EXIT_TIMEOUT_S)
+
+
+def _flush_before_fork() -> None:
+    # blocks the forking thread, so this is much shorter than the exit timeout
+    _flush_all(settings.HEDWIG_PUBLISHER_FORK_TIMEOUT_S)
+
+
+atexit.register(_flush_on_exit)
+if hasattr(os, 'register_at_fork'):  # pragma: no branch
+    os.register_at_fork(before=_flush_before_fork)
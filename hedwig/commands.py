@@ -1,5 +1,17 @@
+import dataclasses
+import logging
+import time
+from datetime import datetime, timezone
+from fnmatch import fnmatch
+from typing import Callable, Collection, Dict, Optional, Set
+
 from hedwig.backends.utils import get_consumer_backend
-from typing import Optional
+from hedwig.exceptions import ValidationError
+from hedwig.models import Message
+from hedwig.utils import log
+
+_MAX_SEEN_MESSAGES = 100_000
+"""Maximum number of message ids remembered by a replay, for backends that pull skipped messages again"""
 
 
 def requeue_dead_letter(num_messages: int = 10, visibility_timeout: Optional[int] = None) -> None:
@@ -12,3 +24,159 @@ def requeue_dead_letter(num_messages: int = 10, visibility_timeout: Optional[int
     """
     consumer_backend = get_consumer_backend(dlq=True)
     consumer_backend.requeue_dead_letter(num_messages, visibility_timeout)
+
+
+@dataclasses.dataclass(frozen=True)
+class ReplayFilter:
+    """
+    Selects messages to replay from the Hedwig DLQ. A message is selected only if it matches all the criteria that are
+    set.
+    """
+
+    message_types: Optional[Collection[str]] = None
+    """Message types"""
+
+    versions: Optional[Collection[str]] = None
+    """Version patterns, e.g. ``1.*`` or ``1.2``"""
+
+    publishers: Optional[Collection[str]] = None
+    """Publisher names"""
+
+    headers: Optional[Dict[str, str]] = None
+    """Headers the message must have, with the same values"""
+
+    published_after: Optional[datetime] = None
+    """Only messages published at or after this time. Naive datetimes are treated as UTC"""
+
+    published_before: Optional[datetime] = None
+    """Only messages published before this time. Naive datetimes are treated as UTC"""
+
+    @property
+    def is_empty(self) -> bool:
+        return all(getattr(self, field.name) is None for field in dataclasses.fields(self))
+
+    def matches(self, message: Message) -> bool:
+        if self.message_types is not None and message.type not in self.message_types:
+            return False
+        if self.versions is not None and not any(fnmatch(str(message.version), x) for x in self.versions):
+            return False
+        if self.publishers is not None and message.publisher not in self.publishers:
+            return False
+        if self.headers is not None and any(message.headers.get(k) != v for k, v in self.headers.items()):
+            return False
+        published_at = datetime.fromtimestamp(message.timestamp / 1000, tz=timezone.utc)
+        if self.published_after is not None and published_at < _as_utc(self.published_after):
+            return False
+        if self.published_before is not None and published_at >= _as_utc(self.published_before):
+            return False
+        return True
+
+
+@dataclasses.dataclass
+class ReplayStats:
+    """
+    Progress of a DLQ replay.
+    """
+
+    pulled: int = 0
+    """Number of messages pulled from the DLQ"""
+
+    matched: int = 0
+    """Number of messages that matched the filter"""
+
+    replayed: int = 0
+    """Number of messages re-queued. Always 0 for a dry run"""
+
+    invalid: int = 0
+    """Number of messages that couldn't be decoded to apply the filter. These are left in the DLQ"""
+
+
+def replay_dead_letter(
+    replay_filter: Optional[ReplayFilter] = None,
+    rate_limit: Optional[float] = None,
+    dry_run: bool = False,
+    progress_callback: Optional[Callable[[ReplayStats], None]] = None,
+    num_messages: int = 10,
+    visibility_timeout: Optional[int] = None,
+) -> ReplayStats:
+    """
+    Re-queues messages from the Hedwig DLQ back into the Hedwig queue, optionally only the ones matching a filter, and
+    at a limited rate. Messages that don't match the filter are left in the DLQ.
+
+    Messages that aren't re-queued remain invisible to other DLQ readers until their visibility timeout expires, and
+    the replay stops once it only pulls messages it has already seen, so ``visibility_timeout`` should be long enough
+    for the whole replay when filtering or for a dry run. Since the seen messages are remembered in memory, a replay
+    stops after pulling 100,000 messages on backends that may pull a skipped message again (AWS and Google); run it
+    again to continue. Redis replays walk the DLQ with a cursor instead, and aren't limited.
+
+    :param replay_filter: Selects the messages to re-queue. Defaults to None, which re-queues all messages.
+    :param rate_limit: Maximum number of messages re-queued per second. Messages are re-queued in batches of up to
+        ``num_messages``, or ``rate_limit`` if lower. The wait happens before pulling, so pulled messages don't
+        outlast their visibility timeout. Defaults to None, which is unlimited.
+    :param dry_run: If set, messages are only counted, and nothing is re-queued.
+    :param progress_callback: Called with the stats so far after every batch.
+    :param num_messages: Maximum number of messages to fetch in one call. Defaults to 10.
+    :param visibility_timeout: The number of seconds the message should remain invisible to other queue readers.
+        Defaults to None, which is queue default
+    :return: the final stats
+    """
+    consumer_backend = get_consumer_backend(dlq=True)
+    stats = ReplayStats()
+    seen: Set[str] = set()
+    started_at = time.monotonic()
+    if rate_limit:
+        num_messages = max(1, min(num_messages, int(rate_limit)))
+
+    consumer_backend._reset_dead_letter_pull()
+    while True:
+        if rate_limit and not dry_run:
+            # pace before pulling so that the total number of messages re-queued doesn't exceed rate limit, and the
+            # pulled messages are re-queued well within their visibility timeout
+            wait_s = started_at + (stats.replayed + num_messages) / rate_limit - time.monotonic()
+            if wait_s > 0:
+                time.sleep(wait_s)
+        queue_messages = consumer_backend._pull_dead_letter(num_messages, visibility_timeout)
+        selected = []
+        new = False
+        for queue_message in queue_messages:
+            message_id, message_payload, attributes = consumer_backend._decode_dead_letter(queue_message)
+            if consumer_backend._dead_letter_pull_repeats:
+                if message_id in seen:
+                    continue
+                seen.add(message_id)
+            new = True
+            stats.pulled += 1
+            if replay_filter is not None and not replay_filter.is_empty:
+                try:
+                    message = Message.deserialize(message_payload, attributes, None)
+                except ValidationError:
+                    stats.invalid += 1
+                    continue
+                if not replay_filter.matches(message):
+                    continue
+            stats.matched += 1
+            selected.append(queue_message)
+
+        if not new:
+            break
+
+        if selected and not dry_run:
+            stats.replayed += consumer_backend._requeue_dead_letter(selected)
+
+        log(__name__, logging.INFO, "Replayed {} of {} messages".format(stats.replayed, stats.pulled))
+        if progress_callback:
+            progress_callback(dataclasses.replace(stats))
+
+        if len(seen) >= _MAX_SEEN_MESSAGES:
+            log(
+                __name__,
+                logging.WARNING,
+                "Stopping replay after pulling {} messages, run it again to continue".format(len(seen)),
+            )
+            break
+
+    return stats
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
@@ -30,27 +30,73 @@ _DEFAULTS: dict = {
     'AWS_CONNECT_TIMEOUT_S': 2,
     'AWS_ENDPOINT_SNS': None,
     'AWS_ENDPOINT_SQS': None,
+    'AWS_MAX_POOL_CONNECTIONS': 10,
     'AWS_READ_TIMEOUT_S': 2,
+    'AWS_RETRY_MAX_ATTEMPTS': None,
+    'AWS_RETRY_MODE': None,
     'AWS_SECRET_KEY': None,
     'AWS_SESSION_TOKEN': None,
+    'AWS_TCP_KEEPALIVE': False,
+    'AWS_THREAD_LOCAL_CLIENTS': False,
+    'AWS_WARMUP_CLIENTS': False,
     'GOOGLE_APPLICATION_CREDENTIALS': None,
     'GOOGLE_CLOUD_PROJECT': None,
+    'GOOGLE_PUBSUB_GRPC_COMPRESSION': None,
+    'GOOGLE_PUBSUB_GRPC_OPTIONS': (),
     'GOOGLE_PUBSUB_READ_TIMEOUT_S': 5,
+    'GOOGLE_PUBSUB_REQUEUE_CONCURRENCY': 1,
+    'GOOGLE_PUBSUB_SHARED_CHANNEL': False,
+    'REDIS_CLUSTER': False,
     'REDIS_URL': None,
+    'HEDWIG_BULKHEADS': {},
     'HEDWIG_CALLBACKS': {},
     'HEDWIG_CONSUMER_BACKEND': None,
     'HEDWIG_DATA_VALIDATOR_CLASS': 'hedwig.validators.jsonschema.JSONSchemaValidator',
+    'HEDWIG_DEDUP_MAX_SIZE': 100000,
+    'HEDWIG_DEDUP_SQLITE_PATH': ':memory:',
+    'HEDWIG_DEDUP_STORE_CLASS': None,
+    'HEDWIG_DEDUP_TTL_S': 86400,
     'HEDWIG_DEFAULT_HEADERS': 'hedwig.conf.default_headers_hook',
+    'HEDWIG_DEFAULT_MESSAGE_TTL_S': None,
+    'HEDWIG_DEFAULT_RETRY_BACKOFF': None,
+    'HEDWIG_GLOBAL_RATE_LIMIT': None,
     'HEDWIG_HEARTBEAT_INACTIVITY_RESET_S': None,
     'HEDWIG_HEARTBEAT_INTERVAL_S': 15,
     'HEDWIG_HEARTBEAT_HOOK': 'hedwig.conf.noop_hook',
+    'HEDWIG_LOAD_SHEDDING': None,
     'HEDWIG_MESSAGE_ROUTING': {},
+    'HEDWIG_MESSAGE_TTL_S': {},
+    'HEDWIG_OUTBOX_BATCH_SIZE': 100,
+    'HEDWIG_OUTBOX_LEASE_S': 60,
+    'HEDWIG_OUTBOX_POLL_INTERVAL_S': 1.0,
+    'HEDWIG_OUTBOX_PUBLISHER_BACKEND': None,
+    'HEDWIG_OUTBOX_RELAY': True,
+    'HEDWIG_OUTBOX_RETRY_BACKOFF': None,
+    'HEDWIG_OUTBOX_SQLITE_PATH': 'hedwig-outbox.sqlite3',
+    'HEDWIG_OUTBOX_STORE_CLASS': 'hedwig.outbox.SQLiteOutboxStore',
+    'HEDWIG_PRE_FILTER': None,
     'HEDWIG_PRE_PROCESS_HOOK': 'hedwig.conf.noop_hook',
     'HEDWIG_POST_PROCESS_HOOK': 'hedwig.conf.noop_hook',
     'HEDWIG_PUBLISHER': None,
     'HEDWIG_PUBLISHER_BACKEND': None,
+    'HEDWIG_PUBLISHER_COALESCING_WINDOW_S': 0.05,
+    'HEDWIG_PUBLISHER_EXIT_TIMEOUT_S': 30,
+    'HEDWIG_PUBLISHER_FORK_TIMEOUT_S': 1,
     'HEDWIG_PUBLISHER_GCP_BATCH_SETTINGS': (),
+    'HEDWIG_PUBLISHER_GCP_IN_FLIGHT_LIMITS': (),
+    'HEDWIG_PUBLISHER_GCP_PUBLISHER_OPTIONS': (),
+    'HEDWIG_PUBLISHER_REDIS_BATCH_SETTINGS': (),
+    'HEDWIG_QUARANTINE_INVALID_MESSAGES': False,
     'HEDWIG_QUEUE': None,
+    'HEDWIG_RATE_LIMIT_BUCKET_CLASS': 'hedwig.backends.base.TokenBucket',
+    'HEDWIG_RATE_LIMITS': {},
+    'HEDWIG_REDIS_AT_MOST_ONCE_SUBSCRIPTIONS': [],
+    'HEDWIG_REDIS_CONSUMER_IDLE_TIMEOUT_S': None,
+    'HEDWIG_REDIS_CONSUMER_NAME': None,
+    'HEDWIG_REDIS_PARTITION_ASSIGNMENT': None,
+    'HEDWIG_REDIS_PARTITION_KEY_HEADER': None,
+    'HEDWIG_REDIS_STREAM_PARTITIONS': {},
+    'HEDWIG_RETRY_BACKOFF': {},
     'HEDWIG_JSONSCHEMA_FILE': None,
     'HEDWIG_MAX_DELIVERY_ATTEMPTS': None,
     'HEDWIG_PROTOBUF_MESSAGES': None,
@@ -58,6 +104,7 @@ _DEFAULTS: dict = {
     'HEDWIG_SUBSCRIPTIONS': [],
     'HEDWIG_VISIBILITY_TIMEOUT_S': None,
     'HEDWIG_USE_TRANSPORT_MESSAGE_ATTRIBUTES': True,
+    'HEDWIG_WORKER_INDEX': 0,
 }
 
 
@@ -65,11 +112,16 @@ _DEFAULTS: dict = {
 _IMPORT_STRINGS = (
     'HEDWIG_CONSUMER_BACKEND',
     'HEDWIG_DATA_VALIDATOR_CLASS',
+    'HEDWIG_DEDUP_STORE_CLASS',
     'HEDWIG_DEFAULT_HEADERS',
     'HEDWIG_HEARTBEAT_HOOK',
+    'HEDWIG_OUTBOX_PUBLISHER_BACKEND',
+    'HEDWIG_OUTBOX_STORE_CLASS',
+    'HEDWIG_PRE_FILTER',
     'HEDWIG_PRE_PROCESS_HOOK',
     'HEDWIG_POST_PROCESS_HOOK',
     'HEDWIG_PUBLISHER_BACKEND',
+    'HEDWIG_RATE_LIMIT_BUCKET_CLASS',
 )
 
 # List of settings that will be dicts with values as string import notation.
@@ -187,7 +239,7 @@ class _LazySettings:
             val = self._defaults[attr]
 
         # Coerce import strings into classes
-        if attr in self._import_strings:
+        if attr in self._import_strings and val is not None:
             val = self._import_string(val)
 
         if attr in self._import_dict_values:
@@ -0,0 +1,83 @@
+import abc
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from hedwig.conf import settings
+
+
+class DedupStore(abc.ABC):
+    """
+    Store of ids of messages that were processed successfully, used to skip redelivered messages.
+    """
+
+    @abc.abstractmethod
+    def seen(self, message_id: str) -> bool:
+        """
+        Checks if a message with this id was recorded, and hasn't expired yet.
+        """
+
+    @abc.abstractmethod
+    def record(self, message_id: str, ttl_s: int) -> None:
+        """
+        Records that a message with this id was processed, for ``ttl_s`` seconds.
+        """
+
+
+class InMemoryDedupStore(DedupStore):
+    """
+    LRU store local to the consumer process, that holds up to ``HEDWIG_DEDUP_MAX_SIZE`` message ids.
+    """
+
+    def __init__(self) -> None:
+        self._max_size = settings.HEDWIG_DEDUP_MAX_SIZE
+        # message id to expiry time, in order of recording
+        self._expires_at: 'OrderedDict[str, float]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, message_id: str) -> bool:
+        with self._lock:
+            expires_at = self._expires_at.get(message_id)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._expires_at[message_id]
+                return False
+            return True
+
+    def record(self, message_id: str, ttl_s: int) -> None:
+        with self._lock:
+            self._expires_at[message_id] = time.monotonic() + ttl_s
+            self._expires_at.move_to_end(message_id)
+            while len(self._expires_at) > self._max_size:
+                self._expires_at.popitem(last=False)
+
+
+class SQLiteDedupStore(DedupStore):
+    """
+    Store in the SQLite database at ``HEDWIG_DEDUP_SQLITE_PATH``, useful for tests and single host deployments.
+    """
+
+    def __init__(self) -> None:
+        self._conn = sqlite3.connect(settings.HEDWIG_DEDUP_SQLITE_PATH, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS hedwig_dedup (message_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)'
+            )
+
+    def seen(self, message_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM hedwig_dedup WHERE message_id = ? AND expires_at > ?', (message_id, time.time())
+            ).fetchone()
+        return row is not None
+
+    def record(self, message_id: str, ttl_s: int) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM hedwig_dedup WHERE expires_at <= ?', (now,))
+            self._conn.execute(
+                'INSERT OR REPLACE INTO hedwig_dedup (message_id, expires_at) VALUES (?, ?)', (message_id, now + ttl_s)
+            )
@@ -0,0 +1,325 @@
+import abc
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, NamedTuple, Optional, Union
+
+from hedwig.backends.base import HedwigPublisherBaseBackend, RetryBackoff
+from hedwig.conf import settings
+from hedwig.exceptions import ValidationError
+from hedwig.models import Message
+from hedwig.utils import log
+
+# backoff for messages that failed to publish, if HEDWIG_OUTBOX_RETRY_BACKOFF isn't set
+_DEFAULT_RETRY_BACKOFF = RetryBackoff(initial_s=1, max_s=300)
+
+# delay before messages that can never be published are claimed again, by stores that can't set them aside
+_FAILED_RETRY_DELAY_S = 86400
+
+
+class OutboxEntry(NamedTuple):
+    """
+    A message waiting in the outbox
+    """
+
+    id: int
+    """Id of the entry in the store"""
+
+    payload: Union[str, bytes]
+    """Serialized message payload"""
+
+    attributes: Dict[str, str]
+    """Serialized message attributes"""
+
+    attempts: int
+    """Number of failed attempts to publish"""
+
+
+class OutboxStore(abc.ABC):
+    """
+    Durable store of serialized messages waiting to be published. Implement this to store messages in the
+    application's database, so that they're written in the same transaction as application data.
+    """
+
+    @abc.abstractmethod
+    def add(self, payload: Union[str, bytes], attributes: Dict[str, str]) -> None:
+        """
+        Adds a message to the outbox.
+        """
+
+    @abc.abstractmethod
+    def claim(self, limit: int, lease_s: float) -> List[OutboxEntry]:
+        """
+        Returns up to ``limit`` messages that are due for publishing, oldest first, and hides them from other relays
+        for ``lease_s`` seconds.
+        """
+
+    @abc.abstractmethod
+    def remove(self, entry_ids: List[int]) -> None:
+        """
+        Removes published messages from the outbox.
+        """
+
+    @abc.abstractmethod
+    def retry(self, entry_id: int, delay_s: float) -> None:
+        """
+        Counts a failed attempt to publish a message, and makes it due again after ``delay_s`` seconds.
+        """
+
+    def fail(self, entry_id: int) -> None:
+        """
+        Sets aside a message that can never be published, such as one that can't be deserialized, so that it's kept for
+        inspection but not claimed again. Defaults to retrying it after a day.
+        """
+        self.retry(entry_id, _FAILED_RETRY_DELAY_S)
+
+
+class SQLiteOutboxStore(OutboxStore):
+    """
+    Store in the SQLite database at ``HEDWIG_OUTBOX_SQLITE_PATH``, using write-ahead logging so that adding a message
+    is cheap and doesn't block relays. The database may be shared by processes on the same host. Messages that can
+    never be published are moved to the ``hedwig_outbox_failed`` table.
+    """
+
+    def __init__(self) -> None:
+        # autocommit, transactions are started explicitly
+        self._conn = sqlite3.connect(settings.HEDWIG_OUTBOX_SQLITE_PATH, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS hedwig_outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, payload BLOB NOT NULL, '
+                'attributes TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS hedwig_outbox_available_at ON hedwig_outbox (available_at)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS hedwig_outbox_failed (id INTEGER PRIMARY KEY, payload BLOB NOT NULL, '
+                'attributes TEXT NOT NULL, attempts INTEGER NOT NULL, failed_at REAL NOT NULL)'
+            )
+
+    def add(self, payload: Union[str, bytes], attributes: Dict[str, str]) -> None:
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO hedwig_outbox (payload, attributes, available_at) VALUES (?, ?, ?)',
+                (payload, json.dumps(attributes), time.time()),
+            )
+
+    def claim(self, limit: int, lease_s: float) -> List[OutboxEntry]:
+        now = time.time()
+        with self._lock:
+            # lock the database up front, so that concurrent relays don't claim the same messages
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    'SELECT id, payload, attributes, attempts FROM hedwig_outbox WHERE available_at <= ? '
+                    'ORDER BY id LIMIT ?',
+                    (now, limit),
+                ).fetchall()
+                self._conn.executemany(
+                    'UPDATE hedwig_outbox SET available_at = ? WHERE id = ?', [(now + lease_s, row[0]) for row in rows]
+                )
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+        return [OutboxEntry(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def remove(self, entry_ids: List[int]) -> None:
+        with self._lock:
+            self._conn.executemany('DELETE FROM hedwig_outbox WHERE id = ?', [(entry_id,) for entry_id in entry_ids])
+
+    def retry(self, entry_id: int, delay_s: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                'UPDATE hedwig_outbox SET attempts = attempts + 1, available_at = ? WHERE id = ?',
+                (time.time() + delay_s, entry_id),
+            )
+
+    def fail(self, entry_id: int) -> None:
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute(
+                    'INSERT INTO hedwig_outbox_failed (id, payload, attributes, attempts, failed_at) '
+                    'SELECT id, payload, attributes, attempts, ? FROM hedwig_outbox WHERE id = ?',
+                    (time.time(), entry_id),
+                )
+                self._conn.execute('DELETE FROM hedwig_outbox WHERE id = ?', (entry_id,))
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+
+class OutboxRelay:
+    """
+    Publishes messages from the outbox using ``HEDWIG_OUTBOX_PUBLISHER_BACKEND``, in batches of
+    ``HEDWIG_OUTBOX_BATCH_SIZE``. Messages are removed from the outbox only once published, so a message may be
+    published more than once if the relay dies midway. Messages that fail to publish are retried with
+    ``HEDWIG_OUTBOX_RETRY_BACKOFF``, and messages that can't be deserialized are set aside with
+    :meth:`OutboxStore.fail`.
+    """
+
+    def __init__(
+        self, store: Optional[OutboxStore] = None, backend: Optional[HedwigPublisherBaseBackend] = None
+    ) -> None:
+        """
+        :param store: Outbox store, defaults to a new ``HEDWIG_OUTBOX_STORE_CLASS``
+        :param backend: Publisher backend, defaults to a new ``HEDWIG_OUTBOX_PUBLISHER_BACKEND``
+        """
+        self._store = store or settings.HEDWIG_OUTBOX_STORE_CLASS()
+        self._backend = backend or settings.HEDWIG_OUTBOX_PUBLISHER_BACKEND()
+        self._wake = threading.Event()
+        self._shutdown = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def backend(self) -> HedwigPublisherBaseBackend:
+        return self._backend
+
+    def relay_once(self) -> int:
+        """
+        Publishes one batch of messages that are due.
+
+        :returns: number of messages claimed from the outbox
+        """
+        entries = self._store.claim(settings.HEDWIG_OUTBOX_BATCH_SIZE, settings.HEDWIG_OUTBOX_LEASE_S)
+        done: List[int] = []
+        results = []
+        for entry in entries:
+            try:
+                message = Message.deserialize(entry.payload, entry.attributes, None)
+            except ValidationError:
+                # will never succeed
+                log(
+                    __name__,
+                    logging.ERROR,
+                    'Set aside invalid message in outbox',
+                    exc_info=True,
+                    extra={'entry_id': entry.id},
+                )
+                self._store.fail(entry.id)
+                continue
+            try:
+                # already serialized with default headers and instrumentation when added to the outbox
+                result = self._backend.publish_serialized(message, entry.payload, dict(entry.attributes))
+            except Exception:
+                self._retry(entry)
+                continue
+            results.append((entry, result))
+
+        for entry, result in results:
+            try:
+                if isinstance(result, Future):
+                    result.result()
+            except Exception:
+                self._retry(entry)
+                continue
+            done.append(entry.id)
+        if done:
+            self._store.remove(done)
+        return len(entries)
+
+    def _retry(self, entry: OutboxEntry) -> None:
+        log(
+            __name__,
+            logging.WARNING,
+            'Failed to publish message from outbox',
+            exc_info=True,
+            extra={'entry_id': entry.id},
+        )
+        backoff = settings.HEDWIG_OUTBOX_RETRY_BACKOFF or _DEFAULT_RETRY_BACKOFF
+        self._store.retry(entry.id, backoff.delay_s(entry.attempts + 1))
+
+    def run(self, shutdown_event: Optional[threading.Event] = None) -> None:
+        """
+        Publishes messages until shut down. Waits up to ``HEDWIG_OUTBOX_POLL_INTERVAL_S`` seconds for new messages
+        once the outbox is drained.
+
+        :param shutdown_event: An event to signal that the relay should shut down, in addition to :meth:`stop`
+        """
+        while not self._shutdown.is_set() and not (shutdown_event and shutdown_event.is_set()):
+            self._wake.clear()
+            try:
+                claimed = self.relay_once()
+            except Exception:
+                log(__name__, logging.ERROR, 'Failed to relay messages from outbox', exc_info=True)
+                claimed = 0
+            if claimed < settings.HEDWIG_OUTBOX_BATCH_SIZE:
+                self._wake.wait(settings.HEDWIG_OUTBOX_POLL_INTERVAL_S)
+
+    def start(self) -> None:
+        """
+        Runs the relay in a daemon thread.
+        """
+        self._thread = threading.Thread(target=self.run, name='hedwig-outbox-relay', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stops the relay thread after the current batch.
+        """
+        self._shutdown.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def notify(self) -> None:
+        """
+        Wakes the relay up to publish new messages.
+        """
+        self._wake.set()
+
+
+class OutboxPublisherBackend(HedwigPublisherBaseBackend):
+    """
+    Publisher backend that writes messages to a durable outbox instead of the broker, so that publishing isn't slowed
+    down or failed by the broker. Messages are published by an :class:`OutboxRelay`, which runs in a background thread
+    if ``HEDWIG_OUTBOX_RELAY`` is set, or separately with ``python -m hedwig relay``. Returns the Hedwig message id,
+    rather than the broker's message id.
+    """
+
+    def __init__(self) -> None:
+        self._store = settings.HEDWIG_OUTBOX_STORE_CLASS()
+        self._relay: Optional[OutboxRelay] = None
+        self._relay_lock = threading.Lock()
+
+    @property
+    def relay(self) -> OutboxRelay:
+        if self._relay is None:
+            with self._relay_lock:
+                if self._relay is None:
+                    relay = OutboxRelay(store=self._store)
+                    if settings.HEDWIG_OUTBOX_RELAY:
+                        relay.start()
+                    self._relay = relay
+        return self._relay
+
+    def _publish(self, message: Message, payload: Union[str, bytes], attributes: Dict[str, str]) -> str:
+        self._store.add(payload, attributes)
+        if settings.HEDWIG_OUTBOX_RELAY:
+            self.relay.notify()
+        return message.id
+
+
+def publish_on_commit(message: Message, using: Optional[str] = None) -> None:
+    """
+    Publishes a message once the current Django transaction commits, or drops it if the transaction is rolled back.
+    Publishes right away if not in a transaction.
+
+    The message is published after the commit, so it's lost if the process dies in between, or if publishing fails with
+    a publisher backend other than :class:`OutboxPublisherBackend`. Even with the outbox, the default
+    :class:`SQLiteOutboxStore` is a separate database, written outside the transaction. To write messages atomically
+    with application data, use an :class:`OutboxStore` in the application database, and publish inside the
+    transaction instead.
+
+    :param message: The message to publish
+    :param using: Django database alias, defaults to the default database
+    """
+    from django.db import transaction
+
+    transaction.on_commit(message.publish, using=using)
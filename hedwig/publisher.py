@@ -1,10 +1,17 @@
+import hashlib
+import json
+import logging
+import threading
 import typing
-from concurrent.futures import Future
-from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import Future, wait
+from typing import Dict, NamedTuple, Optional, Tuple, List
 
 from hedwig.backends.base import HedwigPublisherBaseBackend
-from hedwig.backends.utils import get_publisher_backend
+from hedwig.backends.utils import flush_on_exit_and_fork, get_publisher_backend
+from hedwig.conf import settings
 from hedwig.models import Message
+from hedwig.utils import log
 
 
 def publish(message: Message, backend: Optional[HedwigPublisherBaseBackend] = None) -> typing.Union[str, Future]:
@@ -15,3 +22,244 @@ def publish(message: Message, backend: Optional[HedwigPublisherBaseBackend] = No
     """
     backend = backend or get_publisher_backend()
     return backend.publish(message)
+
+
+def _content_hash(message: Message) -> str:
+    if hasattr(message.data, 'SerializeToString'):
+        data = message.data.SerializeToString(deterministic=True)
+    else:
+        data = json.dumps(message.data, sort_keys=True, default=str).encode()
+    content = json.dumps([message.type, str(message.version), sorted(message.headers.items())]).encode()
+    return hashlib.sha256(content + data).hexdigest()
+
+
+class CoalescingPublisher:
+    """
+    Holds messages for a short window and publishes only one message per key, so that repeated updates of the same
+    entity published in quick succession cost a single publish. Messages with a dedup key are coalesced into the latest
+    message published with that key. Other messages are coalesced only if they're exact duplicates of an earlier
+    message, that is, they have the same type, version, headers and data.
+
+    Buffered messages are published ``window_s`` seconds after the first of them was buffered, on interpreter exit, and
+    before the process forks. Works with both sync and async publisher backends.
+    """
+
+    def __init__(self, window_s: Optional[float] = None, backend: Optional[HedwigPublisherBaseBackend] = None) -> None:
+        """
+        :param window_s: Seconds to hold messages for, defaults to ``HEDWIG_PUBLISHER_COALESCING_WINDOW_S``
+        :param backend: Publisher backend, defaults to the configured publisher backend
+        """
+        self._window_s = settings.HEDWIG_PUBLISHER_COALESCING_WINDOW_S if window_s is None else window_s
+        self._backend = backend
+        # latest message and futures of all coalesced messages, by key, in order of the first message
+        self._pending: 'OrderedDict[Tuple[str, str], Tuple[Message, List[Future]]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        # publishes through the backend, so flushed before backends
+        flush_on_exit_and_fork(self._flush_on_exit_and_fork, stage=0)
+
+    def publish(self, message: Message, dedup_key: Optional[str] = None) -> Future:
+        """
+        Buffers a message for publishing.
+
+        :param message: The message to publish
+        :param dedup_key: Messages of the same type with the same dedup key are coalesced into the latest one. If not
+            set, exact duplicates are coalesced.
+        :returns: a future that results in the id of the published message, once the window expires
+        """
+        key = (message.type, dedup_key) if dedup_key is not None else ('', _content_hash(message))
+        future: Future = Future()
+        with self._lock:
+            if key in self._pending:
+                pending_message, futures = self._pending[key]
+                self._pending[key] = (message if dedup_key is not None else pending_message, futures + [future])
+            else:
+                self._pending[key] = (message, [future])
+            if self._timer is None:
+                self._timer = threading.Timer(self._window_s, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def flush(self) -> None:
+        """
+        Publishes all buffered messages right away. For async publisher backends, doesn't wait for the publish to
+        finish.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for message, futures in pending.values():
+            self._publish(message, futures)
+
+    def _flush_on_exit_and_fork(self, timeout_s: float) -> None:
+        # async publisher backends are waited for when they're flushed
+        self.flush()
+
+    def _publish(self, message: Message, futures: List[Future]) -> None:
+        try:
+            result = publish(message, self._backend)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(lambda f: self._set_results(futures, f))
+        else:
+            for future in futures:
+                future.set_result(result)
+
+    @staticmethod
+    def _set_results(futures: List[Future], result: Future) -> None:
+        exception = result.exception()
+        for future in futures:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result.result())
+
+
+class PublishReport(NamedTuple):
+    """
+    Outcome of messages published through a :class:`TrackingPublisher`
+    """
+
+    succeeded: int
+    """
+    Number of messages published successfully
+    """
+
+    failed: List[Tuple[Message, BaseException]]
+    """
+    Messages that failed to publish, with the error
+    """
+
+    pending: List[Message]
+    """
+    Messages that hadn't finished publishing when the wait timed out
+    """
+
+    @property
+    def ok(self) -> bool:
+        """
+        True if all messages were published successfully
+        """
+        return not self.failed and not self.pending
+
+
+class TrackingPublisher:
+    """
+    Publishes messages and keeps track of the outstanding futures of async publisher backends, so that a batch job can
+    wait for everything it published and find out which messages failed. May be used as a context manager, which closes
+    the publisher on exit:
+
+    .. code:: python
+
+        with TrackingPublisher() as publisher:
+            for message in messages:
+                publisher.publish(message)
+        assert publisher.report.ok
+
+    Outstanding messages are waited for on interpreter exit and before the process forks, if the publisher wasn't
+    closed explicitly, waiting up to ``HEDWIG_PUBLISHER_EXIT_TIMEOUT_S`` or ``HEDWIG_PUBLISHER_FORK_TIMEOUT_S``
+    seconds, and logging any messages that failed to publish.
+    """
+
+    def __init__(self, backend: Optional[HedwigPublisherBaseBackend] = None) -> None:
+        """
+        :param backend: Publisher backend, defaults to the configured publisher backend
+        """
+        self._backend = backend
+        self._lock = threading.Lock()
+        self._pending: Dict[Future, Message] = {}
+        self._succeeded = 0
+        self._failed: List[Tuple[Message, BaseException]] = []
+        self.report: Optional[PublishReport] = None
+        """
+        Report returned by :meth:`close`, once closed
+        """
+        flush_on_exit_and_fork(self._flush_on_exit_and_fork, stage=0)
+
+    def publish(self, message: Message) -> typing.Union[str, Future]:
+        """
+        Publishes a message, see :meth:`hedwig.publisher.publish`. Errors raised by the publisher backend aren't
+        tracked, they're raised to the caller.
+        """
+        result = publish(message, self._backend)
+        if not isinstance(result, Future):
+            with self._lock:
+                self._succeeded += 1
+            return result
+        with self._lock:
+            self._pending[result] = message
+        result.add_done_callback(self._on_done)
+        return result
+
+    def _on_done(self, future: Future) -> None:
+        with self._lock:
+            message = self._pending.pop(future, None)
+            if message is None:
+                # already counted
+                return
+            error = future.exception()
+            if error is not None:
+                self._failed.append((message, error))
+            else:
+                self._succeeded += 1
+
+    def flush(self, timeout: Optional[float] = None) -> PublishReport:
+        """
+        Waits for all messages published so far to finish publishing, and reports the outcome of messages finished
+        since the last flush.
+
+        :param timeout: Maximum number of seconds to wait, or None to wait until done
+        :returns: the outcome of published messages, messages that are still publishing are reported as pending
+        """
+        with self._lock:
+            futures = list(self._pending)
+        done, _ = wait(futures, timeout)
+        # done callbacks may not have run yet
+        for future in done:
+            self._on_done(future)
+        with self._lock:
+            report = PublishReport(self._succeeded, self._failed, list(self._pending.values()))
+            self._succeeded = 0
+            self._failed = []
+        return report
+
+    def close(self, timeout: Optional[float] = None) -> PublishReport:
+        """
+        Flushes the publisher, and stops tracking it for interpreter exit.
+
+        :param timeout: Maximum number of seconds to wait, or None to wait until done
+        """
+        self.report = self.flush(timeout)
+        return self.report
+
+    def _flush_on_exit_and_fork(self, timeout_s: float) -> None:
+        if self.report is not None:
+            return
+        # wait without consuming the outcome, that's still reported by the next flush
+        with self._lock:
+            futures = list(self._pending)
+        done, not_done = wait(futures, timeout_s)
+        for future in done:
+            self._on_done(future)
+        with self._lock:
+            failed = [message.id for message, _ in self._failed]
+            pending = [self._pending[future].id for future in not_done if future in self._pending]
+        if failed or pending:
+            log(
+                __name__,
+                logging.ERROR,
+                'Messages failed to publish before exit or fork',
+                extra={'failed': failed, 'pending': pending},
+            )
+
+    def __enter__(self) -> 'TrackingPublisher':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close(settings.HEDWIG_PUBLISHER_EXIT_TIMEOUT_S)
@@ -0,0 +1,124 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from functools import partial
+from typing import List, Optional
+
+from hedwig.conf import settings
+from hedwig.consumer import listen_for_messages
+from hedwig.utils import log
+
+
+# how often dead workers are restarted
+_POLL_INTERVAL_S = 1.0
+
+
+def _report_heartbeat(error_counts, index: int, error_count: int, **kwargs) -> None:
+    error_counts[index] = error_count
+
+
+def _configure_worker(index: int, num_workers: int) -> None:
+    setattr(settings, 'HEDWIG_WORKER_INDEX', index)
+    # split the partitions assigned to this host between workers, so that each partition is still read by one worker
+    host_index, num_hosts = settings.HEDWIG_REDIS_PARTITION_ASSIGNMENT or (0, 1)
+    setattr(settings, 'HEDWIG_REDIS_PARTITION_ASSIGNMENT', (host_index + index * num_hosts, num_hosts * num_workers))
+
+
+def _worker_main(
+    index: int, num_workers: int, error_counts, num_messages: int, visibility_timeout_s: Optional[int]
+) -> None:
+    shutdown_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: shutdown_event.set())
+    # Ctrl-C is sent to the whole process group, supervisor forwards it as SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # heartbeat hook is called by the supervisor with combined worker health
+    setattr(settings, 'HEDWIG_HEARTBEAT_HOOK', partial(_report_heartbeat, error_counts, index))
+    _configure_worker(index, num_workers)
+
+    log(__name__, logging.INFO, 'Starting Hedwig consumer worker', extra={'worker': index})
+    listen_for_messages(num_messages, visibility_timeout_s, shutdown_event=shutdown_event)
+
+
+def supervise(
+    num_workers: int,
+    num_messages: int = 10,
+    visibility_timeout_s: Optional[int] = None,
+    shutdown_event: Optional[threading.Event] = None,
+    shutdown_timeout_s: float = 60,
+) -> None:
+    """
+    Runs ``num_workers`` consumer processes, each calling :meth:`hedwig.consumer.listen_for_messages`, and restarts
+    workers that exit. The heartbeat hook is called by the supervisor, with ``error_count`` being the highest error count
+    of all workers.
+
+    Each worker gets its index in ``HEDWIG_WORKER_INDEX``. On Redis, the partitions assigned to this process by
+    ``HEDWIG_REDIS_PARTITION_ASSIGNMENT`` (all partitions if not set) are split between workers, so that each partition
+    is still read by a single worker.
+
+    SIGTERM and SIGINT shut down the supervisor. Workers are sent SIGTERM, finish processing the current messages, and
+    are killed if they don't exit within ``shutdown_timeout_s``.
+
+    :param num_workers: Number of worker processes
+    :param num_messages: Maximum number of messages to fetch in one API call. Defaults to 10
+    :param visibility_timeout_s: The number of seconds the message should remain invisible to other queue readers.
+        Defaults to None, which is queue default
+    :param shutdown_event: An event to signal that the supervisor should shut down, in addition to signals
+    :param shutdown_timeout_s: Seconds to wait for workers to exit on shut down
+    """
+    if not shutdown_event:
+        shutdown_event = threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: shutdown_event.set())  # type: ignore[union-attr]
+
+    context = multiprocessing.get_context('fork')
+    error_counts = context.Array('i', num_workers)
+    workers: List[Optional[multiprocessing.process.BaseProcess]] = [None] * num_workers
+    heartbeat_interval_s = settings.HEDWIG_HEARTBEAT_INTERVAL_S
+    heartbeat_called_at = 0.0
+
+    while not shutdown_event.is_set():
+        for index, worker in enumerate(workers):
+            if worker is not None and worker.is_alive():
+                continue
+            if worker is not None:
+                log(
+                    __name__,
+                    logging.ERROR,
+                    'Hedwig consumer worker exited, restarting',
+                    extra={'worker': index, 'exitcode': worker.exitcode},
+                )
+            error_counts[index] = 0
+            worker = context.Process(
+                target=_worker_main,
+                args=(index, num_workers, error_counts, num_messages, visibility_timeout_s),
+                name=f'hedwig-worker-{index}',
+            )
+            worker.start()
+            workers[index] = worker
+
+        now = time.monotonic()
+        if now - heartbeat_called_at >= heartbeat_interval_s:
+            try:
+                settings.HEDWIG_HEARTBEAT_HOOK(error_count=max(error_counts[:]))
+            except Exception:
+                log(__name__, logging.ERROR, 'Exception in heartbeat hook', exc_info=True)
+            heartbeat_called_at = now
+
+        shutdown_event.wait(_POLL_INTERVAL_S)
+
+    log(__name__, logging.INFO, 'Shutting down Hedwig consumer workers')
+    for worker in workers:
+        if worker is not None and worker.is_alive():
+            worker.terminate()
+    deadline = time.monotonic() + shutdown_timeout_s
+    for worker in workers:
+        if worker is None:
+            continue
+        worker.join(max(0.0, deadline - time.monotonic()))
+        if worker.is_alive():
+            log(__name__, logging.ERROR, 'Killing Hedwig consumer worker', extra={'worker': worker.name})
+            worker.kill()
+            worker.join()
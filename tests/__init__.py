@@ -7,9 +7,6 @@ from hedwig.models import Message
 
 
 class MockHedwigPublisherBackend(HedwigPublisherBaseBackend):
-    def _mock_queue_message(self, message: Message):
-        pass
-
     def _publish(self, message: Message, payload: Union[str, bytes], attributes: Dict[str, str]) -> Union[str, Future]:
         pass
 
@@ -4,6 +4,7 @@ from unittest import mock
 
 import pytest
 
+import hedwig.backends.utils
 import hedwig.conf
 from hedwig.backends.import_utils import import_module_attr
 from hedwig.testing.config import unconfigure
@@ -22,6 +23,16 @@ def pytest_configure():
     logging.basicConfig()
 
 
+@pytest.fixture(autouse=True)
+def flush_methods():
+    """
+    Isolates objects registered for flushing on exit and fork, so that objects left with mocked messages in flight
+    don't delay forks in other tests
+    """
+    with mock.patch.object(hedwig.backends.utils, '_flush_methods', []) as flush_methods:
+        yield flush_methods
+
+
 @pytest.fixture
 def settings():
     """
@@ -1,6 +1,8 @@
 import base64
 import json
+import logging
 import threading
+import time
 import uuid
 from datetime import datetime, timedelta, timezone
 from unittest import mock
@@ -12,6 +14,7 @@ try:
     from hedwig.backends.aws import AWSMetadata
 except ImportError:
     pass
+from hedwig.backends.base import RateLimit, RetryBackoff, SyncMetadata
 from hedwig.backends.exceptions import PartialFailure
 from hedwig.conf import settings as hedwig_settings
 from hedwig.exceptions import ValidationError, CallbackNotFound
@@ -66,18 +69,85 @@ class TestSNSPublisher:
         settings.HEDWIG_PUBLISHER_BACKEND = 'hedwig.backends.aws.AWSSNSPublisherBackend'
         settings.HEDWIG_CONSUMER_BACKEND = 'hedwig.backends.aws.AWSSQSConsumerBackend'
         settings.HEDWIG_SYNC = True
-        receipt = 'test-receipt'
-        sent_time = datetime.now(timezone.utc)
-        sent_time = sent_time.replace(microsecond=(sent_time.microsecond // 1000) * 1000)
-        first_receive_time = datetime.now(timezone.utc)
-        first_receive_time = first_receive_time.replace(microsecond=(first_receive_time.microsecond // 1000) * 1000)
-        receive_count = 1
 
         message.publish()
         callback_mock.assert_called_once_with(
-            message.with_provider_metadata(AWSMetadata(receipt, first_receive_time, sent_time, receive_count))
+            message.with_provider_metadata(SyncMetadata(aws.AWSSNSPublisherBackend.topic(message)))
         )
 
+    def test_client_config(self, mock_boto3, settings):
+        settings.AWS_MAX_POOL_CONNECTIONS = 50
+        settings.AWS_TCP_KEEPALIVE = True
+        settings.AWS_RETRY_MODE = 'adaptive'
+        settings.AWS_RETRY_MAX_ATTEMPTS = 5
+        sns_publisher = aws.AWSSNSPublisherBackend()
+
+        sns_publisher.sns_client
+
+        config = mock_boto3.client.call_args[1]['config']
+        assert config.max_pool_connections == 50
+        assert config.tcp_keepalive is True
+        assert config.retries == {'mode': 'adaptive', 'total_max_attempts': 5}
+        assert config.connect_timeout == hedwig_settings.AWS_CONNECT_TIMEOUT_S
+
+    def test_client_shared_between_threads(self, mock_boto3):
+        sns_publisher = aws.AWSSNSPublisherBackend()
+        clients = []
+
+        thread = threading.Thread(target=lambda: clients.append(sns_publisher.sns_client))
+        thread.start()
+        thread.join()
+
+        assert sns_publisher.sns_client is clients[0]
+        mock_boto3.client.assert_called_once()
+
+    def test_thread_local_clients(self, mock_boto3, settings):
+        settings.AWS_THREAD_LOCAL_CLIENTS = True
+        mock_boto3.client.side_effect = lambda *args, **kwargs: mock.MagicMock()
+        sns_publisher = aws.AWSSNSPublisherBackend()
+        clients = []
+
+        thread = threading.Thread(target=lambda: clients.append(sns_publisher.sns_client))
+        thread.start()
+        thread.join()
+
+        assert sns_publisher.sns_client is sns_publisher.sns_client
+        assert sns_publisher.sns_client is not clients[0]
+        assert mock_boto3.client.call_count == 2
+
+    def test_warmup(self, mock_boto3):
+        sns_publisher = aws.AWSSNSPublisherBackend()
+
+        sns_publisher.warmup()
+
+        sns_publisher.sns_client.list_topics.assert_called_once_with()
+
+    @pytest.mark.parametrize('warmup_clients', [True, False])
+    def test_warmup_on_creation(self, mock_boto3, settings, warmup_clients):
+        settings.AWS_WARMUP_CLIENTS = warmup_clients
+
+        aws.AWSSNSPublisherBackend()
+
+        assert mock_boto3.client.return_value.list_topics.called is warmup_clients
+
+    def test_warmup_ignores_errors(self, mock_boto3):
+        sns_publisher = aws.AWSSNSPublisherBackend()
+        sns_publisher.sns_client.list_topics.side_effect = aws.BotoCoreError()
+
+        sns_publisher.warmup()
+
+    @mock.patch('tests.handlers._trip_created_handler', autospec=True)
+    def test_sync_mode_hooks(self, callback_mock, mock_boto3, message, prepost_process_hooks, settings):
+        settings.HEDWIG_PUBLISHER_BACKEND = 'hedwig.backends.aws.AWSSNSPublisherBackend'
+        settings.HEDWIG_CONSUMER_BACKEND = 'hedwig.backends.aws.AWSSQSConsumerBackend'
+        settings.HEDWIG_SYNC = True
+
+        message.publish()
+
+        metadata = SyncMetadata(aws.AWSSNSPublisherBackend.topic(message))
+        pre_process_hook.assert_called_once_with(sqs_queue_message=metadata)
+        post_process_hook.assert_called_once_with(sqs_queue_message=metadata)
+
     def test_sync_mode_detects_invalid_callback(self, settings, mock_boto3, message_factory):
         settings.HEDWIG_PUBLISHER_BACKEND = 'hedwig.backends.aws.AWSSNSPublisherBackend'
         settings.HEDWIG_CONSUMER_BACKEND = 'hedwig.backends.aws.AWSSQSConsumerBackend'
@@ -127,6 +197,7 @@ class TestSQSConsumer:
             aws_secret_access_key=hedwig_settings.AWS_SECRET_KEY,
             aws_session_token=hedwig_settings.AWS_SESSION_TOKEN,
             endpoint_url=hedwig_settings.AWS_ENDPOINT_SQS,
+            config=mock.ANY,
         )
         mock_boto3.client.assert_called_once_with(
             'sqs',
@@ -135,8 +206,25 @@ class TestSQSConsumer:
             aws_secret_access_key=hedwig_settings.AWS_SECRET_KEY,
             aws_session_token=hedwig_settings.AWS_SESSION_TOKEN,
             endpoint_url=hedwig_settings.AWS_ENDPOINT_SQS,
+            config=mock.ANY,
         )
 
+    def test_warmup(self, sqs_consumer, mock_boto3):
+        sqs_consumer.warmup()
+
+        mock_boto3.resource.assert_called_once()
+        sqs_consumer.sqs_client.get_queue_url.assert_called_once_with(QueueName=sqs_consumer.queue_name)
+
+    @pytest.mark.parametrize('warmup_clients', [True, False])
+    def test_warmup_on_creation(self, mock_boto3, settings, warmup_clients):
+        settings.AWS_WARMUP_CLIENTS = warmup_clients
+
+        sqs_consumer = aws.AWSSQSConsumerBackend()
+
+        assert mock_boto3.client.return_value.get_queue_url.called is warmup_clients
+        if warmup_clients:
+            mock_boto3.client.return_value.get_queue_url.assert_called_once_with(QueueName=sqs_consumer.queue_name)
+
     def test_pull_messages(self, sqs_consumer, prepost_process_hooks):
         num_messages = 1
         visibility_timeout = 10
@@ -183,6 +271,96 @@ class TestSQSConsumer:
         assert sqs_consumer._error_count == expected_error_count
         heartbeat_hook.assert_called_once_with(error_count=expected_error_count)
 
+    def test_quarantine_message(self, sqs_consumer):
+        queue_message = mock.MagicMock()
+        queue_message.message_attributes = {'hedwig_id': {'DataType': 'String', 'StringValue': '123'}}
+        dead_letter_queue = sqs_consumer.sqs_resource.get_queue_by_name.return_value
+
+        sqs_consumer._quarantine_message(queue_message, 'Invalid message body')
+        sqs_consumer._quarantine_message(queue_message, 'Invalid message body')
+
+        # DLQ is looked up once
+        sqs_consumer.sqs_resource.get_queue_by_name.assert_called_once_with(
+            QueueName=f'HEDWIG-{hedwig_settings.HEDWIG_QUEUE}-DLQ'
+        )
+        dead_letter_queue.send_message.assert_called_with(
+            MessageBody=queue_message.body,
+            MessageAttributes={
+                'hedwig_id': {'DataType': 'String', 'StringValue': '123'},
+                'hedwig_error': {'DataType': 'String', 'StringValue': 'Invalid message body'},
+            },
+        )
+        assert dead_letter_queue.send_message.call_count == 2
+
+    @mock.patch('hedwig.backends.aws.log', autospec=True)
+    def test_quarantine_message_with_many_headers(self, mock_log, sqs_consumer, message):
+        _, attributes = message.serialize()
+        headers = {f'header_{i}': str(i) for i in range(aws.MAX_MESSAGE_ATTRIBUTES - len(attributes))}
+        _, attributes = message.with_headers({**message.headers, **headers}).serialize()
+        assert len(attributes) == aws.MAX_MESSAGE_ATTRIBUTES
+        queue_message = mock.MagicMock()
+        queue_message.message_attributes = {k: {'DataType': 'String', 'StringValue': v} for k, v in attributes.items()}
+        dead_letter_queue = sqs_consumer.sqs_resource.get_queue_by_name.return_value
+
+        sqs_consumer._quarantine_message(queue_message, 'Invalid message body')
+
+        # message keeps all its attributes, error doesn't fit
+        dead_letter_queue.send_message.assert_called_once_with(
+            MessageBody=queue_message.body, MessageAttributes=queue_message.message_attributes
+        )
+        mock_log.assert_called_once_with(
+            'hedwig.backends.aws',
+            logging.WARNING,
+            'Too many message attributes to add error, moving message to DLQ without it',
+            extra={'queue_message': queue_message, 'error': 'Invalid message body'},
+        )
+
+    def test_nack_message_with_backoff(self, sqs_consumer, settings):
+        settings.HEDWIG_DEFAULT_RETRY_BACKOFF = RetryBackoff(initial_s=5, max_s=600)
+        queue_message = mock.MagicMock()
+        queue_message.attributes = {'ApproximateReceiveCount': '3'}
+
+        sqs_consumer.nack_message(queue_message)
+
+        queue_message.change_visibility.assert_called_once_with(VisibilityTimeout=20)
+
+    def test_nack_message_without_backoff(self, sqs_consumer):
+        queue_message = mock.MagicMock()
+        queue_message.attributes = {'ApproximateReceiveCount': '3'}
+
+        sqs_consumer.nack_message(queue_message)
+
+        queue_message.change_visibility.assert_not_called()
+
+    @pytest.mark.parametrize(
+        'visibility_timeout, setting, expected', [(None, None, 30), (None, 120, 120), (300, 120, 300)]
+    )
+    def test_extend_queued_message_lease(self, sqs_consumer, settings, visibility_timeout, setting, expected):
+        settings.HEDWIG_VISIBILITY_TIMEOUT_S = setting
+        sqs_consumer._visibility_timeout = visibility_timeout
+        queue_message = mock.MagicMock()
+
+        assert sqs_consumer._extend_queued_message_lease(queue_message) == expected
+
+        queue_message.change_visibility.assert_called_once_with(VisibilityTimeout=expected)
+
+    def test_message_timestamp(self, sqs_consumer):
+        queue_message = mock.MagicMock()
+        queue_message.attributes = {'SentTimestamp': '1609459200000'}
+
+        assert sqs_consumer._message_timestamp(queue_message, {'hedwig_message_timestamp': '1500000000000'}) == 1.5e9
+        # falls back to SQS sent time
+        assert sqs_consumer._message_timestamp(queue_message, {}) == 1609459200
+
+    def test_expired_message_without_timestamp_attribute(self, sqs_consumer, settings):
+        settings.HEDWIG_DEFAULT_MESSAGE_TTL_S = 60
+        queue_message = mock.MagicMock()
+
+        queue_message.attributes = {'SentTimestamp': str(int((time.time() - 120) * 1000))}
+        assert sqs_consumer._is_expired(queue_message, {})
+        queue_message.attributes = {'SentTimestamp': str(int(time.time() * 1000))}
+        assert not sqs_consumer._is_expired(queue_message, {})
+
     def test_extend_visibility_timeout(self, sqs_consumer, prepost_process_hooks):
         visibility_timeout_s = 10
         receipt = "receipt"
@@ -202,6 +380,27 @@ class TestSQSConsumer:
         )
         heartbeat_hook.assert_called_once_with(error_count=0)
 
+    @mock.patch('hedwig.backends.base.time.sleep', autospec=True)
+    @mock.patch('tests.handlers._trip_created_handler', autospec=True)
+    def test_rate_limit_wait_extends_visibility_timeout(
+        self, callback_mock, mock_sleep, sqs_consumer, message, settings
+    ):
+        settings.HEDWIG_RATE_LIMITS = {(message.type, f'{message.major_version}.*'): RateLimit(rate=0.4, max_wait_s=5)}
+        sqs_consumer._visibility_timeout = 60
+        sqs_consumer.sqs_client.get_queue_url = mock.MagicMock(return_value={"QueueUrl": "DummyQueueUrl"})
+        now = datetime.now(timezone.utc)
+        metadata = AWSMetadata("receipt", now, now, 1)
+
+        sqs_consumer.message_handler(*message.serialize(), metadata)
+        sqs_consumer.message_handler(*message.serialize(), metadata)
+
+        # covers the wait, and the visibility timeout the message was pulled with
+        mock_sleep.assert_called_once_with(pytest.approx(2.5, abs=0.01))
+        sqs_consumer.sqs_client.change_message_visibility.assert_called_once_with(
+            QueueUrl='DummyQueueUrl', ReceiptHandle='receipt', VisibilityTimeout=63
+        )
+        assert callback_mock.call_count == 2
+
     def test_success_requeue_dead_letter(self, sqs_consumer):
         sqs_consumer = aws.AWSSQSConsumerBackend(dlq=True)
         num_messages = 3
@@ -1,15 +1,30 @@
 import json
 import logging
+import os
 import threading
+import time
 from unittest import mock
 
 import pytest
 
+from hedwig.backends.base import (
+    Bulkhead,
+    LoadShedding,
+    PreFilterAction,
+    RateLimit,
+    RetryBackoff,
+    SyncMetadata,
+    TokenBucket,
+    callbacks_pre_filter,
+)
+from hedwig.backends import utils as backends_utils
 from hedwig.backends.utils import get_consumer_backend, get_publisher_backend
 from hedwig.conf import settings
-from hedwig.exceptions import LoggingException, RetryException, IgnoreException
+from hedwig.exceptions import CallbackNotFound, LoggingException, RetryException, IgnoreException
 from hedwig.models import ValidationError
+from hedwig.validators.base import HedwigBaseValidator
 from tests import MockHedwigConsumerBackend, MockHedwigPublisherBackend
+from tests.models import MessageType
 from tests.utils.mock import mock_return_once
 
 
@@ -28,6 +43,18 @@ class TestBackends:
 
         assert isinstance(publisher_backend, MockHedwigPublisherBackend)
 
+    def test_backends_are_reset_after_fork(self, settings):
+        settings.HEDWIG_PUBLISHER_BACKEND = "tests.MockHedwigPublisherBackend"
+        publisher_backend = get_publisher_backend()
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if get_publisher_backend() is not publisher_backend else 1)
+        _, status = os.waitpid(pid, 0)
+
+        assert os.waitstatus_to_exitcode(status) == 0
+        assert get_publisher_backend() is publisher_backend
+
     @pytest.mark.parametrize("get_backend_fn", [get_publisher_backend, get_consumer_backend])
     def test_failure(self, get_backend_fn, settings):
         settings.HEDWIG_PUBLISHER_BACKEND = settings.HEDWIG_CONSUMER_BACKEND = "hedwig.backends.invalid"
@@ -36,6 +63,106 @@ class TestBackends:
             get_backend_fn()
 
 
+class _Buffer:
+    def __init__(self, flushed: list) -> None:
+        self.flushed = flushed
+
+    def flush(self, timeout_s: float) -> None:
+        self.flushed.append(self)
+
+
+class _FailingBuffer:
+    def flush(self, timeout_s: float) -> None:
+        raise ValueError
+
+
+class _SlowBuffer:
+    def __init__(self, timeouts: list) -> None:
+        self.timeouts = timeouts
+
+    def flush(self, timeout_s: float) -> None:
+        self.timeouts.append(timeout_s)
+        time.sleep(timeout_s)
+
+
+class TestFlushOnExitAndFork:
+    def test_flushes_by_stage(self):
+        flushed: list = []
+        backend, publisher = _Buffer(flushed), _Buffer(flushed)
+        backends_utils.flush_on_exit_and_fork(backend.flush, stage=1)
+        backends_utils.flush_on_exit_and_fork(publisher.flush, stage=0)
+
+        backends_utils._flush_all(30)
+
+        assert flushed == [publisher, backend]
+
+    def test_flushes_before_fork(self):
+        flushed: list = []
+        buffer = _Buffer(flushed)
+        backends_utils.flush_on_exit_and_fork(buffer.flush)
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        assert flushed == [buffer]
+
+    def test_doesnt_keep_objects_alive(self, flush_methods):
+        flushed: list = []
+        backends_utils.flush_on_exit_and_fork(_Buffer(flushed).flush)
+
+        backends_utils._flush_all(30)
+
+        assert flushed == []
+        # dead references are removed on the next registration
+        backends_utils.flush_on_exit_and_fork(_Buffer(flushed).flush)
+        assert len(flush_methods) == 1
+
+    def test_flush_error(self):
+        flushed: list = []
+        failing, buffer = _FailingBuffer(), _Buffer(flushed)
+        backends_utils.flush_on_exit_and_fork(failing.flush)
+        backends_utils.flush_on_exit_and_fork(buffer.flush)
+
+        with mock.patch('hedwig.backends.utils.log') as logging_mock:
+            backends_utils._flush_all(30)
+
+        assert flushed == [buffer]
+        logging_mock.assert_called_once_with(
+            'hedwig.backends.utils', logging.ERROR, 'Failed to flush buffered messages', exc_info=True
+        )
+
+    def test_timeout_is_shared(self):
+        timeouts: list = []
+        buffers = [_SlowBuffer(timeouts), _SlowBuffer(timeouts)]
+        for buffer in buffers:
+            backends_utils.flush_on_exit_and_fork(buffer.flush)
+
+        with mock.patch('hedwig.backends.utils.log') as logging_mock:
+            backends_utils._flush_all(0.05)
+
+        assert timeouts == [pytest.approx(0.05, abs=0.01), 0]
+        logging_mock.assert_called_once_with(
+            'hedwig.backends.utils', logging.WARNING, 'Timed out flushing buffered messages', extra={'timeout_s': 0.05}
+        )
+
+    @pytest.mark.parametrize(
+        'flush_fn, setting',
+        [
+            (backends_utils._flush_on_exit, 'HEDWIG_PUBLISHER_EXIT_TIMEOUT_S'),
+            (backends_utils._flush_before_fork, 'HEDWIG_PUBLISHER_FORK_TIMEOUT_S'),
+        ],
+    )
+    def test_flush_timeouts(self, settings, flush_fn, setting):
+        setattr(settings, setting, 7)
+
+        with mock.patch('hedwig.backends.utils._flush_all', autospec=True) as mock_flush_all:
+            flush_fn()
+
+        mock_flush_all.assert_called_once_with(7)
+
+
 @mock.patch('hedwig.backends.base.Message.exec_callback', autospec=True)
 class TestMessageHandler:
     def test_success(self, mock_exec_callback, message, consumer_backend, use_transport_message_attrs):
@@ -63,6 +190,105 @@ class TestMessageHandler:
         mock_exec_callback.side_effect = Exception
         with pytest.raises(mock_exec_callback.side_effect):
             consumer_backend.message_handler(*message.serialize(), None)
+        # message is kept for retry backoff lookup
+        assert consumer_backend._message == message
+
+    @mock.patch('hedwig.backends.base.time.sleep', autospec=True)
+    def test_waits_for_rate_limit(self, mock_sleep, mock_exec_callback, message, consumer_backend, settings):
+        settings.HEDWIG_RATE_LIMITS = {(message.type, f'{message.major_version}.*'): RateLimit(rate=2, max_wait_s=1)}
+        consumer_backend._extend_lease_for_wait = mock.MagicMock(return_value=True)
+        provider_metadata = mock.Mock()
+
+        consumer_backend.message_handler(*message.serialize(), provider_metadata)
+        mock_sleep.assert_not_called()
+
+        consumer_backend.message_handler(*message.serialize(), provider_metadata)
+        mock_sleep.assert_called_once_with(pytest.approx(0.5, abs=0.01))
+        consumer_backend._extend_lease_for_wait.assert_called_once_with(provider_metadata, pytest.approx(0.5, abs=0.01))
+        assert mock_exec_callback.call_count == 2
+
+    @mock.patch('hedwig.backends.base.time.sleep', autospec=True)
+    def test_defers_when_lease_cant_be_extended(
+        self, mock_sleep, mock_exec_callback, message, consumer_backend, settings
+    ):
+        settings.HEDWIG_GLOBAL_RATE_LIMIT = RateLimit(rate=100, burst=2)
+        settings.HEDWIG_RATE_LIMITS = {(message.type, f'{message.major_version}.*'): RateLimit(rate=2, max_wait_s=1)}
+        consumer_backend._extend_lease_for_wait = mock.MagicMock(return_value=False)
+
+        consumer_backend.message_handler(*message.serialize(), None)
+        with pytest.raises(RetryException):
+            consumer_backend.message_handler(*message.serialize(), None)
+
+        mock_sleep.assert_not_called()
+        mock_exec_callback.assert_called_once()
+        assert consumer_backend._retry_delay_s(1) == pytest.approx(0.5, abs=0.01)
+        # tokens were refunded
+        assert consumer_backend._rate_limit_buckets['global'].reserve(0) == (True, 0)
+        assert consumer_backend._rate_limit_buckets[f'{message.type}:{message.major_version}'].reserve(1) == (
+            True,
+            pytest.approx(0.5, abs=0.01),
+        )
+
+    def test_defers_on_rate_limit(self, mock_exec_callback, message, consumer_backend, settings):
+        settings.HEDWIG_GLOBAL_RATE_LIMIT = RateLimit(rate=100, burst=2)
+        settings.HEDWIG_RATE_LIMITS = {(message.type, f'{message.major_version}.*'): RateLimit(rate=0.1)}
+
+        consumer_backend.message_handler(*message.serialize(), None)
+        with pytest.raises(RetryException):
+            consumer_backend.message_handler(*message.serialize(), None)
+
+        mock_exec_callback.assert_called_once()
+        assert consumer_backend._retry_delay_s(1) == pytest.approx(10, abs=0.01)
+        # deferral only applies once
+        assert consumer_backend._retry_delay_s(1) is None
+        # global token was refunded
+        assert consumer_backend._rate_limit_buckets['global'].reserve(0) == (True, 0)
+
+
+class TestTokenBucket:
+    @mock.patch('hedwig.backends.base.time.monotonic', autospec=True)
+    def test_reserve(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket('test', RateLimit(rate=2, burst=2))
+
+        assert bucket.reserve(0) == (True, 0)
+        assert bucket.reserve(0) == (True, 0)
+        assert bucket.reserve(0) == (False, 0.5)
+        assert bucket.reserve(1) == (True, 0.5)
+        assert bucket.reserve(0.5) == (False, 1.0)
+
+        # refills over time, up to burst
+        mock_monotonic.return_value = 110.0
+        assert bucket.reserve(0) == (True, 0)
+        assert bucket.reserve(0) == (True, 0)
+        assert bucket.reserve(0) == (False, 0.5)
+
+    def test_refund(self):
+        bucket = TokenBucket('test', RateLimit(rate=0.001))
+
+        assert bucket.reserve(0) == (True, 0)
+        bucket.refund()
+        assert bucket.reserve(0) == (True, 0)
+
+
+class TestRetryBackoff:
+    def test_delay_s(self):
+        backoff = RetryBackoff(initial_s=1, max_s=10)
+        assert [backoff.delay_s(x) for x in range(1, 6)] == [1, 2, 4, 8, 10]
+
+    def test_retry_delay_s(self, message, consumer_backend, settings):
+        settings.HEDWIG_DEFAULT_RETRY_BACKOFF = RetryBackoff(initial_s=1, max_s=10)
+        settings.HEDWIG_RETRY_BACKOFF = {('trip_created', '1.*'): RetryBackoff(initial_s=5, max_s=60, multiplier=3)}
+
+        # message couldn't be deserialized
+        assert consumer_backend._retry_delay_s(2) == 2
+
+        consumer_backend._message = message
+        assert consumer_backend._retry_delay_s(2) == 15
+
+    def test_retry_delay_s_not_configured(self, message, consumer_backend):
+        consumer_backend._message = message
+        assert consumer_backend._retry_delay_s(2) is None
 
 
 pre_process_hook = mock.MagicMock()
@@ -246,6 +472,278 @@ class TestFetchAndProcessMessages:
 
             logging_mock.assert_called_once_with('hedwig.backends.base', logging.INFO, mock.ANY, extra=mock.ANY)
 
+    @pytest.mark.parametrize(
+        'quarantine,deserialized,quarantined',
+        [(True, False, True), (False, False, False), (True, True, False)],
+        ids=['quarantine', 'quarantine-disabled', 'callback-validation-error'],
+    )
+    def test_quarantine_invalid_message(self, consumer_backend, settings, quarantine, deserialized, quarantined):
+        settings.HEDWIG_QUARANTINE_INVALID_MESSAGES = quarantine
+        shutdown_event = threading.Event()
+        queue_message = mock.MagicMock()
+        consumer_backend.pull_messages = mock.MagicMock()
+        mock_return_once(consumer_backend.pull_messages, [queue_message], [], shutdown_event)
+
+        def process_message(_):
+            if deserialized:
+                consumer_backend._message = mock.MagicMock()
+            raise ValidationError('Invalid message body')
+
+        consumer_backend.process_message = mock.MagicMock(side_effect=process_message)
+        consumer_backend._quarantine_message = mock.MagicMock()
+        consumer_backend.ack_message = mock.MagicMock()
+        consumer_backend.nack_message = mock.MagicMock()
+
+        consumer_backend.fetch_and_process_messages(shutdown_event=shutdown_event)
+
+        if quarantined:
+            consumer_backend._quarantine_message.assert_called_once_with(queue_message, 'Invalid message body')
+            consumer_backend.ack_message.assert_called_once_with(queue_message)
+            consumer_backend.nack_message.assert_not_called()
+            assert consumer_backend.error_count == 0
+        else:
+            consumer_backend._quarantine_message.assert_not_called()
+            consumer_backend.ack_message.assert_not_called()
+            consumer_backend.nack_message.assert_called_once_with(queue_message)
+            assert consumer_backend.error_count == 1
+
+    def test_quarantine_invalid_message_failure(self, consumer_backend, settings):
+        settings.HEDWIG_QUARANTINE_INVALID_MESSAGES = True
+        shutdown_event = threading.Event()
+        queue_message = mock.MagicMock()
+        consumer_backend.pull_messages = mock.MagicMock()
+        mock_return_once(consumer_backend.pull_messages, [queue_message], [], shutdown_event)
+        consumer_backend.process_message = mock.MagicMock(side_effect=ValidationError('Invalid message body'))
+        consumer_backend._quarantine_message = mock.MagicMock(side_effect=Exception)
+        consumer_backend.ack_message = mock.MagicMock()
+        consumer_backend.nack_message = mock.MagicMock()
+
+        consumer_backend.fetch_and_process_messages(shutdown_event=shutdown_event)
+
+        consumer_backend.ack_message.assert_not_called()
+        consumer_backend.nack_message.assert_called_once_with(queue_message)
+
+    @pytest.mark.parametrize('action', list(PreFilterAction))
+    def test_pre_filter(self, consumer_backend, settings, message, action):
+        settings.HEDWIG_PRE_FILTER = 'tests.test_backends.test_base.pre_filter'
+        pre_filter.return_value = action
+        shutdown_event = threading.Event()
+        queue_message = mock.MagicMock()
+        _, attributes = message.serialize()
+        consumer_backend.pull_messages = mock.MagicMock()
+        mock_return_once(consumer_backend.pull_messages, [queue_message], [], shutdown_event)
+        consumer_backend.message_attributes = mock.MagicMock(return_value=attributes)
+        consumer_backend.process_message = mock.MagicMock()
+        consumer_backend._quarantine_message = mock.MagicMock()
+        consumer_backend.ack_message = mock.MagicMock()
+
+        with mock.patch(
+            'hedwig.validators.base.HedwigBaseValidator._decode_message_type',
+            autospec=True,
+            side_effect=HedwigBaseValidator._decode_message_type,
+        ) as mock_decode:
+            consumer_backend.fetch_and_process_messages(shutdown_event=shutdown_event)
+            consumer_backend._pre_filter(attributes)
+            # decoded schemas are cached
+            mock_decode.assert_called_once_with(mock.ANY, attributes['hedwig_schema'])
+
+        pre_filter.assert_called_with(message_type=message.type, version=message.version, headers=message.headers)
+        consumer_backend.ack_message.assert_called_once_with(queue_message)
+        if action is PreFilterAction.PROCESS:
+            consumer_backend.process_message.assert_called_once_with(queue_message)
+        else:
+            consumer_backend.process_message.assert_not_called()
+        if action is PreFilterAction.DEAD_LETTER:
+            consumer_backend._quarantine_message.assert_called_once_with(
+                queue_message, f'Rejected by pre filter: {attributes["hedwig_schema"]}'
+            )
+        else:
+            consumer_backend._quarantine_message.assert_not_called()
+
+    def test_pre_filter_invalid_schema(self, consumer_backend, settings, message):
+        settings.HEDWIG_PRE_FILTER = 'tests.test_backends.test_base.pre_filter'
+        _, attributes = message.serialize()
+
+        assert consumer_backend._pre_filter({**attributes, 'hedwig_schema': 'invalid'}) is PreFilterAction.PROCESS
+        assert consumer_backend._pre_filter({}) is PreFilterAction.PROCESS
+        pre_filter.assert_not_called()
+
+    def test_pre_filter_without_transport_attributes(self, consumer_backend, settings, message):
+        settings.HEDWIG_PRE_FILTER = 'tests.test_backends.test_base.pre_filter'
+        settings.HEDWIG_USE_TRANSPORT_MESSAGE_ATTRIBUTES = False
+        _, attributes = message.serialize()
+
+        assert consumer_backend._pre_filter(attributes) is PreFilterAction.PROCESS
+        pre_filter.assert_not_called()
+
+    @pytest.mark.parametrize(
+        'ttl_settings,expired',
+        [
+            ({}, False),
+            ({'HEDWIG_DEFAULT_MESSAGE_TTL_S': 60}, True),
+            ({'HEDWIG_DEFAULT_MESSAGE_TTL_S': 120}, False),
+            ({'HEDWIG_MESSAGE_TTL_S': {('trip_created', '1.*'): 60}}, True),
+            (
+                {
+                    'HEDWIG_MESSAGE_TTL_S': {('trip_created', '1.*'): 60},
+                    'HEDWIG_USE_TRANSPORT_MESSAGE_ATTRIBUTES': False,
+                },
+                False,
+            ),
+            ({'HEDWIG_MESSAGE_TTL_S': {('vehicle_created', '1.*'): 60}, 'HEDWIG_DEFAULT_MESSAGE_TTL_S': 120}, False),
+        ],
+    )
+    def test_expired_message(self, consumer_backend, settings, message_factory, ttl_settings, expired):
+        for name, value in ttl_settings.items():
+            setattr(settings, name, value)
+        message = message_factory(msg_type=MessageType.trip_created, model_version=1)
+        _, attributes = message.serialize()
+        shutdown_event = threading.Event()
+        queue_message = mock.MagicMock()
+        consumer_backend.pull_messages = mock.MagicMock()
+        mock_return_once(consumer_backend.pull_messages, [queue_message], [], shutdown_event)
+        consumer_backend.message_attributes = mock.MagicMock(return_value=attributes)
+        consumer_backend.process_message = mock.MagicMock()
+        consumer_backend.ack_message = mock.MagicMock()
+
+        with mock.patch('hedwig.backends.base.time.time', return_value=message.timestamp / 1000 + 90):
+            consumer_backend.fetch_and_process_messages(shutdown_event=shutdown_event)
+
+        consumer_backend.ack_message.assert_called_once_with(queue_message)
+        assert consumer_backend.process_message.called is not expired
+        assert consumer_backend.expired_count == int(expired)
+
+    @pytest.mark.parametrize('message_types', [None, [('trip_created', '1.*')], [('vehicle_created', '1.*')]])
+    def test_load_shedding(self, consumer_backend, settings, message_factory, message_types):
+        settings.HEDWIG_LOAD_SHEDDING = LoadShedding(backlog_age_s=600, max_age_s=60, message_types=message_types)
+        message = message_factory(msg_type=MessageType.trip_created, model_version=1)
+        _, attributes = message.serialize()
+        published_at = message.timestamp / 1000
+        sheddable = message_types is None or ('trip_created', '1.*') in message_types
+
+        # message age in seconds, and whether it's dropped
+        ages = [(300, False), (600, sheddable), (300, sheddable), (60, False), (300, False)]
+        for age_s, expired in ages:
+            with mock.patch('hedwig.backends.base.time.time', return_value=published_at + age_s):
+                assert consumer_backend._is_expired(mock.MagicMock(), attributes) is expired
+
+    def test_bulkhead(self, consumer_backend, settings, message_factory):
+        settings.HEDWIG_BULKHEADS = {('trip_created', '1.*'): Bulkhead(name='trips', max_concurrency=1, max_pending=1)}
+        trip_created = message_factory(msg_type=MessageType.trip_created, model_version=1).serialize()[1]
+        device_created = message_factory(msg_type=MessageType.device_created, model_version=1).serialize()[1]
+        queue_messages = [mock.MagicMock(attributes=attributes) for attributes in [trip_created] * 3 + [device_created]]
+        shutdown_event = threading.Event()
+        consumer_backend.pull_messages = mock.MagicMock()
+        mock_return_once(consumer_backend.pull_messages, queue_messages, [], shutdown_event)
+        consumer_backend.message_attributes = lambda queue_message: queue_message.attributes
+        consumer_backend.ack_message = mock.MagicMock()
+        consumer_backend.nack_message = mock.MagicMock()
+        release = threading.Event()
+        thread_names = {}
+
+        def process_message(queue_message):
+            thread_names[queue_message] = threading.current_thread().name
+            if queue_message is queue_messages[0]:
+                # slow callback holds up its bulkhead, but not other message types
+                assert release.wait(timeout=5)
+
+        consumer_backend.process_message = mock.MagicMock(side_effect=process_message)
+        consumer_backend.nack_message.side_effect = lambda _: release.set()
+
+        consumer_backend.fetch_and_process_messages(shutdown_event=shutdown_event)
+
+        # one message running, one pending, the third is nacked
+        consumer_backend.nack_message.assert_called_once_with(queue_messages[2])
+        consumer_backend.ack_message.assert_has_calls(
+            [mock.call(queue_messages[0]), mock.call(queue_messages[1]), mock.call(queue_messages[3])], any_order=True
+        )
+        assert consumer_backend.ack_message.call_count == 3
+        assert thread_names[queue_messages[0]].startswith('hedwig-trips')
+        assert thread_names[queue_messages[1]].startswith('hedwig-trips')
+        assert thread_names[queue_messages[3]] == threading.current_thread().name
+        assert consumer_backend._bulkheads == {}
+
+    @pytest.mark.parametrize('lease_s', [None, 0, 60])
+    def test_bulkhead_queued_message_lease(self, consumer_backend, settings, message_factory, lease_s):
+        settings.HEDWIG_BULKHEADS = {('trip_created', '1.*'): Bulkhead(name='trips', max_concurrency=1, max_pending=1)}
+        attributes = message_factory(msg_type=MessageType.trip_created, model_version=1).serialize()[1]
+        queue_messages = [mock.MagicMock(attributes=attributes) for _ in range(2)]
+        shutdown_event = threading.Event()
+        consumer_backend.pull_messages = mock.MagicMock()
+        mock_return_once(consumer_backend.pull_messages, queue_messages, [], shutdown_event)
+        consumer_backend.message_attributes = lambda queue_message: queue_message.attributes
+        consumer_backend.ack_message = mock.MagicMock()
+        release = threading.Event()
+        processed = []
+
+        def extend_lease(queue_message):
+            release.set()
+            return lease_s
+
+        def process_message(queue_message):
+            # hold up the only thread until the second message is queued
+            assert release.wait(timeout=5)
+            processed.append(queue_message)
+
+        consumer_backend._extend_queued_message_lease = mock.MagicMock(side_effect=extend_lease)
+        consumer_backend.process_message = mock.MagicMock(side_effect=process_message)
+
+        with mock.patch('hedwig.backends.base.log'):
+            consumer_backend.fetch_and_process_messages(shutdown_event=shutdown_event)
+
+        if lease_s == 0:
+            # lease expired while it waited, so the message is left to be redelivered
+            assert processed == [queue_messages[0]]
+            consumer_backend._extend_queued_message_lease.assert_called_once_with(queue_messages[1])
+        else:
+            assert processed == queue_messages
+            # extended when queued, and renewed when a thread picks it up
+            calls = 1 if lease_s is None else 2
+            assert (
+                consumer_backend._extend_queued_message_lease.call_args_list == [mock.call(queue_messages[1])] * calls
+            )
+        consumer_backend.ack_message.assert_has_calls([mock.call(queue_message) for queue_message in processed])
+
+    def test_current_message_is_thread_local(self, consumer_backend, message):
+        consumer_backend._message = message
+        messages = []
+        thread = threading.Thread(target=lambda: messages.append(consumer_backend._message))
+        thread.start()
+        thread.join()
+
+        assert messages == [None]
+        assert consumer_backend._message is message
+
+    @mock.patch('hedwig.backends.base.Message.exec_callback', autospec=True)
+    def test_skips_processed_messages(self, mock_exec_callback, consumer_backend, settings, message):
+        settings.HEDWIG_DEDUP_STORE_CLASS = 'hedwig.dedup.InMemoryDedupStore'
+        shutdown_event = threading.Event()
+        queue_messages = [mock.MagicMock(), mock.MagicMock()]
+        consumer_backend.pull_messages = mock.MagicMock()
+        mock_return_once(consumer_backend.pull_messages, queue_messages, [], shutdown_event)
+        consumer_backend.process_message = lambda _: consumer_backend.message_handler(*message.serialize(), None)
+        consumer_backend.ack_message = mock.MagicMock()
+
+        consumer_backend.fetch_and_process_messages(shutdown_event=shutdown_event)
+
+        mock_exec_callback.assert_called_once()
+        consumer_backend.ack_message.assert_has_calls([mock.call(queue_message) for queue_message in queue_messages])
+        assert consumer_backend._dedup_store.seen(message.id)
+
+    @mock.patch('hedwig.backends.base.Message.exec_callback', autospec=True)
+    def test_failed_messages_are_not_recorded(self, mock_exec_callback, consumer_backend, settings, message):
+        settings.HEDWIG_DEDUP_STORE_CLASS = 'hedwig.dedup.InMemoryDedupStore'
+        mock_exec_callback.side_effect = RetryException
+        shutdown_event = threading.Event()
+        consumer_backend.pull_messages = mock.MagicMock()
+        mock_return_once(consumer_backend.pull_messages, [mock.MagicMock()], [], shutdown_event)
+        consumer_backend.process_message = lambda _: consumer_backend.message_handler(*message.serialize(), None)
+        consumer_backend.nack_message = mock.MagicMock()
+
+        consumer_backend.fetch_and_process_messages(shutdown_event=shutdown_event)
+
+        assert not consumer_backend._dedup_store.seen(message.id)
+
     def test_handling_exception_increase_error_count(self, consumer_backend):
         shutdown_event = threading.Event()
         queue_message = mock.MagicMock()
@@ -300,6 +798,24 @@ class TestFetchAndProcessMessages:
         heartbeat_hook.assert_called_once_with(error_count=0)
 
 
+pre_filter = mock.MagicMock()
+
+
+@pytest.fixture(autouse=True)
+def _reset_pre_filter():
+    yield
+    pre_filter.reset_mock()
+
+
+@pytest.mark.parametrize('registered,action', [(True, PreFilterAction.PROCESS), (False, PreFilterAction.SKIP)])
+def test_callbacks_pre_filter(message, registered, action):
+    with mock.patch('hedwig.callback.Callback.find_by_message', autospec=True) as mock_find_by_message:
+        if not registered:
+            mock_find_by_message.side_effect = CallbackNotFound(message.type, message.major_version)
+        assert callbacks_pre_filter(message.type, message.version, {}) is action
+        mock_find_by_message.assert_called_once_with(message.type, message.major_version)
+
+
 default_headers = mock.MagicMock(return_value={'mickey': 'mouse'})
 
 
@@ -355,3 +871,45 @@ class TestPublisher:
                 **default_headers_hook.return_value,
             }
             assert mock_publisher_backend._publish.call_args[0][2] == attributes
+
+    @mock.patch('hedwig.backends.base.Message.exec_callback', autospec=True)
+    def test_sync_mode(self, mock_exec_callback, message, mock_publisher_backend, prepost_process_hooks, settings):
+        settings.HEDWIG_SYNC = True
+        settings.HEDWIG_CONSUMER_BACKEND = 'tests.MockHedwigConsumerBackend'
+        metadata = SyncMetadata(mock_publisher_backend.topic(message))
+
+        mock_publisher_backend.publish(message)
+
+        mock_publisher_backend._publish.assert_not_called()
+        mock_exec_callback.assert_called_once_with(message.with_provider_metadata(metadata))
+        pre_process_hook.assert_called_once_with()
+        post_process_hook.assert_called_once_with()
+
+    @mock.patch('hedwig.dedup.InMemoryDedupStore.seen', autospec=True, return_value=True)
+    @mock.patch('hedwig.backends.base.Message.exec_callback', autospec=True)
+    def test_sync_mode_skips_consumer_stages(
+        self, mock_exec_callback, mock_seen, message, mock_publisher_backend, settings
+    ):
+        settings.HEDWIG_SYNC = True
+        settings.HEDWIG_CONSUMER_BACKEND = 'tests.MockHedwigConsumerBackend'
+        settings.HEDWIG_GLOBAL_RATE_LIMIT = RateLimit(rate=0.01, burst=1, max_wait_s=0)
+        settings.HEDWIG_RATE_LIMITS = {(message.type, f'{message.major_version}.*'): RateLimit(rate=0.01, burst=1)}
+        settings.HEDWIG_DEDUP_STORE_CLASS = 'hedwig.dedup.InMemoryDedupStore'
+        settings.HEDWIG_VISIBILITY_TIMEOUT_S = 30
+
+        with mock.patch.object(MockHedwigConsumerBackend, 'extend_visibility_timeout') as mock_extend:
+            mock_publisher_backend.publish(message)
+            mock_publisher_backend.publish(message)
+
+        assert mock_exec_callback.call_count == 2
+        mock_seen.assert_not_called()
+        mock_extend.assert_not_called()
+
+    def test_sync_metadata(self):
+        metadata = SyncMetadata('dev-trip-created-v1')
+
+        assert metadata == SyncMetadata('dev-trip-created-v1', delivery_attempt=1)
+        assert metadata != SyncMetadata('dev-trip-created-v2')
+        assert repr(metadata) == "SyncMetadata(topic='dev-trip-created-v1', delivery_attempt=1)"
+        with pytest.raises(AttributeError):
+            metadata.extra = 1  # type: ignore[attr-defined]
@@ -1,4 +1,8 @@
+import logging
+import os
+import queue
 import threading
+from concurrent.futures import Future
 from datetime import datetime, timedelta, timezone
 from unittest import mock
 
@@ -6,7 +10,9 @@ import freezegun
 import pytest
 
 try:
-    from google.cloud.pubsub_v1.types import FlowControl
+    from google.cloud.pubsub_v1.subscriber._protocol import requests as subscriber_requests
+    from google.cloud.pubsub_v1.subscriber.message import Message as StreamingPullMessage
+    from google.cloud.pubsub_v1.types import FlowControl, PubsubMessage
 except ImportError:
     pass
 
@@ -15,8 +21,11 @@ try:
     from tests.utils.gcp import build_gcp_queue_message, build_gcp_received_message
 except ImportError:
     pass
+from hedwig.backends.base import RetryBackoff, SyncMetadata
+from hedwig.backends.exceptions import PublisherOverloaded
 from hedwig.conf import settings
 from hedwig.exceptions import ValidationError, CallbackNotFound
+from hedwig.models import Message
 
 from tests.models import MessageType
 
@@ -60,7 +69,7 @@ class TestPubSubPublisher:
             payload = payload.encode('utf8')
             attributes["hedwig_encoding"] = 'utf8'
 
-        mock_pubsub_v1.PublisherClient.assert_called_once_with(batch_settings=())
+        mock_pubsub_v1.PublisherClient.assert_called_once_with(batch_settings=(), publisher_options=())
         gcp_publisher.publisher.topic_path.assert_called_once_with(
             gcp_settings.GOOGLE_CLOUD_PROJECT, f'hedwig-{gcp_publisher.topic(message)}'
         )
@@ -80,24 +89,132 @@ class TestPubSubPublisher:
             payload = payload.encode('utf8')
             attributes["hedwig_encoding"] = 'utf8'
 
-        mock_pubsub_v1.PublisherClient.assert_called_once_with(batch_settings=())
+        mock_pubsub_v1.PublisherClient.assert_called_once_with(batch_settings=(), publisher_options=())
         gcp_publisher.publisher.topic_path.assert_called_once_with(
             gcp_settings.GOOGLE_CLOUD_PROJECT, f'hedwig-{gcp_publisher.topic(message)}'
         )
         gcp_publisher.publisher.publish.assert_called_once_with("dummy_topic_path", data=payload, **attributes)
 
+    def test_in_flight_tracking(self, mock_pubsub_v1, message, gcp_settings):
+        gcp_publisher = gcp.GooglePubSubAsyncPublisherBackend()
+        publish_future: Future = Future()
+        gcp_publisher.publisher.publish.return_value = publish_future
+
+        future = gcp_publisher.publish(message)
+
+        assert future is publish_future
+        assert gcp_publisher.in_flight_messages == 1
+        assert gcp_publisher.in_flight_bytes > 0
+        assert gcp_publisher.flush(timeout=0) is False
+
+        publish_future.set_result('message-id')
+
+        assert gcp_publisher.in_flight_messages == 0
+        assert gcp_publisher.in_flight_bytes == 0
+        assert gcp_publisher.flush(timeout=0) is True
+
+    def test_in_flight_publish_error(self, mock_pubsub_v1, message, gcp_settings):
+        gcp_publisher = gcp.GooglePubSubAsyncPublisherBackend()
+        gcp_publisher.publisher.publish.side_effect = ValueError
+
+        with pytest.raises(ValueError):
+            gcp_publisher.publish(message)
+
+        assert gcp_publisher.in_flight_messages == 0
+
+    def test_in_flight_limit_raise(self, mock_pubsub_v1, message, gcp_settings):
+        gcp_settings.HEDWIG_PUBLISHER_GCP_IN_FLIGHT_LIMITS = gcp.InFlightLimits(
+            max_messages=1, overflow=gcp.OverflowBehavior.RAISE
+        )
+        gcp_publisher = gcp.GooglePubSubAsyncPublisherBackend()
+        gcp_publisher.publisher.publish.side_effect = lambda *args, **kwargs: Future()
+        gcp_publisher.publish(message)
+
+        with pytest.raises(PublisherOverloaded):
+            gcp_publisher.publish(message)
+
+        assert gcp_publisher.publisher.publish.call_count == 1
+
+    def test_in_flight_limit_drop(self, mock_pubsub_v1, message, gcp_settings):
+        gcp_settings.HEDWIG_PUBLISHER_GCP_IN_FLIGHT_LIMITS = gcp.InFlightLimits(
+            max_bytes=1, overflow=gcp.OverflowBehavior.DROP
+        )
+        gcp_publisher = gcp.GooglePubSubAsyncPublisherBackend()
+        gcp_publisher.publisher.publish.side_effect = lambda *args, **kwargs: Future()
+        # a single message larger than the limit is still published
+        gcp_publisher.publish(message)
+
+        future = gcp_publisher.publish(message)
+
+        assert isinstance(future.exception(), PublisherOverloaded)
+        assert gcp_publisher.dropped_count == 1
+        assert gcp_publisher.in_flight_messages == 1
+
+    def test_in_flight_limit_block(self, mock_pubsub_v1, message, gcp_settings):
+        gcp_settings.HEDWIG_PUBLISHER_GCP_IN_FLIGHT_LIMITS = gcp.InFlightLimits(max_messages=1)
+        gcp_publisher = gcp.GooglePubSubAsyncPublisherBackend()
+        first_future: Future = Future()
+        gcp_publisher.publisher.publish.side_effect = [first_future, Future()]
+        gcp_publisher.publish(message)
+        timer = threading.Timer(0.05, first_future.set_result, args=('message-id',))
+        timer.start()
+
+        gcp_publisher.publish(message)
+
+        timer.join()
+        assert gcp_publisher.publisher.publish.call_count == 2
+        assert gcp_publisher.in_flight_messages == 1
+
+    def test_in_flight_limit_block_timeout(self, mock_pubsub_v1, message, gcp_settings):
+        gcp_settings.HEDWIG_PUBLISHER_GCP_IN_FLIGHT_LIMITS = gcp.InFlightLimits(max_messages=1, block_timeout_s=0.01)
+        gcp_publisher = gcp.GooglePubSubAsyncPublisherBackend()
+        gcp_publisher.publisher.publish.side_effect = lambda *args, **kwargs: Future()
+        gcp_publisher.publish(message)
+
+        with pytest.raises(PublisherOverloaded):
+            gcp_publisher.publish(message)
+
+    def test_flushes_before_fork(self, mock_pubsub_v1, message, gcp_settings):
+        gcp_publisher = gcp.GooglePubSubAsyncPublisherBackend()
+        publish_future: Future = Future()
+        gcp_publisher.publisher.publish.return_value = publish_future
+        gcp_publisher.publish(message)
+        timer = threading.Timer(0.05, publish_future.set_result, args=('message-id',))
+        timer.start()
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        assert publish_future.done()
+        assert gcp_publisher.in_flight_messages == 0
+
+    def test_flush_on_exit_and_fork_timeout(self, mock_pubsub_v1, message, gcp_settings):
+        gcp_publisher = gcp.GooglePubSubAsyncPublisherBackend()
+        publish_future: Future = Future()
+        gcp_publisher.publisher.publish.return_value = publish_future
+        gcp_publisher.publish(message)
+
+        with mock.patch('hedwig.backends.gcp.log') as logging_mock:
+            gcp_publisher._flush_on_exit_and_fork(0.01)
+
+        logging_mock.assert_called_once_with(
+            'hedwig.backends.gcp',
+            logging.WARNING,
+            'Messages still in flight after flush timeout',
+            extra={'in_flight_messages': 1},
+        )
+        publish_future.set_result('message-id')
+
     @freezegun.freeze_time()
     @mock.patch('tests.handlers._trip_created_handler', autospec=True)
     def test_sync_mode(self, callback_mock, mock_pubsub_v1, message, mock_publisher_backend, gcp_settings):
         gcp_settings.HEDWIG_SYNC = True
 
-        receipt = 'test-receipt'
-        publish_time = datetime.now(timezone.utc)
-        delivery_attempt = 1
-
         message.publish()
         callback_mock.assert_called_once_with(
-            message.with_provider_metadata(GoogleMetadata(receipt, 'test-subscription', publish_time, delivery_attempt))
+            message.with_provider_metadata(SyncMetadata(gcp.GooglePubSubPublisherBackend.topic(message)))
         )
 
     def test_sync_mode_detects_invalid_callback(self, gcp_settings, mock_pubsub_v1, message_factory):
@@ -313,6 +430,111 @@ class TestGCPConsumer:
             subscription=subscription_path, ack_ids=[queue_message.ack_id]
         )
 
+    def test_quarantine_message(self, gcp_consumer):
+        queue_message = mock.MagicMock()
+        queue_message.message.attributes = {'hedwig_id': '123'}
+
+        gcp_consumer._quarantine_message(queue_message, 'Invalid message body')
+
+        gcp_consumer.publisher.publish.assert_called_once_with(
+            gcp_consumer._dlq_topic_path,
+            data=queue_message.message.data,
+            hedwig_id='123',
+            hedwig_error='Invalid message body',
+        )
+        gcp_consumer.publisher.publish.return_value.result.assert_called_once_with()
+
+    def test_nack_message_with_backoff(self, gcp_consumer, gcp_settings):
+        gcp_settings.HEDWIG_DEFAULT_RETRY_BACKOFF = RetryBackoff(initial_s=10, max_s=1000)
+        queue_message = mock.MagicMock()
+        queue_message.message.delivery_attempt = 3
+
+        gcp_consumer.nack_message(queue_message)
+
+        queue_message.message.modify_ack_deadline.assert_called_once_with(40)
+        queue_message.message.drop.assert_called_once_with()
+        queue_message.message.nack.assert_not_called()
+
+        # capped to max ack deadline
+        queue_message.message.delivery_attempt = 10
+        gcp_consumer.nack_message(queue_message)
+        queue_message.message.modify_ack_deadline.assert_called_with(600)
+
+    def test_nack_message_with_backoff_releases_lease(self, gcp_consumer, gcp_settings):
+        gcp_settings.HEDWIG_DEFAULT_RETRY_BACKOFF = RetryBackoff(initial_s=10, max_s=1000)
+        request_queue: queue.Queue = queue.Queue()
+        pubsub_message = PubsubMessage(data=b'{}', message_id='1', ordering_key='key')
+        queue_message = mock.MagicMock()
+        queue_message.message = StreamingPullMessage(pubsub_message._pb, 'ack-id', 1, request_queue)
+
+        gcp_consumer.nack_message(queue_message)
+
+        modack, drop = request_queue.get_nowait(), request_queue.get_nowait()
+        assert request_queue.empty()
+        assert isinstance(modack, subscriber_requests.ModAckRequest)
+        assert (modack.ack_id, modack.seconds) == ('ack-id', 10)
+        # dropped from the leaser, so the deadline isn't extended and the flow control slot is freed
+        assert drop == subscriber_requests.DropRequest('ack-id', queue_message.message.size, 'key')
+
+    def test_nack_message_without_backoff(self, gcp_consumer):
+        queue_message = mock.MagicMock()
+
+        gcp_consumer.nack_message(queue_message)
+
+        queue_message.message.nack.assert_called_once_with()
+        queue_message.message.modify_ack_deadline.assert_not_called()
+
+    def test_message_timestamp(self, gcp_consumer):
+        queue_message = mock.MagicMock()
+        queue_message.message.publish_time = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+        assert gcp_consumer._message_timestamp(queue_message, {'hedwig_message_timestamp': '1500000000000'}) == 1.5e9
+        # falls back to Pub/Sub publish time
+        assert gcp_consumer._message_timestamp(queue_message, {}) == 1609459200
+
+    def test_decode_dead_letter(self, mock_pubsub_v1, message):
+        gcp_consumer = gcp.GooglePubSubConsumerBackend(dlq=True)
+        queue_message = build_gcp_received_message(message)
+
+        message_id, payload, attributes = gcp_consumer._decode_dead_letter(queue_message)
+
+        assert message_id == queue_message.message.message_id
+        assert Message.deserialize(payload, attributes, None).id == message.id
+
+    @pytest.mark.parametrize('raised', [False, True], ids=['failed-future', 'raised'])
+    def test_requeue_dead_letter_batches(self, mock_pubsub_v1, message_factory, gcp_settings, raised):
+        gcp_settings.GOOGLE_PUBSUB_REQUEUE_CONCURRENCY = 2
+        gcp_consumer = gcp.GooglePubSubConsumerBackend(dlq=True)
+        subscription_path = gcp_consumer._subscription_paths[0]
+
+        queue_messages = [
+            build_gcp_received_message(message_factory(msg_type=MessageType.trip_created)) for _ in range(3)
+        ]
+        for i, queue_message in enumerate(queue_messages):
+            queue_message.ack_id = f"ack_id_{i}"
+        response = mock.MagicMock()
+        response.received_messages = queue_messages
+        empty_response = mock.MagicMock()
+        empty_response.received_messages = []
+        # one batch, then each worker finds the DLQ empty
+        gcp_consumer.subscriber.pull.side_effect = iter([response, empty_response, empty_response])
+        failed_future = Future()
+        failed_future.set_exception(RuntimeError("publish failed"))
+        failure = RuntimeError("publish failed") if raised else failed_future
+        gcp_consumer.publisher.publish.side_effect = [mock.MagicMock(), failure, mock.MagicMock()]
+
+        gcp_consumer.requeue_dead_letter(num_messages=3, visibility_timeout=4)
+
+        assert gcp_consumer.subscriber.pull.call_count == 3
+        gcp_consumer.subscriber.modify_ack_deadline.assert_called_once_with(
+            subscription=subscription_path, ack_ids=["ack_id_0", "ack_id_1", "ack_id_2"], ack_deadline_seconds=4
+        )
+        assert gcp_consumer._publisher.publish.call_count == 3
+        # failed message is left in DLQ
+        gcp_consumer.subscriber.acknowledge.assert_called_once_with(
+            subscription=subscription_path, ack_ids=["ack_id_0", "ack_id_2"]
+        )
+
     def test_fetch_and_process_messages_success(
         self,
         gcp_consumer,
@@ -371,3 +593,78 @@ class TestGCPConsumer:
         pre_process_hook.assert_called_once_with(google_pubsub_message=queue_message)
         post_process_hook.assert_called_once_with(google_pubsub_message=queue_message)
         heartbeat_hook.assert_called_once_with(error_count=0)
+
+
+class TestClientTransport:
+    @pytest.fixture(autouse=True)
+    def reset_shared_channels(self):
+        yield
+        gcp._shared_channels.clear()
+
+    def test_default_transport(self):
+        assert gcp._client_kwargs(mock.Mock()) == {}
+
+    def test_default_transport_with_emulator(self, settings):
+        settings.GOOGLE_PUBSUB_SHARED_CHANNEL = True
+        with mock.patch.dict('os.environ', {'PUBSUB_EMULATOR_HOST': 'localhost:8085'}):
+            assert gcp._client_kwargs(mock.Mock()) == {}
+
+    def test_channel_options(self, settings):
+        settings.GOOGLE_PUBSUB_GRPC_OPTIONS = [('grpc.keepalive_time_ms', 60000), ('grpc.enable_retries', 0)]
+        settings.GOOGLE_PUBSUB_GRPC_COMPRESSION = 'gzip'
+        transport_class = mock.Mock()
+
+        kwargs = gcp._client_kwargs(transport_class)
+        channel_init = transport_class.call_args[1]['channel']
+        channel = channel_init('pubsub.googleapis.com', credentials=None, options=[('grpc.max_metadata_size', 1024)])
+
+        assert kwargs == {'transport': transport_class.return_value}
+        assert channel == transport_class.create_channel.return_value
+        transport_class.create_channel.assert_called_once_with(
+            'pubsub.googleapis.com',
+            options=[
+                ('grpc.max_send_message_length', -1),
+                ('grpc.max_receive_message_length', -1),
+                ('grpc.max_metadata_size', 1024),
+                ('grpc.keepalive_time_ms', 60000),
+                ('grpc.enable_retries', 0),
+            ],
+            credentials=None,
+            compression=gcp.grpc.Compression.Gzip,
+        )
+
+    def test_shared_channel(self, settings):
+        settings.GOOGLE_PUBSUB_SHARED_CHANNEL = True
+        publisher_transport_class = mock.Mock()
+        subscriber_transport_class = mock.Mock()
+
+        gcp._client_kwargs(publisher_transport_class)
+        gcp._client_kwargs(subscriber_transport_class)
+        publisher_channel = publisher_transport_class.call_args[1]['channel']('pubsub.googleapis.com')
+        subscriber_channel = subscriber_transport_class.call_args[1]['channel']('pubsub.googleapis.com')
+
+        assert publisher_channel is subscriber_channel
+        publisher_transport_class.create_channel.assert_called_once()
+        subscriber_transport_class.create_channel.assert_not_called()
+
+    def test_shared_channel_reset_after_fork(self, settings):
+        settings.GOOGLE_PUBSUB_SHARED_CHANNEL = True
+        transport_class = mock.Mock()
+        transport_class.create_channel.side_effect = lambda *args, **kwargs: mock.Mock()
+        gcp._client_kwargs(transport_class)
+        channel_init = transport_class.call_args[1]['channel']
+        channel = channel_init('pubsub.googleapis.com')
+
+        gcp._reset_shared_channels_after_fork()
+
+        assert channel_init('pubsub.googleapis.com') is not channel
+
+    def test_clients_use_transport(self, mock_pubsub_v1, settings):
+        settings.GOOGLE_PUBSUB_SHARED_CHANNEL = True
+        with mock.patch('hedwig.backends.gcp.PublisherGrpcTransport', autospec=True) as transport_class:
+            gcp_publisher = gcp.GooglePubSubPublisherBackend()
+            gcp_publisher.publisher
+
+        mock_pubsub_v1.PublisherClient.assert_called_once_with(
+            batch_settings=(), publisher_options=(), transport=transport_class.return_value
+        )
@@ -1,16 +1,21 @@
 import base64
 import threading
-from time import sleep
+import zlib
+from time import sleep, time
 from unittest import mock
 
 import freezegun
 import pytest
+from redis.crc import key_slot
+from redis.exceptions import ResponseError
 
-from hedwig.commands import requeue_dead_letter
+from hedwig.backends.base import RateLimit, RetryBackoff, SyncMetadata
+from hedwig.commands import ReplayFilter, ReplayStats, replay_dead_letter, requeue_dead_letter
+from hedwig.conf import settings as hedwig_settings
 from hedwig.models import Message
 
 try:
-    from hedwig.backends.redis import RedisMetadata, RedisMessage
+    from hedwig.backends.redis import RedisMessage, RedisMetadata
 except ImportError:
     pass
 from hedwig.exceptions import ValidationError, CallbackNotFound
@@ -100,17 +105,38 @@ class TestPubSubPublisher:
         assert msg_id == message_id
         assert_redis_message_payload(message, msg_payload)
 
+    def test_publish_partitioned(self, message_factory, redis_client, redis_settings):
+        redis_settings.HEDWIG_REDIS_STREAM_PARTITIONS = {'dev-trip-created-v1': 4}
+        redis_settings.HEDWIG_REDIS_PARTITION_KEY_HEADER = 'trip_id'
+        redis_publisher = redis.RedisStreamsPublisherBackend()
+        messages = [
+            message_factory(msg_type=MessageType.trip_created, metadata__headers__trip_id="T_1") for _ in range(2)
+        ]
+        stream = f"hedwig:dev-trip-created-v1:{zlib.crc32(b'T_1') % 4}".encode()
+
+        try:
+            message_ids = [redis_publisher.publish(message) for message in messages]
+
+            resp = redis_client.xread(streams={stream: "0-0"})
+            assert [x[0] for x in resp[stream][0]] == message_ids
+        finally:
+            redis_client.delete(stream)
+
+    def test_publish_partitioned_by_message_id(self, message, redis_settings):
+        redis_settings.HEDWIG_REDIS_STREAM_PARTITIONS = {'dev-trip-created-v1': 4}
+        redis_publisher = redis.RedisStreamsPublisherBackend()
+
+        partition = zlib.crc32(message.id.encode()) % 4
+        assert redis_publisher._stream(message) == f"hedwig:dev-trip-created-v1:{partition}"
+
     @mock.patch('tests.handlers._trip_created_handler', autospec=True)
     def test_sync_mode(self, callback_mock, message_factory, redis_settings):
         redis_settings.HEDWIG_SYNC = True
-        publisher = redis.RedisStreamsPublisherBackend()
         message = message_factory(msg_type=MessageType.trip_created)
-        stream = f"hedwig:{publisher.topic(message)}"
-        message_id = "1739836800000-0"
 
         message.publish()
         callback_mock.assert_called_once_with(
-            message.with_provider_metadata(RedisMetadata(id=message_id, stream=stream, delivery_attempt=1))
+            message.with_provider_metadata(SyncMetadata(redis.RedisStreamsPublisherBackend.topic(message)))
         )
 
     def test_sync_mode_detects_invalid_callback(self, redis_settings, message_factory):
@@ -122,6 +148,59 @@ class TestPubSubPublisher:
         assert isinstance(exc_info.value.__context__, CallbackNotFound)
 
 
+class TestAsyncPublisher:
+    def test_publish_batch_max_messages(self, message_factory, redis_client, redis_settings):
+        redis_settings.HEDWIG_PUBLISHER_REDIS_BATCH_SETTINGS = redis.BatchSettings(max_messages=2, max_latency=60)
+        redis_publisher = redis.RedisStreamsAsyncPublisherBackend()
+        stream = b"hedwig:dev-trip-created-v1"
+
+        futures = [redis_publisher.publish(message_factory(msg_type=MessageType.trip_created)) for _ in range(3)]
+
+        # first batch is published right away, last message is still buffered
+        assert [f.done() for f in futures] == [True, True, False]
+        resp = redis_client.xread(streams={stream: "0-0"})
+        assert [x[0] for x in resp[stream][0]] == [f.result() for f in futures[:2]]
+
+        redis_publisher.flush()
+        assert futures[2].done()
+        resp = redis_client.xread(streams={stream: "0-0"})
+        assert [x[0] for x in resp[stream][0]] == [f.result() for f in futures]
+
+    def test_publish_batch_max_latency(self, message, redis_client, redis_settings):
+        redis_settings.HEDWIG_PUBLISHER_REDIS_BATCH_SETTINGS = redis.BatchSettings(max_messages=100, max_latency=0.05)
+        redis_publisher = redis.RedisStreamsAsyncPublisherBackend()
+
+        future = redis_publisher.publish(message)
+
+        message_id = future.result(timeout=1)
+        stream = b"hedwig:dev-trip-created-v1"
+        resp = redis_client.xread(streams={stream: "0-0"})
+        msg_id, msg_payload = resp[stream][0][0]
+        assert msg_id == message_id
+        assert_redis_message_payload(message, msg_payload)
+
+    def test_publish_batch_failure(self, message_factory, redis_client, redis_settings):
+        redis_settings.HEDWIG_MESSAGE_ROUTING = {
+            **redis_settings.HEDWIG_MESSAGE_ROUTING,
+            ('device.created', '1.*'): 'dev-not-a-stream',
+        }
+        redis_publisher = redis.RedisStreamsAsyncPublisherBackend()
+        redis_client.set("hedwig:dev-not-a-stream", "value")
+
+        try:
+            futures = [
+                redis_publisher.publish(message_factory(msg_type=MessageType.trip_created)),
+                redis_publisher.publish(message_factory(msg_type=MessageType.device_created)),
+            ]
+            redis_publisher.flush()
+
+            assert futures[0].result()
+            with pytest.raises(ResponseError):
+                futures[1].result()
+        finally:
+            redis_client.delete("hedwig:dev-not-a-stream")
+
+
 pre_process_hook = mock.MagicMock()
 post_process_hook = mock.MagicMock()
 heartbeat_hook = mock.MagicMock()
@@ -181,6 +260,69 @@ class TestRedisConsumer:
         items = list(redis_consumer.pull_messages(num_messages=1))
         assert len(items) == 0
 
+    def test_pull_messages_partitioned(self, message_factory, redis_client, redis_settings):
+        redis_settings.HEDWIG_REDIS_STREAM_PARTITIONS = {'dev-trip-created-v1': 4}
+        redis_settings.HEDWIG_REDIS_PARTITION_KEY_HEADER = 'trip_id'
+        redis_settings.HEDWIG_REDIS_PARTITION_ASSIGNMENT = (1, 2)
+        partition_streams = [f"hedwig:dev-trip-created-v1:{partition}" for partition in range(4)]
+        for stream in partition_streams:
+            redis_client.xgroup_create(name=stream, groupname=redis_settings.HEDWIG_QUEUE, mkstream=True)
+        # pick keys that hash to an owned and a not-owned partition
+        owned_key = next(f"T_{i}" for i in range(100) if zlib.crc32(f"T_{i}".encode()) % 4 == 3)
+        other_key = next(f"T_{i}" for i in range(100) if zlib.crc32(f"T_{i}".encode()) % 4 == 0)
+
+        try:
+            redis_consumer = redis.RedisStreamsConsumerBackend()
+            assert redis_consumer._streams == [partition_streams[1], partition_streams[3], 'hedwig:dev:myapp']
+
+            owned_message_id = message_factory(
+                msg_type=MessageType.trip_created, metadata__headers__trip_id=owned_key
+            ).publish()
+            message_factory(msg_type=MessageType.trip_created, metadata__headers__trip_id=other_key).publish()
+
+            items = list(redis_consumer.pull_messages(num_messages=10))
+            assert [(x.stream, x.key) for x in items] == [(partition_streams[3].encode(), owned_message_id)]
+        finally:
+            for stream in partition_streams:
+                redis_client.delete(stream)
+
+    def test_message_timestamp(self):
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        queue_message = RedisMessage(stream=b'stream', key=b'1609459200000-3', payload={}, delivery_attempt=1)
+
+        assert redis_consumer._message_timestamp(queue_message, {'hedwig_message_timestamp': '1500000000000'}) == 1.5e9
+        # falls back to time in entry id
+        assert redis_consumer._message_timestamp(queue_message, {}) == 1609459200
+
+    def test_expired_message_without_timestamp_attribute(self, message, redis_client, redis_settings):
+        redis_settings.HEDWIG_DEFAULT_MESSAGE_TTL_S = 60
+        payload, attributes = message.serialize()
+        del attributes['hedwig_message_timestamp']
+        redis_client.xadd(
+            'hedwig:dev-trip-created-v1',
+            redis.RedisStreamsPublisherBackend._redis_message(payload, attributes),
+            id=f'{int((time() - 120) * 1000)}-0',
+        )
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        (queue_message,) = redis_consumer.pull_messages(num_messages=1)
+
+        assert redis_consumer._is_expired(queue_message, redis_consumer.message_attributes(queue_message))
+
+    def test_nack_message_with_backoff(self, message, redis_settings):
+        redis_settings.HEDWIG_MAX_DELIVERY_ATTEMPTS = 3
+        redis_settings.HEDWIG_DEFAULT_RETRY_BACKOFF = RetryBackoff(initial_s=0.2, max_s=1)
+        message_id = message.publish()
+
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        items = list(redis_consumer.pull_messages(num_messages=1))
+        redis_consumer.nack_message(items[0])
+
+        # redelivered after backoff, well before visibility timeout
+        assert list(redis_consumer.pull_messages(num_messages=1)) == []
+        sleep(0.3)
+        items = list(redis_consumer.pull_messages(num_messages=1))
+        assert [(x.key, x.delivery_attempt) for x in items] == [(message_id, 2)]
+
     def test_pull_messages_with_expired_visibility_timeout(self, message, prepost_process_hooks, redis_settings):
         redis_settings.HEDWIG_VISIBILITY_TIMEOUT_S = 0.3
         redis_settings.HEDWIG_MAX_DELIVERY_ATTEMPTS = 3
@@ -211,6 +353,129 @@ class TestRedisConsumer:
         assert redis_message.delivery_attempt == 2
         heartbeat_hook.assert_called_once_with(error_count=0)
 
+    @pytest.mark.parametrize('wait_s, extended', [(10, True), (20, False)])
+    def test_extend_lease_for_wait(self, redis_settings, wait_s, extended):
+        redis_settings.HEDWIG_VISIBILITY_TIMEOUT_S = 30
+        redis_settings.HEDWIG_REDIS_AT_MOST_ONCE_SUBSCRIPTIONS = ["dev-trip-created-v1"]
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        redis_consumer.extend_visibility_timeout = mock.MagicMock()
+        metadata = RedisMetadata("1-0", "hedwig:dev-device-created-v1", 1)
+
+        assert redis_consumer._extend_lease_for_wait(metadata, wait_s) is extended
+
+        if extended:
+            redis_consumer.extend_visibility_timeout.assert_called_once_with(30, metadata)
+        else:
+            redis_consumer.extend_visibility_timeout.assert_not_called()
+        # at-most-once messages aren't leased
+        assert redis_consumer._extend_lease_for_wait(RedisMetadata("1-0", "hedwig:dev-trip-created-v1", 1), wait_s)
+
+    def test_extend_queued_message_lease(self, message, redis_settings):
+        redis_settings.HEDWIG_VISIBILITY_TIMEOUT_S = 0.5
+        redis_settings.HEDWIG_MAX_DELIVERY_ATTEMPTS = 3
+        message.publish()
+
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        [redis_message] = redis_consumer.pull_messages(num_messages=1)
+        sleep(0.3)
+        assert redis_consumer._extend_queued_message_lease(redis_message) == 0.5
+        sleep(0.3)
+
+        # still leased, since idle time was reset
+        assert list(redis.RedisStreamsConsumerBackend().pull_messages(num_messages=1)) == []
+
+    def test_pull_messages_reclaims_once_per_visibility_timeout(self, message, redis_client):
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        with mock.patch.object(redis_consumer, '_claim_script', wraps=redis_consumer._claim_script) as claim_script:
+            list(redis_consumer.pull_messages(num_messages=1))
+            list(redis_consumer.pull_messages(num_messages=1))
+
+        # a single call for all streams, and for the first pull only
+        claim_script.assert_called_once()
+        assert claim_script.call_args.kwargs['keys'] == [*redis_consumer._streams, redis_consumer._deadletter_stream]
+
+    def test_pull_messages_reclaim_resumes_from_cursor(self, message_factory, redis_settings):
+        redis_settings.HEDWIG_VISIBILITY_TIMEOUT_S = 0.3
+        redis_settings.HEDWIG_MAX_DELIVERY_ATTEMPTS = 3
+        message_ids = [message_factory(msg_type=MessageType.trip_created).publish() for _ in range(2)]
+
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        items = list(redis_consumer.pull_messages(num_messages=2))
+        assert len(items) == 2
+
+        sleep(0.5)
+        # new consumer claims one message per pull, second pull continues where the first one left off
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        items = list(redis_consumer.pull_messages(num_messages=1))
+        assert [x.key for x in items] == message_ids[:1]
+        assert redis_consumer._reclaim_cursors['hedwig:dev-trip-created-v1'] == message_ids[1]
+
+        items = list(redis_consumer.pull_messages(num_messages=1))
+        assert [x.key for x in items] == message_ids[1:]
+        assert items[0].delivery_attempt == 2
+        assert redis_consumer._reclaim_cursors['hedwig:dev-trip-created-v1'] == b"0-0"
+
+    def test_pull_messages_stable_consumer_name(self, message, redis_client, redis_settings):
+        redis_settings.HEDWIG_REDIS_CONSUMER_NAME = "host-1"
+        message_id = message.publish()
+
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        items = list(redis_consumer.pull_messages(num_messages=1))
+
+        assert len(items) == 1
+        pending = redis_client.xpending_range(
+            "hedwig:dev-trip-created-v1", redis_settings.HEDWIG_QUEUE, "-", "+", 10, consumername="host-1"
+        )
+        assert [x["message_id"] for x in pending] == [message_id]
+
+    @mock.patch('hedwig.backends.redis.socket.gethostname', autospec=True, return_value='host')
+    def test_consumer_name_template(self, _, redis_settings):
+        redis_settings.HEDWIG_REDIS_CONSUMER_NAME = "{hostname}-{worker_index}"
+        redis_settings.HEDWIG_WORKER_INDEX = 2
+
+        assert redis.RedisStreamsConsumerBackend()._consumer_id == "host-2"
+
+    def test_pull_messages_at_most_once(self, message, redis_client, redis_settings):
+        redis_settings.HEDWIG_REDIS_AT_MOST_ONCE_SUBSCRIPTIONS = ['dev-trip-created-v1']
+        message_id = message.publish()
+
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        with mock.patch.object(redis_consumer, '_claim_script', wraps=redis_consumer._claim_script) as claim_script:
+            items = list(redis_consumer.pull_messages(num_messages=1))
+
+        assert [x.key for x in items] == [message_id]
+        # at-most-once streams are never reclaimed
+        assert claim_script.call_args.kwargs['keys'] == ['hedwig:dev:myapp', redis_consumer._deadletter_stream]
+        # message isn't tracked in PEL, so acking is a no-op
+        assert redis_client.xpending("hedwig:dev-trip-created-v1", redis_settings.HEDWIG_QUEUE)["pending"] == 0
+        with mock.patch.object(redis_consumer._r, 'xack') as xack:
+            redis_consumer.ack_message(items[0])
+        xack.assert_not_called()
+
+    def test_pull_messages_removes_idle_consumers(self, message, redis_client, redis_settings):
+        redis_settings.HEDWIG_VISIBILITY_TIMEOUT_S = 0.1
+        redis_settings.HEDWIG_REDIS_CONSUMER_IDLE_TIMEOUT_S = 0.3
+        redis_settings.HEDWIG_MAX_DELIVERY_ATTEMPTS = 3
+        message_id = message.publish()
+
+        items = list(redis.RedisStreamsConsumerBackend().pull_messages(num_messages=1))
+        assert len(items) == 1
+
+        sleep(0.5)
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        items = list(redis_consumer.pull_messages(num_messages=1))
+
+        # message of the removed consumer is taken over, keeping its delivery count
+        assert [(x.key, x.delivery_attempt) for x in items] == [(message_id, 2)]
+        consumers = redis_client.xinfo_consumers("hedwig:dev-trip-created-v1", redis_settings.HEDWIG_QUEUE)
+        assert [x["name"] for x in consumers] == [redis_consumer._consumer_id.encode()]
+
+    def test_consumer_idle_timeout_must_exceed_visibility_timeout(self, redis_settings):
+        redis_settings.HEDWIG_REDIS_CONSUMER_IDLE_TIMEOUT_S = redis_settings.HEDWIG_VISIBILITY_TIMEOUT_S
+
+        with pytest.raises(AssertionError):
+            redis.RedisStreamsConsumerBackend()
+
     def test_pull_messages_and_move_to_dlq(self, message, prepost_process_hooks, redis_settings, redis_client):
         redis_settings.HEDWIG_VISIBILITY_TIMEOUT_S = 0.3
         # 2nd delivery attempt will be moved to dlq
@@ -313,6 +578,61 @@ class TestRedisConsumer:
         for _, msg_payload in entries[main_stream][0]:
             assert_redis_message_payload(message, msg_payload)
 
+    def test_replay_dead_letter(self, message_factory, redis_client, redis_settings):
+        dlq_stream = redis.RedisStreamsConsumerBackend(dlq=True)._deadletter_stream
+        main_stream = redis.RedisStreamsConsumerBackend()._main_stream
+        messages = [
+            message_factory(msg_type=MessageType.trip_created, metadata__headers__replay=str(i % 2)) for i in range(4)
+        ]
+        for message in messages:
+            redis_client.xadd(dlq_stream, redis.RedisStreamsPublisherBackend._redis_message(*message.serialize()))
+        # first two messages are pending, the rest are new
+        redis_client.xreadgroup(
+            groupname=redis_settings.HEDWIG_QUEUE, consumername="test-client", streams={dlq_stream: ">"}, count=2
+        )
+
+        stats = replay_dead_letter(ReplayFilter(headers={'replay': '1'}), num_messages=1)
+
+        assert stats == ReplayStats(pulled=4, matched=2, replayed=2)
+        entries = redis_client.xrange(main_stream)
+        assert len(entries) == 2
+        for (_, payload), message in zip(entries, [messages[1], messages[3]]):
+            assert_redis_message_payload(message, payload)
+        # skipped messages are left in DLQ
+        assert redis_client.xpending(dlq_stream, redis_settings.HEDWIG_QUEUE)["pending"] == 2
+
+    def test_replay_dead_letter_twice(self, message_factory, redis_client, redis_settings):
+        dlq_stream = redis.RedisStreamsConsumerBackend(dlq=True)._deadletter_stream
+        main_stream = redis.RedisStreamsConsumerBackend()._main_stream
+        messages = [
+            message_factory(msg_type=MessageType.trip_created, metadata__headers__replay=str(i)) for i in range(2)
+        ]
+        for message in messages:
+            redis_client.xadd(dlq_stream, redis.RedisStreamsPublisherBackend._redis_message(*message.serialize()))
+
+        assert replay_dead_letter(ReplayFilter(headers={'replay': '0'})) == ReplayStats(pulled=2, matched=1, replayed=1)
+        # skipped message is pending on the DLQ, and is pulled again by the next replay
+        assert replay_dead_letter(ReplayFilter(headers={'replay': '1'})) == ReplayStats(pulled=1, matched=1, replayed=1)
+
+        entries = redis_client.xrange(main_stream)
+        assert len(entries) == 2
+        for (_, payload), message in zip(entries, messages):
+            assert_redis_message_payload(message, payload)
+        assert redis_client.xpending(dlq_stream, redis_settings.HEDWIG_QUEUE)["pending"] == 0
+
+    @mock.patch('hedwig.callback.Callback.find_by_message', side_effect=CallbackNotFound)
+    def test_fetch_and_process_messages_quarantines_invalid_message(self, _, message, redis_client, redis_settings):
+        redis_settings.HEDWIG_QUARANTINE_INVALID_MESSAGES = True
+
+        _publish_and_consume_message(message)
+
+        dlq_entries = redis_client.xrange(f"hedwig:{redis_settings.HEDWIG_QUEUE}:dlq")
+        assert len(dlq_entries) == 1
+        payload = dlq_entries[0][1]
+        assert payload.pop(b"hedwig_error").startswith(b"CallbackNotFound")
+        assert_redis_message_payload(message, payload)
+        assert redis_client.xpending("hedwig:dev-trip-created-v1", redis_settings.HEDWIG_QUEUE)["pending"] == 0
+
     def test_fetch_and_process_messages_success(
         self, message_factory, redis_client, redis_settings, prepost_process_hooks
     ):
@@ -387,3 +707,112 @@ class TestRedisConsumer:
             message.extend_visibility_timeout(1000)
 
         assert "Visibility timeout is not configurable" in str(err.value)
+
+
+class TestRedisTokenBucket:
+    def test_reserve(self, redis_client):
+        # left by earlier runs until it expires
+        redis_client.delete("hedwig:dev:myapp:ratelimit:trip_created:1")
+        bucket = redis.RedisTokenBucket('trip_created:1', RateLimit(rate=0.1, burst=2))
+        other_consumer_bucket = redis.RedisTokenBucket('trip_created:1', RateLimit(rate=0.1, burst=2))
+
+        assert bucket.reserve(0) == (True, 0)
+        assert other_consumer_bucket.reserve(0) == (True, 0)
+        reserved, wait_s = bucket.reserve(0)
+        assert not reserved
+        assert wait_s == pytest.approx(10, abs=0.1)
+        assert redis_client.ttl("hedwig:dev:myapp:ratelimit:trip_created:1") > 0
+
+        other_consumer_bucket.refund()
+        assert bucket.reserve(0) == (True, 0)
+        reserved, wait_s = bucket.reserve(20)
+        assert reserved
+        assert wait_s == pytest.approx(10, abs=0.1)
+
+
+class TestRedisDedupStore:
+    def test_seen(self, redis_client):
+        # left by earlier runs until it expires
+        redis_client.delete("hedwig:dev:myapp:dedup:123")
+        dedup_store = redis.RedisDedupStore()
+
+        assert not dedup_store.seen('123')
+        dedup_store.record('123', 10)
+        assert dedup_store.seen('123')
+        assert 0 < redis_client.ttl("hedwig:dev:myapp:dedup:123") <= 10
+
+
+class TestRedisCluster:
+    @pytest.fixture(name='cluster_client')
+    def _cluster_client(self, redis_settings):
+        redis_settings.REDIS_CLUSTER = True
+        # client for stream groups setup was already created
+        hedwig_settings.clear_cache()
+        with mock.patch("hedwig.backends.redis.RedisCluster", autospec=True) as cluster_mock:
+            client = cluster_mock.from_url.return_value
+            client.keyslot.side_effect = lambda key: key_slot(key.encode())
+            client.xreadgroup.return_value = {}
+            # nothing to claim from any of the streams
+            client.register_script.return_value.side_effect = lambda keys, args: [
+                [b"0-0", [], []] for _ in range(len(args) - 5)
+            ]
+            yield client
+
+    def test_client(self, cluster_client, redis_settings):
+        assert redis._client() == cluster_client
+
+    def test_queue_streams_share_slot(self, cluster_client):
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+
+        assert redis_consumer._main_stream == "hedwig:{dev:myapp}"
+        assert redis_consumer._deadletter_stream == "hedwig:{dev:myapp}:dlq"
+        assert cluster_client.keyslot(redis_consumer._main_stream) == cluster_client.keyslot(
+            redis_consumer._deadletter_stream
+        )
+
+    def test_rate_limit_keys_spread_across_slots(self, cluster_client):
+        keys = [redis.RedisTokenBucket(f'trip_created:{i}', RateLimit(rate=1))._key for i in range(2)]
+
+        assert keys == ["hedwig:dev:myapp:ratelimit:trip_created:0", "hedwig:dev:myapp:ratelimit:trip_created:1"]
+        assert len({key_slot(key.encode()) for key in keys}) == len(keys)
+
+    def test_dedup_keys_spread_across_slots(self, cluster_client):
+        dedup_store = redis.RedisDedupStore()
+
+        dedup_store.record('123', 10)
+        dedup_store.record('456', 10)
+
+        keys = [c.args[0] for c in cluster_client.set.call_args_list]
+        assert keys == ["hedwig:dev:myapp:dedup:123", "hedwig:dev:myapp:dedup:456"]
+        assert len({key_slot(key.encode()) for key in keys}) == len(keys)
+
+    def test_pull_messages_per_slot(self, cluster_client):
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        claim_script = cluster_client.register_script.return_value
+
+        assert list(redis_consumer.pull_messages(num_messages=1)) == []
+
+        # streams live in different slots, so every stream is read separately
+        assert sorted(list(c.kwargs['streams']) for c in cluster_client.xreadgroup.call_args_list) == [
+            ["hedwig:dev-trip-created-v1"],
+            ["hedwig:{dev:myapp}"],
+        ]
+        # dead-letter stream is only passed to the script with streams in the same slot
+        assert sorted(c.kwargs['keys'] for c in claim_script.call_args_list) == [
+            ["hedwig:dev-trip-created-v1"],
+            ["hedwig:{dev:myapp}", "hedwig:{dev:myapp}:dlq"],
+        ]
+
+    def test_pull_messages_dead_letter_across_slots(self, cluster_client):
+        redis_consumer = redis.RedisStreamsConsumerBackend()
+        claim_script = cluster_client.register_script.return_value
+        claim_script.side_effect = lambda keys, args: [
+            [b"0-0", [], [[b"1-0", [b"hedwig_payload", b"payload"]]] if keys[0] == "hedwig:dev-trip-created-v1" else []]
+        ]
+
+        assert list(redis_consumer.pull_messages(num_messages=1)) == []
+
+        pipeline = cluster_client.pipeline.return_value.__enter__.return_value
+        pipeline.xadd.assert_called_once_with("hedwig:{dev:myapp}:dlq", {b"hedwig_payload": b"payload"})
+        pipeline.xack.assert_called_once_with("hedwig:dev-trip-created-v1", "dev:myapp", b"1-0")
+        pipeline.execute.assert_called_once_with()
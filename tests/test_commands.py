@@ -1,6 +1,11 @@
+import logging
+from datetime import datetime, timedelta, timezone
 from unittest import mock
 
-from hedwig.commands import requeue_dead_letter
+import pytest
+
+from hedwig.commands import ReplayFilter, ReplayStats, replay_dead_letter, requeue_dead_letter
+from tests.models import MessageType
 
 
 @mock.patch('hedwig.commands.get_consumer_backend', autospec=True)
@@ -8,3 +13,148 @@ def test_requeue_dead_letter(mock_get_consumer_backend):
     requeue_dead_letter()
     mock_get_consumer_backend.assert_called_once_with(dlq=True)
     mock_get_consumer_backend.return_value.requeue_dead_letter.assert_called_once_with(10, None)
+
+
+class TestReplayFilter:
+    @pytest.mark.parametrize(
+        'replay_filter,matches',
+        [
+            (ReplayFilter(), True),
+            (ReplayFilter(message_types=['trip_created']), True),
+            (ReplayFilter(message_types=['vehicle_created']), False),
+            (ReplayFilter(versions=['1.*']), True),
+            (ReplayFilter(versions=['2.*']), False),
+            (ReplayFilter(publishers=['myapp']), True),
+            (ReplayFilter(publishers=['other']), False),
+            (ReplayFilter(headers={'foo': 'bar'}), True),
+            (ReplayFilter(headers={'foo': 'baz'}), False),
+            (ReplayFilter(published_after=datetime(2020, 1, 1)), True),
+            (ReplayFilter(published_before=datetime(2020, 1, 1, tzinfo=timezone.utc)), False),
+        ],
+    )
+    def test_matches(self, replay_filter, matches, message_factory):
+        message = message_factory(
+            msg_type=MessageType.trip_created, metadata__publisher='myapp', metadata__headers__foo='bar'
+        )
+        assert replay_filter.matches(message) is matches
+
+    def test_published_range(self, message):
+        published_at = datetime.fromtimestamp(message.timestamp / 1000, tz=timezone.utc)
+        assert ReplayFilter(published_after=published_at, published_before=published_at + timedelta(seconds=1)).matches(
+            message
+        )
+        assert not ReplayFilter(published_before=published_at).matches(message)
+
+
+@pytest.fixture(name='dlq_backend')
+def _dlq_backend(message_factory):
+    messages = [
+        message_factory(msg_type=MessageType.trip_created, metadata__headers__replay=str(i % 2)) for i in range(4)
+    ]
+    backend = mock.MagicMock()
+    backend.messages = messages
+    backend._dead_letter_pull_repeats = True
+    backend._pull_dead_letter.side_effect = [messages[:2], messages[2:], []]
+    backend._decode_dead_letter.side_effect = lambda m: (m.id, *m.serialize())
+    backend._requeue_dead_letter.side_effect = len
+    with mock.patch('hedwig.commands.get_consumer_backend', autospec=True, return_value=backend):
+        yield backend
+
+
+class TestReplayDeadLetter:
+    def test_replay_all(self, dlq_backend):
+        progress_callback = mock.MagicMock()
+
+        stats = replay_dead_letter(progress_callback=progress_callback, num_messages=2, visibility_timeout=30)
+
+        assert stats == ReplayStats(pulled=4, matched=4, replayed=4)
+        dlq_backend._reset_dead_letter_pull.assert_called_once_with()
+        dlq_backend._pull_dead_letter.assert_called_with(2, 30)
+        dlq_backend._requeue_dead_letter.assert_has_calls(
+            [mock.call(dlq_backend.messages[:2]), mock.call(dlq_backend.messages[2:])]
+        )
+        assert progress_callback.call_args_list == [
+            mock.call(ReplayStats(pulled=2, matched=2, replayed=2)),
+            mock.call(ReplayStats(pulled=4, matched=4, replayed=4)),
+        ]
+
+    def test_replay_filtered(self, dlq_backend):
+        stats = replay_dead_letter(ReplayFilter(headers={'replay': '1'}))
+
+        assert stats == ReplayStats(pulled=4, matched=2, replayed=2)
+        dlq_backend._requeue_dead_letter.assert_has_calls(
+            [mock.call([dlq_backend.messages[1]]), mock.call([dlq_backend.messages[3]])]
+        )
+
+    def test_dry_run(self, dlq_backend):
+        stats = replay_dead_letter(ReplayFilter(headers={'replay': '1'}), dry_run=True)
+
+        assert stats == ReplayStats(pulled=4, matched=2, replayed=0)
+        dlq_backend._requeue_dead_letter.assert_not_called()
+
+    def test_invalid_messages_are_skipped(self, dlq_backend):
+        dlq_backend._decode_dead_letter.side_effect = lambda m: (m.id, 'invalid', {})
+
+        stats = replay_dead_letter(ReplayFilter(headers={'replay': '1'}))
+
+        assert stats == ReplayStats(pulled=4, matched=0, replayed=0, invalid=4)
+        dlq_backend._requeue_dead_letter.assert_not_called()
+
+    def test_stops_on_seen_messages(self, dlq_backend):
+        # skipped messages become visible again
+        dlq_backend._pull_dead_letter.side_effect = [dlq_backend.messages[:2], dlq_backend.messages[:2]]
+
+        stats = replay_dead_letter(ReplayFilter(message_types=['vehicle_created']))
+
+        assert stats == ReplayStats(pulled=2, matched=0, replayed=0)
+        assert dlq_backend._pull_dead_letter.call_count == 2
+
+    @mock.patch('hedwig.commands.time', autospec=True)
+    def test_rate_limit(self, mock_time, dlq_backend):
+        mock_time.monotonic.return_value = 100.0
+
+        replay_dead_letter(rate_limit=2, num_messages=2)
+
+        # 2 messages per batch at 2 messages/sec
+        assert mock_time.sleep.call_args_list == [mock.call(1.0), mock.call(2.0), mock.call(3.0)]
+
+    @mock.patch('hedwig.commands.time', autospec=True)
+    def test_rate_limit_waits_before_pulling(self, mock_time, dlq_backend):
+        mock_time.monotonic.return_value = 100.0
+        calls = mock.MagicMock()
+        calls.attach_mock(mock_time.sleep, 'sleep')
+        calls.attach_mock(dlq_backend._pull_dead_letter, 'pull')
+        calls.attach_mock(dlq_backend._requeue_dead_letter, 'requeue')
+
+        replay_dead_letter(rate_limit=2, num_messages=2, visibility_timeout=30)
+
+        assert [name for name, _, _ in calls.mock_calls][:6] == ['sleep', 'pull', 'requeue', 'sleep', 'pull', 'requeue']
+
+    @mock.patch('hedwig.commands.time', autospec=True)
+    def test_rate_limit_caps_pull_size(self, mock_time, dlq_backend):
+        mock_time.monotonic.return_value = 100.0
+
+        replay_dead_letter(rate_limit=0.5, num_messages=10)
+
+        dlq_backend._pull_dead_letter.assert_called_with(1, None)
+        assert mock_time.sleep.call_args_list[0] == mock.call(2.0)
+
+    def test_cursor_backend_doesnt_remember_seen(self, dlq_backend):
+        dlq_backend._dead_letter_pull_repeats = False
+        # a cursor never returns the same message again, so ids aren't checked
+        dlq_backend._decode_dead_letter.side_effect = lambda m: ('same-id', *m.serialize())
+
+        stats = replay_dead_letter()
+
+        assert stats == ReplayStats(pulled=4, matched=4, replayed=4)
+
+    @mock.patch('hedwig.commands._MAX_SEEN_MESSAGES', 2)
+    @mock.patch('hedwig.commands.log', autospec=True)
+    def test_stops_when_seen_is_full(self, mock_log, dlq_backend):
+        stats = replay_dead_letter(num_messages=2)
+
+        assert stats == ReplayStats(pulled=2, matched=2, replayed=2)
+        assert dlq_backend._pull_dead_letter.call_count == 1
+        mock_log.assert_called_with(
+            'hedwig.commands', logging.WARNING, "Stopping replay after pulling 2 messages, run it again to continue"
+        )
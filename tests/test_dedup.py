@@ -0,0 +1,49 @@
+from unittest import mock
+
+import pytest
+
+from hedwig.dedup import InMemoryDedupStore, SQLiteDedupStore
+
+
+@pytest.fixture(name='dedup_store', params=['memory', 'sqlite'])
+def _dedup_store(request, settings, tmp_path):
+    settings.HEDWIG_DEDUP_MAX_SIZE = 2
+    settings.HEDWIG_DEDUP_SQLITE_PATH = str(tmp_path / 'dedup.db')
+    if request.param == 'memory':
+        return InMemoryDedupStore()
+    return SQLiteDedupStore()
+
+
+@mock.patch('hedwig.dedup.time', autospec=True)
+def test_seen(mock_time, dedup_store):
+    mock_time.monotonic.return_value = mock_time.time.return_value = 100.0
+
+    assert not dedup_store.seen('123')
+    dedup_store.record('123', 10)
+    assert dedup_store.seen('123')
+    assert not dedup_store.seen('456')
+
+    mock_time.monotonic.return_value = mock_time.time.return_value = 110.0
+    assert not dedup_store.seen('123')
+
+
+def test_in_memory_evicts_least_recently_recorded(settings):
+    settings.HEDWIG_DEDUP_MAX_SIZE = 2
+    dedup_store = InMemoryDedupStore()
+
+    dedup_store.record('1', 10)
+    dedup_store.record('2', 10)
+    dedup_store.record('1', 10)
+    dedup_store.record('3', 10)
+
+    assert dedup_store.seen('1')
+    assert not dedup_store.seen('2')
+    assert dedup_store.seen('3')
+
+
+def test_sqlite_is_shared(settings, tmp_path):
+    settings.HEDWIG_DEDUP_SQLITE_PATH = str(tmp_path / 'dedup.db')
+
+    SQLiteDedupStore().record('123', 10)
+
+    assert SQLiteDedupStore().seen('123')
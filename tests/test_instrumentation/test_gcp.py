@@ -108,7 +108,7 @@ def test_publish_sends_trace_id(mock_pubsub_v1, message, gcp_settings, use_trans
         payload = payload.encode('utf8')
         attributes["hedwig_encoding"] = 'utf8'
 
-    mock_pubsub_v1.PublisherClient.assert_called_once_with(batch_settings=())
+    mock_pubsub_v1.PublisherClient.assert_called_once_with(batch_settings=(), publisher_options=())
     gcp_publisher.publisher.topic_path.assert_called_once_with(
         gcp_settings.GOOGLE_CLOUD_PROJECT, f'hedwig-{gcp_publisher.topic(message)}'
     )
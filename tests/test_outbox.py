@@ -0,0 +1,233 @@
+import logging
+import threading
+from concurrent.futures import Future
+from unittest import mock
+
+import pytest
+
+from hedwig.__main__ import main
+from hedwig.backends.base import RetryBackoff
+from hedwig.outbox import OutboxPublisherBackend, OutboxRelay, OutboxStore, SQLiteOutboxStore, publish_on_commit
+from tests import MockHedwigPublisherBackend
+
+
+@pytest.fixture(name='outbox_settings')
+def _outbox_settings(settings, tmp_path):
+    settings.HEDWIG_OUTBOX_SQLITE_PATH = str(tmp_path / 'outbox.db')
+    settings.HEDWIG_OUTBOX_PUBLISHER_BACKEND = 'tests.MockHedwigPublisherBackend'
+    settings.HEDWIG_OUTBOX_RELAY = False
+    return settings
+
+
+@pytest.fixture(name='store')
+def _store(outbox_settings):
+    return SQLiteOutboxStore()
+
+
+@pytest.fixture(name='backend')
+def _backend():
+    backend = MockHedwigPublisherBackend()
+    backend._publish = mock.MagicMock(side_effect=lambda message, payload, attributes: f'id-{message.id}')
+    return backend
+
+
+class TestSQLiteOutboxStore:
+    def test_claim(self, store):
+        store.add('{"a": 1}', {'k': 'v'})
+        store.add(b'\x00\x01', {})
+
+        entries = store.claim(10, lease_s=60)
+
+        assert [(e.payload, e.attributes, e.attempts) for e in entries] == [
+            ('{"a": 1}', {'k': 'v'}, 0),
+            (b'\x00\x01', {}, 0),
+        ]
+        # leased
+        assert store.claim(10, lease_s=60) == []
+
+    def test_claim_limit(self, store):
+        for i in range(3):
+            store.add(str(i), {})
+
+        assert [e.payload for e in store.claim(2, lease_s=60)] == ['0', '1']
+        assert [e.payload for e in store.claim(2, lease_s=60)] == ['2']
+
+    def test_claim_after_lease_expires(self, store):
+        store.add('1', {})
+        store.claim(10, lease_s=0)
+
+        assert [e.payload for e in store.claim(10, lease_s=0)] == ['1']
+
+    def test_remove(self, store):
+        store.add('1', {})
+        entries = store.claim(10, lease_s=0)
+
+        store.remove([e.id for e in entries])
+
+        assert store.claim(10, lease_s=0) == []
+
+    def test_retry(self, store):
+        store.add('1', {})
+        (entry,) = store.claim(10, lease_s=0)
+
+        store.retry(entry.id, delay_s=60)
+        assert store.claim(10, lease_s=0) == []
+
+        store.retry(entry.id, delay_s=0)
+        assert [e.attempts for e in store.claim(10, lease_s=0)] == [2]
+
+    def test_shared_between_connections(self, store):
+        store.add('1', {})
+
+        assert [e.payload for e in SQLiteOutboxStore().claim(10, lease_s=60)] == ['1']
+        assert store.claim(10, lease_s=60) == []
+
+
+class TestOutboxRelay:
+    def test_relay_once(self, store, backend, message):
+        payload, attributes = message.serialize()
+        store.add(payload, attributes)
+
+        assert OutboxRelay(store, backend).relay_once() == 1
+
+        backend._publish.assert_called_once_with(message, payload, attributes)
+        assert store.claim(10, lease_s=0) == []
+
+    def test_relay_once_async(self, store, backend, message):
+        future: Future = Future()
+        future.set_result('123')
+        backend._publish.side_effect = None
+        backend._publish.return_value = future
+        store.add(*message.serialize())
+
+        OutboxRelay(store, backend).relay_once()
+
+        assert store.claim(10, lease_s=0) == []
+
+    @pytest.mark.parametrize('async_publish', [True, False])
+    def test_relay_once_failure(self, store, backend, message, outbox_settings, async_publish):
+        outbox_settings.HEDWIG_OUTBOX_RETRY_BACKOFF = RetryBackoff(initial_s=0, max_s=0)
+        if async_publish:
+            future: Future = Future()
+            future.set_exception(ValueError())
+            backend._publish.side_effect = None
+            backend._publish.return_value = future
+        else:
+            backend._publish.side_effect = ValueError
+        store.add(*message.serialize())
+
+        OutboxRelay(store, backend).relay_once()
+
+        assert [e.attempts for e in store.claim(10, lease_s=0)] == [1]
+
+    def test_relay_once_retry_backoff(self, store, backend, message):
+        backend._publish.side_effect = ValueError
+        store.add(*message.serialize())
+
+        with mock.patch.object(store, 'retry', wraps=store.retry) as mock_retry:
+            OutboxRelay(store, backend).relay_once()
+
+        mock_retry.assert_called_once_with(mock.ANY, 1)
+
+    def test_relay_once_sets_aside_invalid_messages(self, store, backend):
+        store.add('invalid', {})
+
+        with mock.patch('hedwig.outbox.log'):
+            OutboxRelay(store, backend).relay_once()
+
+        backend._publish.assert_not_called()
+        assert store.claim(10, lease_s=0) == []
+        assert store._conn.execute('SELECT payload, attributes FROM hedwig_outbox_failed').fetchall() == [
+            ('invalid', '{}')
+        ]
+
+    def test_fail_default(self, store):
+        store.add('invalid', {})
+        [entry] = store.claim(10, lease_s=0)
+
+        with mock.patch.object(store, 'retry', autospec=True) as mock_retry:
+            OutboxStore.fail(store, entry.id)
+
+        mock_retry.assert_called_once_with(entry.id, 86400)
+
+    def test_relay_once_logs_published_message(self, store, backend, message):
+        store.add(*message.serialize())
+
+        with mock.patch('hedwig.backends.base.log') as mock_log:
+            OutboxRelay(store, backend).relay_once()
+
+        mock_log.assert_called_once_with(
+            'hedwig.backends.base',
+            logging.DEBUG,
+            'Sent message',
+            extra={'hedwig_message': message, 'message_id': f'id-{message.id}'},
+        )
+
+    def test_run(self, store, backend, message, outbox_settings):
+        outbox_settings.HEDWIG_OUTBOX_POLL_INTERVAL_S = 60
+        published = threading.Event()
+        backend._publish.side_effect = lambda *_: published.set()
+        relay = OutboxRelay(store, backend)
+        relay.start()
+
+        store.add(*message.serialize())
+        relay.notify()
+        assert published.wait(timeout=5)
+        relay.stop(timeout=5)
+
+        backend._publish.assert_called_once_with(message, *message.serialize())
+        assert not relay._thread.is_alive()
+
+    def test_run_shutdown_event(self, store, backend):
+        shutdown_event = threading.Event()
+        shutdown_event.set()
+
+        OutboxRelay(store, backend).run(shutdown_event)
+
+        backend._publish.assert_not_called()
+
+
+class TestOutboxPublisherBackend:
+    def test_publish(self, outbox_settings, message):
+        outbox_backend = OutboxPublisherBackend()
+
+        assert outbox_backend.publish(message) == message.id
+
+        (entry,) = outbox_backend._store.claim(10, lease_s=0)
+        assert (entry.payload, entry.attributes) == message.serialize()
+
+    def test_publish_relays(self, outbox_settings, message):
+        outbox_settings.HEDWIG_OUTBOX_RELAY = True
+        outbox_backend = OutboxPublisherBackend()
+        published = threading.Event()
+
+        with mock.patch('tests.MockHedwigPublisherBackend._publish', side_effect=lambda *_: published.set()):
+            outbox_backend.publish(message)
+            assert published.wait(timeout=5)
+        outbox_backend.relay.stop(timeout=5)
+
+    def test_sync_mode(self, outbox_settings, message):
+        outbox_settings.HEDWIG_SYNC = True
+        outbox_backend = OutboxPublisherBackend()
+
+        with mock.patch.object(OutboxPublisherBackend, '_dispatch_sync', autospec=True) as mock_dispatch_sync:
+            outbox_backend.publish(message)
+
+        mock_dispatch_sync.assert_called_once_with(outbox_backend, message)
+        assert outbox_backend._store.claim(10, lease_s=0) == []
+
+
+def test_publish_on_commit(message):
+    django_transaction = pytest.importorskip('django.db.transaction')
+
+    with mock.patch.object(django_transaction, 'on_commit', autospec=True) as mock_on_commit:
+        publish_on_commit(message, using='other')
+
+    mock_on_commit.assert_called_once_with(message.publish, using='other')
+
+
+@mock.patch('hedwig.__main__.OutboxRelay', autospec=True)
+def test_main_relay(mock_outbox_relay):
+    main(['relay'])
+
+    mock_outbox_relay.return_value.run.assert_called_once_with(mock.ANY)
@@ -1,6 +1,14 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future, wait
 from unittest import mock
 
-from hedwig.publisher import publish
+import pytest
+
+from hedwig.backends import utils as backends_utils
+from hedwig.publisher import CoalescingPublisher, TrackingPublisher, publish
+from tests.models import MessageType
 
 
 @mock.patch('hedwig.publisher.get_publisher_backend', autospec=True)
@@ -9,3 +17,193 @@ def test_publish(mock_get_publisher_backend, message):
 
     mock_get_publisher_backend.assert_called_once_with()
     mock_get_publisher_backend.return_value.publish.assert_called_once_with(message)
+
+
+@pytest.fixture(name='coalescing_publisher')
+def _coalescing_publisher():
+    backend = mock.MagicMock()
+    backend.publish.side_effect = lambda message: f'id-{message.id}'
+    # long window so that tests flush explicitly
+    coalescing_publisher = CoalescingPublisher(window_s=60, backend=backend)
+    yield coalescing_publisher
+    coalescing_publisher.flush()
+
+
+class TestCoalescingPublisher:
+    def test_publishes_latest_message_per_dedup_key(self, coalescing_publisher, message_factory):
+        messages = [message_factory(msg_type=MessageType.trip_created) for _ in range(3)]
+        other_message = message_factory(msg_type=MessageType.trip_created)
+
+        futures = [coalescing_publisher.publish(message, dedup_key='trip-1') for message in messages]
+        other_future = coalescing_publisher.publish(other_message, dedup_key='trip-2')
+        coalescing_publisher._backend.publish.assert_not_called()
+
+        coalescing_publisher.flush()
+
+        assert coalescing_publisher._backend.publish.call_args_list == [
+            mock.call(messages[2]),
+            mock.call(other_message),
+        ]
+        assert [future.result() for future in futures] == [f'id-{messages[2].id}'] * 3
+        assert other_future.result() == f'id-{other_message.id}'
+
+    def test_drops_exact_duplicates(self, coalescing_publisher, message_factory):
+        message = message_factory(msg_type=MessageType.trip_created)
+        duplicate = message_factory(
+            msg_type=MessageType.trip_created, data=message.data, metadata__headers=message.headers
+        )
+        other_message = message_factory(msg_type=MessageType.trip_created)
+
+        for m in [message, duplicate, other_message]:
+            coalescing_publisher.publish(m)
+        coalescing_publisher.flush()
+
+        assert coalescing_publisher._backend.publish.call_args_list == [mock.call(message), mock.call(other_message)]
+
+    def test_async_backend(self, coalescing_publisher, message):
+        publish_future: Future = Future()
+        coalescing_publisher._backend.publish.side_effect = None
+        coalescing_publisher._backend.publish.return_value = publish_future
+
+        future = coalescing_publisher.publish(message)
+        coalescing_publisher.flush()
+        assert not future.done()
+
+        publish_future.set_result('123')
+        assert future.result() == '123'
+
+    def test_publish_failure(self, coalescing_publisher, message):
+        coalescing_publisher._backend.publish.side_effect = ValueError
+
+        future = coalescing_publisher.publish(message)
+        coalescing_publisher.flush()
+
+        assert isinstance(future.exception(), ValueError)
+
+    def test_publishes_after_window(self, message):
+        backend = mock.MagicMock()
+        coalescing_publisher = CoalescingPublisher(window_s=0.01, backend=backend)
+
+        future = coalescing_publisher.publish(message)
+
+        assert future.result(timeout=1) == backend.publish.return_value
+
+    def test_flushes_before_fork(self, coalescing_publisher, message):
+        coalescing_publisher.publish(message)
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        coalescing_publisher._backend.publish.assert_called_once_with(message)
+
+
+@pytest.fixture(name='tracking_publisher')
+def _tracking_publisher():
+    backend = mock.MagicMock()
+    tracking_publisher = TrackingPublisher(backend=backend)
+    yield tracking_publisher
+    tracking_publisher.close(timeout=0)
+
+
+class TestTrackingPublisher:
+    def test_sync_backend(self, tracking_publisher, message):
+        tracking_publisher._backend.publish.return_value = '123'
+
+        assert tracking_publisher.publish(message) == '123'
+
+        assert tracking_publisher.flush() == (1, [], [])
+
+    def test_async_backend(self, tracking_publisher, message_factory):
+        messages = [message_factory(msg_type=MessageType.trip_created) for _ in range(3)]
+        futures: list = [Future() for _ in messages]
+        tracking_publisher._backend.publish.side_effect = futures
+        for message in messages:
+            tracking_publisher.publish(message)
+        error = ValueError()
+
+        futures[0].set_result('1')
+        futures[1].set_exception(error)
+        report = tracking_publisher.flush(timeout=0)
+
+        assert report.succeeded == 1
+        assert report.failed == [(messages[1], error)]
+        assert report.pending == [messages[2]]
+        assert not report.ok
+
+        futures[2].set_result('3')
+        report = tracking_publisher.flush()
+
+        assert report == (1, [], [])
+        assert report.ok
+
+    def test_flush_waits(self, tracking_publisher, message):
+        future: Future = Future()
+        tracking_publisher._backend.publish.return_value = future
+        tracking_publisher.publish(message)
+        timer = threading.Timer(0.01, future.set_result, args=('123',))
+        timer.start()
+
+        report = tracking_publisher.flush(timeout=5)
+
+        timer.join()
+        assert report == (1, [], [])
+
+    def test_publish_error_raised(self, tracking_publisher, message):
+        tracking_publisher._backend.publish.side_effect = ValueError
+
+        with pytest.raises(ValueError):
+            tracking_publisher.publish(message)
+
+        assert tracking_publisher.flush() == (0, [], [])
+
+    @mock.patch('hedwig.publisher.wait', wraps=wait)
+    def test_context_manager(self, mock_wait, message, settings):
+        settings.HEDWIG_PUBLISHER_EXIT_TIMEOUT_S = 5
+        backend = mock.MagicMock()
+        backend.publish.return_value = '123'
+
+        with TrackingPublisher(backend=backend) as tracking_publisher:
+            tracking_publisher.publish(message)
+
+        assert tracking_publisher.report == (1, [], [])
+        mock_wait.assert_called_once_with([], 5)
+
+    def test_flush_on_exit_and_fork_registered(self, tracking_publisher):
+        [(stage, ref)] = backends_utils._flush_methods
+
+        assert stage == 0
+        assert ref() == tracking_publisher._flush_on_exit_and_fork
+
+    @mock.patch('hedwig.publisher.log', autospec=True)
+    def test_flush_on_exit_and_fork(self, mock_log, tracking_publisher, message_factory):
+        messages = [message_factory(msg_type=MessageType.trip_created) for _ in range(2)]
+        futures: list = [Future() for _ in messages]
+        tracking_publisher._backend.publish.side_effect = futures
+        for message in messages:
+            tracking_publisher.publish(message)
+        error = ValueError()
+        futures[0].set_exception(error)
+
+        tracking_publisher._flush_on_exit_and_fork(0)
+
+        mock_log.assert_called_once_with(
+            'hedwig.publisher',
+            logging.ERROR,
+            'Messages failed to publish before exit or fork',
+            extra={'failed': [messages[0].id], 'pending': [messages[1].id]},
+        )
+        # outcome is still reported by the next flush
+        assert tracking_publisher.report is None
+        assert tracking_publisher.flush(timeout=0) == (0, [(messages[0], error)], [messages[1]])
+
+    @mock.patch('hedwig.publisher.log', autospec=True)
+    def test_flush_on_exit_and_fork_closed(self, mock_log, tracking_publisher, message):
+        tracking_publisher._backend.publish.return_value = Future()
+        tracking_publisher.publish(message)
+        tracking_publisher.close(timeout=0)
+
+        tracking_publisher._flush_on_exit_and_fork(0)
+
+        mock_log.assert_not_called()
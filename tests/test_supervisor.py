@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import signal
+import threading
+from unittest import mock
+
+import pytest
+
+from hedwig.__main__ import main
+from hedwig.conf import settings as hedwig_settings
+from hedwig.supervisor import _worker_main, supervise
+
+
+@pytest.fixture(name='restore_signals')
+def _restore_signals():
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+@mock.patch('hedwig.supervisor.listen_for_messages', autospec=True)
+def test_worker_main(mock_listen_for_messages, settings, restore_signals):
+    error_counts = multiprocessing.Array('i', 2)
+
+    def listen_for_messages(num_messages, visibility_timeout_s, shutdown_event):
+        hedwig_settings.HEDWIG_HEARTBEAT_HOOK(error_count=3)
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert shutdown_event.wait(timeout=1)
+
+    mock_listen_for_messages.side_effect = listen_for_messages
+
+    _worker_main(1, 2, error_counts, 5, 30)
+
+    mock_listen_for_messages.assert_called_once_with(5, 30, shutdown_event=mock.ANY)
+    assert error_counts[:] == [0, 3]
+    assert hedwig_settings.HEDWIG_WORKER_INDEX == 1
+
+
+@pytest.mark.parametrize('host_assignment', [None, (1, 2)])
+@mock.patch('hedwig.supervisor.listen_for_messages', autospec=True)
+def test_worker_main_assigns_disjoint_partitions(mock_listen_for_messages, settings, restore_signals, host_assignment):
+    redis = pytest.importorskip('hedwig.backends.redis')
+    settings.HEDWIG_REDIS_STREAM_PARTITIONS = {'topic': 12}
+    settings.HEDWIG_REDIS_PARTITION_ASSIGNMENT = host_assignment
+    host_streams = redis._topic_streams('topic')
+    worker_streams = []
+    mock_listen_for_messages.side_effect = lambda *_, **__: worker_streams.append(redis._topic_streams('topic'))
+
+    for index in range(3):
+        # as inherited from the supervisor
+        setattr(hedwig_settings, 'HEDWIG_REDIS_PARTITION_ASSIGNMENT', host_assignment)
+        _worker_main(index, 3, multiprocessing.Array('i', 3), 5, 30)
+
+    # every partition of this host is read by exactly one worker
+    assert all(worker_streams)
+    assert sorted(stream for streams in worker_streams for stream in streams) == sorted(host_streams)
+
+
+def _listen_until_shutdown(num_messages, visibility_timeout_s, shutdown_event):
+    hedwig_settings.HEDWIG_HEARTBEAT_HOOK(error_count=2)
+    shutdown_event.wait()
+
+
+@mock.patch('hedwig.supervisor._POLL_INTERVAL_S', 0.01)
+@mock.patch('hedwig.supervisor.listen_for_messages', new=_listen_until_shutdown)
+def test_supervise(settings, restore_signals):
+    settings.HEDWIG_HEARTBEAT_INTERVAL_S = 0
+    shutdown_event = threading.Event()
+    error_counts = []
+
+    def heartbeat_hook(error_count, **kwargs):
+        error_counts.append(error_count)
+        if error_count == 2:
+            shutdown_event.set()
+
+    settings.HEDWIG_HEARTBEAT_HOOK = heartbeat_hook
+
+    with mock.patch.object(
+        multiprocessing.process.BaseProcess,
+        'terminate',
+        autospec=True,
+        side_effect=multiprocessing.process.BaseProcess.terminate,
+    ) as terminate:
+        supervise(2, shutdown_event=shutdown_event, shutdown_timeout_s=5)
+
+    assert error_counts[-1] == 2
+    assert terminate.call_count == 2
+
+
+@mock.patch('hedwig.supervisor._POLL_INTERVAL_S', 0.01)
+@mock.patch('hedwig.supervisor.multiprocessing.get_context', autospec=True)
+def test_supervise_restarts_workers(mock_get_context, settings, restore_signals):
+    settings.HEDWIG_HEARTBEAT_INTERVAL_S = 60
+    shutdown_event = threading.Event()
+    mock_get_context.return_value.Array.side_effect = lambda _, size: [0] * size
+    workers = [mock.MagicMock(), mock.MagicMock()]
+    # first worker crashes once the supervisor checks on it
+    workers[0].is_alive.return_value = False
+    workers[1].is_alive.side_effect = lambda: not shutdown_event.is_set()
+
+    def start_worker():
+        if mock_get_context.return_value.Process.call_count == 2:
+            shutdown_event.set()
+
+    for worker in workers:
+        worker.start.side_effect = start_worker
+    mock_get_context.return_value.Process.side_effect = workers
+
+    supervise(1, shutdown_event=shutdown_event)
+
+    assert mock_get_context.return_value.Process.call_count == 2
+    workers[0].terminate.assert_not_called()
+    workers[1].join.assert_called_once()
+
+
+@mock.patch('hedwig.__main__.supervise', autospec=True)
+def test_main(mock_supervise):
+    main(['consume', '--workers', '4', '--num-messages', '5', '--visibility-timeout', '30'])
+
+    mock_supervise.assert_called_once_with(4, num_messages=5, visibility_timeout_s=30, shutdown_timeout_s=60)